@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""Chunked, optionally gzip compressed output for raw log exports.
+
+ChunkedOutput coalesces many small writes into chunks of about CHUNK_SIZE
+bytes before passing them on to a file-like sink, optionally compressing
+them as a single gzip stream on the way.
+
+Exports are written to blobs, whose files API calls accept less than 1MB
+each.  Pages are not written through it: the python27 runtime buffers the
+whole response body and rejects bodies larger than 32MB, so chunking the
+response would neither lower time-to-first-byte nor bound memory use.
+"""
+
+import zlib
+
+
+# Size of a chunk passed to the sink, in bytes.
+CHUNK_SIZE = 64 * 1024
+
+# zlib compression level of gzip compressed output.
+GZIP_LEVEL = 6
+
+
+class ChunkedOutput(object):
+  """File-like object coalescing writes into chunks for another file."""
+
+  def __init__(self, sink, chunk_size=CHUNK_SIZE, gzip=False):
+    """Constructor.
+
+    Args:
+      sink: file-like object to write chunks to.
+      chunk_size: coalesce writes into chunks of this many bytes.
+      gzip: whether to gzip compress the output. Chunks are compressed
+        as a single gzip stream, chunk_size applies to uncompressed data.
+    """
+    self._sink = sink
+    self._compressor = None
+    if gzip:
+      # wbits > 15 makes zlib write a gzip header and trailer
+      self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+    self._chunk_size = chunk_size
+    self._parts = []
+    self._size = 0
+
+  def write(self, data):
+    """Buffer data, passing it on once a full chunk has accumulated."""
+    self._parts.append(data)
+    self._size += len(data)
+    if self._size >= self._chunk_size:
+      self.flush()
+
+  def flush(self):
+    """Pass on everything written so far, even if it is less than a chunk."""
+    if not self._parts:
+      return
+    chunk = ''.join(self._parts)
+    self._parts = []
+    self._size = 0
+    if self._compressor:
+      # compressed data is buffered by zlib until enough has accumulated
+      chunk = self._compressor.compress(chunk)
+      if not chunk:
+        return
+    self._sink.write(chunk)
+
+  def close(self):
+    """Flush remaining output, including the gzip trailer.
+
+    The sink is not closed.
+    """
+    self.flush()
+    if self._compressor:
+      self._sink.write(self._compressor.flush())
+      self._compressor = None
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""Raw log exports, written to a blob by task queue tasks.
+
+Exporting many requests takes longer than the 60 second deadline of a user
+request, so the request only records a LogExport and queues a task writing
+its logs.  A task writes for up to TASK_SECONDS, then queues the next task
+to continue from the offset of the last request written.  The blob is
+finalized by the last task; until then the LogExport tells how far the
+export got.
+"""
+
+import json
+import logging
+import time
+
+from google.appengine.api import files
+from google.appengine.api import logservice
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+import chunked
+
+
+# Bytes written to a blob per files API call, which accepts less than 1MB.
+BLOB_WRITE_BYTES = 512 * 1024
+
+# Seconds a task writes logs before continuing in a new task, well within
+# the 10 minute deadline of task queue requests.
+TASK_SECONDS = 5 * 60
+
+# RequestLog attributes written by the NDJSON export.
+EXPORT_FIELDS = ('request_id', 'version_id', 'start_time', 'end_time',
+                 'latency', 'pending_time', 'status', 'response_size',
+                 'method', 'resource', 'http_version', 'ip', 'host',
+                 'user_agent', 'referrer', 'combined')
+
+
+class LogExport(db.Model):
+  """A raw log export and the logservice.fetch() parameters of its logs."""
+  version = db.StringProperty()
+  level = db.IntegerProperty()
+  start_time = db.FloatProperty()
+  end_time = db.FloatProperty()
+  max_requests = db.IntegerProperty()
+  export_format = db.StringProperty()
+  gzip = db.BooleanProperty(default=False)
+  # name the blob is downloaded as
+  filename = db.StringProperty()
+  # files API name of the blob while it is written
+  blob_file = db.StringProperty()
+  # set once the blob is finalized
+  blob_key = db.StringProperty()
+  # requests written so far
+  count = db.IntegerProperty(default=0)
+  error = db.TextProperty()
+  created = db.DateTimeProperty(auto_now_add=True)
+
+
+def _json_text(value):
+  # log data may include binary data, which json.dumps() cannot encode
+  if isinstance(value, str):
+    return value.decode('utf-8', 'replace')
+  return value
+
+
+def log_to_json(log):
+  """One line of JSON with the exported fields and app logs of a request."""
+  data = dict((f, _json_text(getattr(log, f))) for f in EXPORT_FIELDS)
+  data['app_logs'] = [{'time': line.time,
+                       'level': line.level,
+                       'message': _json_text(line.message)}
+                      for line in log.app_logs]
+  return json.dumps(data)
+
+
+def write_log(output, log, export_format):
+  """Write a request and its app logs to output.
+
+  Args:
+    output: file-like object to write to.
+    log: logservice.RequestLog including its app logs.
+    export_format: 'ndjson' for a line of JSON, otherwise the combined log
+      line followed by the app logs indented with a tab.
+  """
+  if export_format == 'ndjson':
+    output.write('%s\n' % log_to_json(log))
+    return
+  output.write('%s\n' % log.combined)
+  for line in log.app_logs:
+    t = '%d:%f %s' % (line.level, line.time, line.message)
+    t = t.replace("\n", "\n: ") + "\n"
+    for l in t.splitlines(True):
+      output.write("\t%s" % l)
+
+
+def start(version, level, start_time, end_time, max_requests,
+          export_format='text', gzip=False):
+  """Create a LogExport and queue the task writing its blob.
+
+  Args:
+    version: application version whose logs are exported.
+    level: minimum log level of exported requests, or None.
+    start_time: start of the exported time range, in seconds.
+    end_time: end of the exported time range, in seconds.
+    max_requests: export at most this many of the most recent requests.
+    export_format: 'text' or 'ndjson'.
+    gzip: whether to gzip compress the blob.
+
+  Returns:
+    The stored LogExport.
+  """
+  filename = 'logs.ndjson' if export_format == 'ndjson' else 'logs.txt'
+  if gzip:
+    filename += '.gz'
+    mime_type = 'application/x-gzip'
+  elif export_format == 'ndjson':
+    mime_type = 'application/x-ndjson'
+  else:
+    mime_type = 'text/plain'
+
+  blob_file = files.blobstore.create(mime_type=mime_type,
+                                     _blobinfo_uploaded_filename=filename)
+  log_export = LogExport(version=version,
+                         level=level,
+                         start_time=float(start_time),
+                         end_time=float(end_time),
+                         max_requests=max_requests,
+                         export_format=export_format,
+                         gzip=gzip,
+                         filename=filename,
+                         blob_file=blob_file)
+  log_export.put()
+  deferred.defer(run, str(log_export.key()))
+  return log_export
+
+
+def run(key, offset=None):
+  """Task writing the logs of a LogExport following offset.
+
+  Each task closes its output, so a gzip compressed blob is a series of
+  gzip members, which decompress as a single stream.
+
+  Args:
+    key: key of the LogExport.
+    offset: offset of the last request written by the previous task, or
+      None to start with the most recent request.
+  """
+  log_export = LogExport.get(key)
+  deadline = time.time() + TASK_SECONDS
+  try:
+    logs = logservice.fetch(start_time=log_export.start_time,
+                            end_time=log_export.end_time,
+                            minimum_log_level=log_export.level,
+                            include_app_logs=True,
+                            include_incomplete=False,
+                            version_ids=[log_export.version],
+                            offset=offset)
+    offset = None
+    with files.open(log_export.blob_file, 'a') as f:
+      output = chunked.ChunkedOutput(f, chunk_size=BLOB_WRITE_BYTES,
+                                     gzip=log_export.gzip)
+      for log in logs:
+        if log_export.count >= log_export.max_requests:
+          break
+        write_log(output, log, log_export.export_format)
+        log_export.count += 1
+        if time.time() > deadline:
+          offset = log.offset
+          break
+      output.close()
+
+    if offset is not None:
+      log_export.put()
+      deferred.defer(run, key, offset=offset)
+      return
+    files.finalize(log_export.blob_file)
+    log_export.blob_key = str(
+        files.blobstore.get_blob_key(log_export.blob_file))
+    log_export.put()
+  except Exception, e:
+    # a retry would write the logs of this task a second time
+    logging.exception("export %s failed", key)
+    log_export.error = str(e)
+    log_export.put()
+    raise deferred.PermanentTaskFailure(e)
@@ -0,0 +1,567 @@
+#!/usr/bin/env python
+
+"""Aggregation of logservice.RequestLog records for the summary pages.
+
+Records are buffered column by column into array-backed batches, one pass
+over a list of records per column.  Each full batch is folded into the
+latency histograms and resource tallies a column at a time, using numpy when
+it is available and list comprehensions when it is not.
+
+Latencies are additionally tracked in LatencySketch quantile sketches, which
+report percentiles with bounded relative error in bounded memory and merge
+across batches, MapReduce shards and stored rollups.
+"""
+
+import array
+import itertools
+import math
+import struct
+import zlib
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Request categories, in the order they are shown on the summary page.
+DYNAMIC = 'dynamic'
+ERRORS = 'errors'
+STATIC = 'static'
+CACHED = 'cached'
+PENDING = 'pending'
+
+CATEGORIES = (DYNAMIC, ERRORS, STATIC, CACHED, PENDING)
+
+# Integer codes used inside column batches. PENDING is not a request class of
+# its own: requests with pending time are counted in addition to their class.
+_CODE_DYNAMIC = 0
+_CODE_ERRORS = 1
+_CODE_STATIC = 2
+_CODE_CACHED = 3
+_CODE_PENDING = 4
+
+# Number of records buffered before a batch is aggregated.
+DEFAULT_BATCH_SIZE = 10000
+
+# Relative error of the quantiles reported by LatencySketch.
+SKETCH_RELATIVE_ACCURACY = 0.01
+
+# Upper bound of the number of buckets in a LatencySketch. At 1% accuracy the
+# range from 1ms to one hour needs about 760 buckets.
+SKETCH_MAX_BUCKETS = 2048
+
+_SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+_SKETCH_LOG_GAMMA = math.log(_SKETCH_GAMMA)
+
+# Prefix of encoded sketches, see LatencySketch.to_string().
+SKETCH_PREFIX = 'S'
+
+# Percentiles shown for every latency sketch.
+PERCENTILES = (50, 90, 95, 99)
+
+
+def resource_label(log):
+  """Label under which a request is tallied in the resource lists."""
+  return """[%s] %s""" % (log.status, log.resource)
+
+
+class LogBatch(object):
+  """Column-oriented buffer of the RequestLog fields used for aggregation.
+
+  Resources are interned: the resource column holds ids into the aggregator's
+  resource table rather than strings.
+  """
+
+  def __init__(self):
+    self.status = array.array('i')
+    self.latency = array.array('d')
+    self.pending_time = array.array('d')
+    self.response_size = array.array('d')
+    self.resource = array.array('i')
+
+  def __len__(self):
+    return len(self.status)
+
+
+def sketch_bucket(ms):
+  """Index of the LatencySketch bucket counting a latency of ms milliseconds.
+
+  Latencies below 1ms are counted as 1ms.
+  """
+  return int(math.ceil(math.log(max(ms, 1.0)) / _SKETCH_LOG_GAMMA))
+
+
+class LatencySketch(object):
+  """Mergeable quantile sketch of latencies in milliseconds.
+
+  Values are counted in logarithmically sized buckets, so every quantile is
+  reported within SKETCH_RELATIVE_ACCURACY of the true value however many
+  values were added.  If the number of buckets exceeds SKETCH_MAX_BUCKETS the
+  lowest buckets are collapsed, which only affects the accuracy of the lowest
+  quantiles.
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.buckets = {}
+
+  def add(self, ms):
+    """Add a single latency."""
+    self.add_bucket(sketch_bucket(ms), 1)
+
+  def add_bucket(self, bucket, cnt):
+    """Add cnt latencies falling into bucket."""
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + cnt
+    self.count += cnt
+    if len(self.buckets) > SKETCH_MAX_BUCKETS:
+      self._collapse()
+
+  def merge(self, other):
+    """Add all latencies counted in other."""
+    for bucket, cnt in other.buckets.iteritems():
+      self.buckets[bucket] = self.buckets.get(bucket, 0) + cnt
+    self.count += other.count
+    if len(self.buckets) > SKETCH_MAX_BUCKETS:
+      self._collapse()
+
+  def _collapse(self):
+    ordered = sorted(self.buckets)
+    excess = len(ordered) - SKETCH_MAX_BUCKETS
+    target = ordered[excess]
+    for bucket in ordered[:excess]:
+      self.buckets[target] += self.buckets.pop(bucket)
+
+  def quantile(self, q):
+    """Latency in ms at quantile q (0 <= q <= 1), or None if empty."""
+    if not self.count:
+      return None
+    rank = int(q * (self.count - 1))
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen > rank:
+        break
+    return 2 * _SKETCH_GAMMA ** bucket / (_SKETCH_GAMMA + 1)
+
+  def percentiles(self, percentiles=PERCENTILES):
+    """List of (percentile, latency in ms) tuples."""
+    return [(p, self.quantile(p / 100.0)) for p in percentiles]
+
+  def to_string(self):
+    """Encode as a string starting with SKETCH_PREFIX."""
+    return SKETCH_PREFIX + ','.join(
+        '%d:%d' % item for item in sorted(self.buckets.iteritems()))
+
+  def pack(self):
+    """Encode as a binary string, see unpack_from()."""
+    values = []
+    for item in sorted(self.buckets.iteritems()):
+      values.extend(item)
+    return struct.pack('<i%dq' % len(values), len(self.buckets), *values)
+
+  @classmethod
+  def unpack_from(cls, data, offset=0):
+    """Decode a sketch packed by pack() at offset of data.
+
+    Returns:
+      tuple of the sketch and the offset following it.
+    """
+    size, = struct.unpack_from('<i', data, offset)
+    offset += 4
+    values = struct.unpack_from('<%dq' % (2 * size), data, offset)
+    sketch = cls()
+    for i in xrange(0, len(values), 2):
+      sketch.add_bucket(values[i], values[i + 1])
+    return sketch, offset + 16 * size
+
+  @classmethod
+  def from_string(cls, data):
+    """Decode a string produced by to_string()."""
+    if not data.startswith(SKETCH_PREFIX):
+      raise ValueError("Not a latency sketch: %r" % data[:10])
+    sketch = cls()
+    for item in data[len(SKETCH_PREFIX):].split(','):
+      if item:
+        bucket, cnt = item.split(':')
+        sketch.add_bucket(int(bucket), int(cnt))
+    return sketch
+
+
+def _count_pairs(code, index):
+  """Count equal (code, index) pairs of two numpy columns with bincount.
+
+  Index values spanning a range wider than the batch is long are compacted to
+  their distinct values first, so the size of the bincount depends on the
+  length of the batch rather than on the largest value.
+
+  Returns:
+    list of (code, index, count) tuples for all pairs which occur.
+  """
+  low = int(index.min())
+  stride = int(index.max()) - low + 1
+  if stride <= len(index):
+    values = numpy.arange(low, low + stride)
+    index = index - low
+  else:
+    values, index = numpy.unique(index, return_inverse=True)
+    stride = len(values)
+  counts = numpy.bincount(code * stride + index)
+  keys = numpy.flatnonzero(counts)
+  return zip((keys // stride).tolist(), values[keys % stride].tolist(),
+             counts[keys].tolist())
+
+
+class LogAggregator(object):
+  """Computes latency histograms and resource tallies for request logs.
+
+  Histograms map a bucket index (latency / precision_ms) to a request count,
+  resource tallies map a resource label to a request count; both are kept per
+  category in self.latency and self.resource, next to a LatencySketch per
+  category in self.sketch.
+  """
+
+  def __init__(self, precision_ms, batch_size=DEFAULT_BATCH_SIZE):
+    """Constructor.
+
+    Args:
+      precision_ms: width of a histogram bucket in milliseconds as int.
+      batch_size: number of records to buffer before aggregating them. None
+        buffers all records until flush() is called.
+    """
+    self.precision_ms = precision_ms
+    self.batch_size = batch_size
+    self.count = 0
+    self.latency = dict((c, {}) for c in CATEGORIES)
+    self.resource = dict((c, {}) for c in CATEGORIES)
+    self.sketch = dict((c, LatencySketch()) for c in CATEGORIES)
+    self._resource_ids = {}
+    self._resource_names = []
+    self._batch = LogBatch()
+
+  def add(self, log):
+    """Buffer a single RequestLog, see add_logs()."""
+    self.add_logs([log])
+
+  def add_logs(self, logs):
+    """Buffer a list of RequestLogs, aggregating once the batch is full.
+
+    The columns are built with one pass over logs per field, so callers
+    should pass logs in lists of hundreds or thousands rather than one by
+    one.
+    """
+    if not logs:
+      return
+    batch = self._batch
+    batch.status.fromlist([log.status for log in logs])
+    batch.latency.fromlist([log.latency for log in logs])
+    batch.pending_time.fromlist([log.pending_time for log in logs])
+    batch.response_size.fromlist([log.response_size for log in logs])
+    batch.resource.fromlist(self._intern([log.resource for log in logs]))
+    if self.batch_size and len(batch) >= self.batch_size:
+      self.flush()
+
+  def add_all(self, logs, limit=None):
+    """Buffer RequestLogs of an iterable in lists, see add_logs().
+
+    Args:
+      logs: iterable of RequestLogs.
+      limit: maximum number of logs to take, or None for all.
+
+    Returns:
+      Number of logs taken.
+    """
+    logs = iter(logs)
+    count = 0
+    while limit is None or count < limit:
+      size = self.batch_size or DEFAULT_BATCH_SIZE
+      if limit is not None:
+        size = min(size, limit - count)
+      part = list(itertools.islice(logs, size))
+      if not part:
+        break
+      self.add_logs(part)
+      count += len(part)
+    return count
+
+  def _intern(self, resources):
+    """Ids of resources in the resource table, adding new resources."""
+    ids = self._resource_ids
+    for res in set(resources):
+      if res not in ids:
+        ids[res] = len(self._resource_names)
+        self._resource_names.append(res)
+    return map(ids.__getitem__, resources)
+
+  def buffered(self):
+    """Number of records added but not yet aggregated."""
+    return len(self._batch)
+
+  def extend(self, other, limit=None):
+    """Buffer records which other has buffered but not yet aggregated.
+
+    Used to combine records fetched in parallel by separate aggregators
+    created with batch_size=None.
+
+    Args:
+      other: LogAggregator to take records from.
+      limit: maximum number of records to take, or None for all.
+
+    Returns:
+      Number of records taken, in the order they were added to other.
+    """
+    theirs = other._batch
+    n = len(theirs)
+    if limit is not None:
+      n = min(n, limit)
+    batch = self._batch
+    batch.status.extend(theirs.status[:n])
+    batch.latency.extend(theirs.latency[:n])
+    batch.pending_time.extend(theirs.pending_time[:n])
+    batch.response_size.extend(theirs.response_size[:n])
+    ids = self._intern(other._resource_names)
+    batch.resource.fromlist([ids[r] for r in theirs.resource[:n]])
+    if self.batch_size and len(batch) >= self.batch_size:
+      self.flush()
+    return n
+
+  def flush(self):
+    """Aggregate buffered records."""
+    batch = self._batch
+    if not len(batch):
+      return
+    self._batch = LogBatch()
+    self.count += len(batch)
+    if numpy is not None:
+      self._aggregate_numpy(batch)
+    else:
+      self._aggregate_python(batch)
+
+  def _aggregate_numpy(self, batch):
+    status = numpy.frombuffer(batch.status, dtype=numpy.int32)
+    latency = numpy.frombuffer(batch.latency, dtype=numpy.float64)
+    pending_time = numpy.frombuffer(batch.pending_time, dtype=numpy.float64)
+    response_size = numpy.frombuffer(batch.response_size, dtype=numpy.float64)
+    # resources are tallied under "[status] resource" labels, see
+    # _tally_resources()
+    resource = (status.astype(numpy.int64) * len(self._resource_names) +
+                numpy.frombuffer(batch.resource, dtype=numpy.int32))
+
+    code = numpy.where(status >= 400, _CODE_ERRORS,
+           numpy.where(response_size == 0, _CODE_STATIC,
+           numpy.where(status == 204, _CODE_CACHED, _CODE_DYNAMIC)))
+    ms = (latency - pending_time) * 1000
+    self._count_numpy(code, ms, resource)
+
+    pending = pending_time > 0
+    if pending.any():
+      pending_ms = pending_time[pending] * 1000
+      pending_code = numpy.empty(len(pending_ms), dtype=numpy.int64)
+      pending_code.fill(_CODE_PENDING)
+      self._count_numpy(pending_code, pending_ms, resource[pending])
+
+  def _count_numpy(self, code, ms, resource):
+    """Fold (code, latency, resource) columns into the histograms, sketches
+    and tallies."""
+    index = (ms / self.precision_ms).astype(numpy.int64)
+    for c, i, cnt in _count_pairs(code, index):
+      latency = self.latency[CATEGORIES[c]]
+      latency[i] = latency.get(i, 0) + cnt
+
+    bucket = numpy.ceil(numpy.log(numpy.maximum(ms, 1.0)) /
+                        _SKETCH_LOG_GAMMA).astype(numpy.int64)
+    for c, b, cnt in _count_pairs(code, bucket):
+      self.sketch[CATEGORIES[c]].add_bucket(b, cnt)
+
+    stride = len(self._resource_names)
+    self._tally_resources((c, p // stride, p % stride, cnt)
+                          for c, p, cnt in _count_pairs(code, resource))
+
+  def _tally_resources(self, counts):
+    """Add (code, status, resource id, count) tuples to the tallies."""
+    names = self._resource_names
+    for code, status, resource, cnt in counts:
+      tally = self.resource[CATEGORIES[code]]
+      res = '[%s] %s' % (status, names[resource])
+      tally[res] = tally.get(res, 0) + cnt
+
+  def _aggregate_python(self, batch):
+    status = batch.status
+    code = [_CODE_ERRORS if s >= 400 else
+            _CODE_STATIC if size == 0 else
+            _CODE_CACHED if s == 204 else
+            _CODE_DYNAMIC
+            for s, size in zip(status, batch.response_size)]
+    ms = [(latency - pending) * 1000
+          for latency, pending in zip(batch.latency, batch.pending_time)]
+    resource = zip(status, batch.resource)
+    self._count_python(code, ms, resource)
+
+    pending = [i for i, pending in enumerate(batch.pending_time) if pending > 0]
+    if pending:
+      self._count_python([_CODE_PENDING] * len(pending),
+                         [batch.pending_time[i] * 1000 for i in pending],
+                         [resource[i] for i in pending])
+
+  def _count_python(self, code, ms, resource):
+    """Pure Python version of _count_numpy(), resource holds (status,
+    resource id) pairs."""
+    precision_ms = self.precision_ms
+    counts = _count_keys(zip(code, [int(m / precision_ms) for m in ms]))
+    for (c, i), cnt in counts.iteritems():
+      latency = self.latency[CATEGORIES[c]]
+      latency[i] = latency.get(i, 0) + cnt
+
+    log = math.log
+    ceil = math.ceil
+    bucket = [int(ceil(log(m if m > 1.0 else 1.0) / _SKETCH_LOG_GAMMA))
+              for m in ms]
+    for (c, b), cnt in _count_keys(zip(code, bucket)).iteritems():
+      self.sketch[CATEGORIES[c]].add_bucket(b, cnt)
+
+    counts = _count_keys(zip(code, resource))
+    self._tally_resources((c, s, r, cnt)
+                          for (c, (s, r)), cnt in counts.iteritems())
+
+
+def _count_keys(keys):
+  """Dict mapping each of keys to the number of times it occurs."""
+  counts = {}
+  get = counts.get
+  for key in keys:
+    counts[key] = get(key, 0) + 1
+  return counts
+
+
+# Bucket width of the latency histograms stored in rollups.
+ROLLUP_PRECISION_MS = 100
+
+# Version tag leading every encoded rollup.
+_ROLLUP_FORMAT = 3
+
+# Fixed-size fields following the format tag: request count, busy time and
+# one counter for each status class 1xx .. 5xx.
+_ROLLUP_HEADER = 2 + 5
+
+
+def category_code(status, response_size):
+  """Integer code of the category a request falls into."""
+  if status >= 400:
+    return _CODE_ERRORS
+  elif response_size == 0:
+    return _CODE_STATIC
+  elif status == 204:
+    return _CODE_CACHED
+  return _CODE_DYNAMIC
+
+
+class Rollup(object):
+  """Mergeable aggregate of the requests in some time window.
+
+  Rollups are persisted per version and minute as a compressed string, see
+  to_string(), and merged to answer queries over arbitrary whole-minute
+  windows.  Latency histograms use ROLLUP_PRECISION_MS wide buckets, next to
+  them a LatencySketch per category gives percentiles.
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.busy_ms = 0
+    self.status = [0] * 5
+    self.latency = dict((c, {}) for c in CATEGORIES)
+    self.sketch = dict((c, LatencySketch()) for c in CATEGORIES)
+
+  def add(self, log):
+    """Add a single RequestLog."""
+    self.count += 1
+    self.busy_ms += int(log.latency * 1000)
+    status_class = log.status // 100
+    if 1 <= status_class <= 5:
+      self.status[status_class - 1] += 1
+
+    code = category_code(log.status, log.response_size)
+    ms = (log.latency - log.pending_time) * 1000
+    self._increment(code, int(ms / ROLLUP_PRECISION_MS), 1)
+    self.sketch[CATEGORIES[code]].add(ms)
+    if log.pending_time > 0:
+      ms = log.pending_time * 1000
+      self._increment(_CODE_PENDING, int(ms / ROLLUP_PRECISION_MS), 1)
+      self.sketch[PENDING].add(ms)
+
+  def _increment(self, code, bucket, cnt):
+    latency = self.latency[CATEGORIES[code]]
+    latency[bucket] = latency.get(bucket, 0) + cnt
+
+  def merge(self, other):
+    """Add all requests aggregated in other to this rollup."""
+    self.count += other.count
+    self.busy_ms += other.busy_ms
+    self.status = [a + b for a, b in zip(self.status, other.status)]
+    for category, latency in other.latency.iteritems():
+      mine = self.latency[category]
+      for bucket, cnt in latency.iteritems():
+        mine[bucket] = mine.get(bucket, 0) + cnt
+    for category, sketch in other.sketch.iteritems():
+      self.sketch[category].merge(sketch)
+
+  def histogram(self, category, precision_ms):
+    """Latency histogram of a category re-bucketed to precision_ms.
+
+    Buckets are exact when precision_ms is a multiple of ROLLUP_PRECISION_MS.
+    """
+    result = {}
+    for bucket, cnt in self.latency[category].iteritems():
+      index = bucket * ROLLUP_PRECISION_MS // precision_ms
+      result[index] = result.get(index, 0) + cnt
+    return result
+
+  def to_list(self):
+    """Encode as a list of ints.
+
+    The layout is the format tag, the request count, the busy time in ms, the
+    five status class counters and then (category code, bucket, count)
+    triples for every non-empty histogram bucket.  Sketches are not included,
+    see to_string().
+    """
+    values = [_ROLLUP_FORMAT, self.count, self.busy_ms] + self.status
+    for code, category in enumerate(CATEGORIES):
+      for bucket, cnt in sorted(self.latency[category].iteritems()):
+        values.extend((code, bucket, cnt))
+    return values
+
+  @classmethod
+  def from_list(cls, values):
+    """Decode a list produced by to_list()."""
+    if not values or values[0] != _ROLLUP_FORMAT:
+      raise ValueError("Unsupported rollup format: %r" % values[:1])
+    rollup = cls()
+    rollup.count = values[1]
+    rollup.busy_ms = values[2]
+    rollup.status = list(values[3:_ROLLUP_HEADER + 1])
+    for i in xrange(_ROLLUP_HEADER + 1, len(values), 3):
+      rollup._increment(values[i], values[i + 1], values[i + 2])
+    return rollup
+
+  def to_string(self):
+    """Encode as a zlib compressed string.
+
+    The string holds the number of ints of to_list() followed by the ints
+    themselves and then the sketch of every category, see
+    LatencySketch.pack().
+    """
+    values = self.to_list()
+    parts = [struct.pack('<i%dq' % len(values), len(values), *values)]
+    for category in CATEGORIES:
+      parts.append(self.sketch[category].pack())
+    return zlib.compress(''.join(parts))
+
+  @classmethod
+  def from_string(cls, data):
+    """Decode a string produced by to_string()."""
+    data = zlib.decompress(data)
+    size, = struct.unpack_from('<i', data)
+    rollup = cls.from_list(list(struct.unpack_from('<%dq' % size, data, 4)))
+    offset = 4 + 8 * size
+    for category in CATEGORIES:
+      rollup.sketch[category], offset = LatencySketch.unpack_from(data, offset)
+    return rollup
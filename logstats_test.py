@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+"""Tests for logstats."""
+
+import collections
+import random
+import unittest
+
+import logstats
+
+
+Log = collections.namedtuple(
+    "Log", "status latency pending_time response_size resource")
+
+
+def make_logs(count, seed=1):
+  """Deterministic mix of logs of every category."""
+  rand = random.Random(seed)
+  logs = []
+  for _ in xrange(count):
+    logs.append(Log(status=rand.choice([200, 200, 200, 204, 302, 404, 500]),
+                    latency=rand.expovariate(5.0),
+                    pending_time=rand.choice([0, 0, 0, 0.01, 0.25]),
+                    response_size=rand.choice([0, 512, 4096]),
+                    resource=rand.choice(["/", "/a", "/b?c=d"])))
+  return logs
+
+
+def expected_counts(logs, precision_ms):
+  """Histograms and tallies of logs computed one request at a time."""
+  latency = dict((c, {}) for c in logstats.CATEGORIES)
+  resource = dict((c, {}) for c in logstats.CATEGORIES)
+  for log in logs:
+    code = logstats.category_code(log.status, log.response_size)
+    timings = [(code, (log.latency - log.pending_time) * 1000)]
+    if log.pending_time > 0:
+      timings.append((logstats._CODE_PENDING, log.pending_time * 1000))
+    for code, ms in timings:
+      category = logstats.CATEGORIES[code]
+      index = int(ms / precision_ms)
+      latency[category][index] = latency[category].get(index, 0) + 1
+      label = logstats.resource_label(log)
+      resource[category][label] = resource[category].get(label, 0) + 1
+  return latency, resource
+
+
+class LogAggregatorTest(unittest.TestCase):
+  """Tests LogAggregator with and without numpy."""
+
+  def setUp(self):
+    self.numpy = logstats.numpy
+
+  def tearDown(self):
+    logstats.numpy = self.numpy
+
+  def aggregate(self, logs, precision_ms, batch_size):
+    aggregator = logstats.LogAggregator(precision_ms, batch_size)
+    for log in logs:
+      aggregator.add(log)
+    aggregator.flush()
+    return aggregator
+
+  def check(self, precision_ms=100, batch_size=logstats.DEFAULT_BATCH_SIZE):
+    logs = make_logs(2500)
+    aggregator = self.aggregate(logs, precision_ms, batch_size)
+    latency, resource = expected_counts(logs, precision_ms)
+    self.assertEquals(len(logs), aggregator.count)
+    self.assertEquals(latency, aggregator.latency)
+    self.assertEquals(resource, aggregator.resource)
+    self.assertEquals(
+        sum(sum(counts.itervalues()) for counts in latency.itervalues()),
+        sum(sketch.count for sketch in aggregator.sketch.itervalues()))
+
+  def testPython(self):
+    logstats.numpy = None
+    self.check()
+    self.check(precision_ms=1, batch_size=7)
+
+  def testNumpy(self):
+    if logstats.numpy is None:
+      return
+    self.check()
+    self.check(precision_ms=1, batch_size=7)
+
+  def testNumpyMatchesPython(self):
+    if logstats.numpy is None:
+      return
+    logs = make_logs(1000, seed=2)
+    with_numpy = self.aggregate(logs, 10, 100)
+    logstats.numpy = None
+    without_numpy = self.aggregate(logs, 10, 100)
+    for category in logstats.CATEGORIES:
+      self.assertEquals(without_numpy.sketch[category].buckets,
+                        with_numpy.sketch[category].buckets)
+
+  def testCountPairsSparse(self):
+    numpy = logstats.numpy
+    if numpy is None:
+      return
+    # values far apart must not need a bincount of their product
+    code = numpy.array([0, 4, 4, 1], dtype=numpy.int64)
+    index = numpy.array([-3, 10 ** 12, 10 ** 12, 5], dtype=numpy.int64)
+    self.assertEquals([(0, -3, 1), (1, 5, 1), (4, 10 ** 12, 2)],
+                      sorted(logstats._count_pairs(code, index)))
+
+  def testCountPairsDense(self):
+    numpy = logstats.numpy
+    if numpy is None:
+      return
+    code = numpy.array([0, 4, 4, 1, 0], dtype=numpy.int64)
+    index = numpy.array([-3, 2, 2, 5, -3], dtype=numpy.int64)
+    self.assertEquals([(0, -3, 2), (1, 5, 1), (4, 2, 2)],
+                      sorted(logstats._count_pairs(code, index)))
+
+  def testAddLogs(self):
+    logs = make_logs(2500)
+    for numpy in (self.numpy, None):
+      logstats.numpy = numpy
+      aggregator = logstats.LogAggregator(10, 100)
+      aggregator.add_logs(logs[:150])
+      aggregator.add_logs([])
+      self.assertEquals(0, aggregator.buffered())
+      self.assertEquals(2000, aggregator.add_all(iter(logs[150:]), 2000))
+      aggregator.flush()
+      self.assertEquals(2150, aggregator.count)
+      expected = self.aggregate(logs[:2150], 10, 100)
+      self.assertEquals(expected.latency, aggregator.latency)
+      self.assertEquals(expected.resource, aggregator.resource)
+
+  def testExtend(self):
+    logs = make_logs(300)
+    first = logstats.LogAggregator(100, None)
+    second = logstats.LogAggregator(100, None)
+    for log in logs[:200]:
+      first.add(log)
+    for log in logs[200:]:
+      second.add(log)
+    combined = logstats.LogAggregator(100)
+    self.assertEquals(200, combined.extend(first))
+    self.assertEquals(50, combined.extend(second, limit=50))
+    combined.flush()
+    self.assertEquals(expected_counts(logs[:250], 100),
+                      (combined.latency, combined.resource))
+
+
+class LatencySketchTest(unittest.TestCase):
+  """Tests LatencySketch."""
+
+  def testRelativeAccuracy(self):
+    values = [1 + i * 0.37 for i in xrange(10000)]
+    sketch = logstats.LatencySketch()
+    for ms in values:
+      sketch.add(ms)
+    for q in (0.5, 0.9, 0.99):
+      exact = values[int(q * (len(values) - 1))]
+      self.assertTrue(abs(sketch.quantile(q) - exact) <=
+                      exact * logstats.SKETCH_RELATIVE_ACCURACY)
+
+  def testEmpty(self):
+    self.assertEquals(None, logstats.LatencySketch().quantile(0.5))
+
+  def testMerge(self):
+    first = logstats.LatencySketch()
+    second = logstats.LatencySketch()
+    whole = logstats.LatencySketch()
+    for i in xrange(1000):
+      (first if i % 3 else second).add(i)
+      whole.add(i)
+    first.merge(second)
+    self.assertEquals(whole.count, first.count)
+    self.assertEquals(whole.buckets, first.buckets)
+
+  def testCollapse(self):
+    sketch = logstats.LatencySketch()
+    for bucket in xrange(logstats.SKETCH_MAX_BUCKETS + 10):
+      sketch.add_bucket(bucket, 1)
+    self.assertEquals(logstats.SKETCH_MAX_BUCKETS, len(sketch.buckets))
+    self.assertEquals(logstats.SKETCH_MAX_BUCKETS + 10, sketch.count)
+    self.assertEquals(11, sketch.buckets[10])
+
+  def testStringRoundTrip(self):
+    sketch = logstats.LatencySketch()
+    for ms in (0, 1, 3, 250, 250, 90000):
+      sketch.add(ms)
+    decoded = logstats.LatencySketch.from_string(sketch.to_string())
+    self.assertEquals(sketch.buckets, decoded.buckets)
+    self.assertEquals(sketch.count, decoded.count)
+    self.assertRaises(ValueError, logstats.LatencySketch.from_string, "x")
+
+  def testPackRoundTrip(self):
+    sketch = logstats.LatencySketch()
+    for ms in (0, 1, 3, 250, 250, 90000):
+      sketch.add(ms)
+    data = "xx" + sketch.pack() + logstats.LatencySketch().pack()
+    decoded, offset = logstats.LatencySketch.unpack_from(data, 2)
+    self.assertEquals(sketch.buckets, decoded.buckets)
+    self.assertEquals(sketch.count, decoded.count)
+    empty, offset = logstats.LatencySketch.unpack_from(data, offset)
+    self.assertEquals({}, empty.buckets)
+    self.assertEquals(len(data), offset)
+
+
+class RollupTest(unittest.TestCase):
+  """Tests Rollup."""
+
+  def make_rollup(self, logs):
+    rollup = logstats.Rollup()
+    for log in logs:
+      rollup.add(log)
+    return rollup
+
+  def testAdd(self):
+    logs = make_logs(500)
+    rollup = self.make_rollup(logs)
+    latency, _ = expected_counts(logs, logstats.ROLLUP_PRECISION_MS)
+    self.assertEquals(500, rollup.count)
+    self.assertEquals(latency, rollup.latency)
+    self.assertEquals(500, sum(rollup.status))
+
+  def testMerge(self):
+    logs = make_logs(500)
+    rollup = self.make_rollup(logs[:100])
+    rollup.merge(self.make_rollup(logs[100:]))
+    whole = self.make_rollup(logs)
+    self.assertEquals(whole.to_list(), rollup.to_list())
+    self.assertEquals(whole.busy_ms, rollup.busy_ms)
+
+  def testHistogram(self):
+    rollup = logstats.Rollup()
+    rollup.latency[logstats.DYNAMIC] = {0: 1, 4: 2, 5: 3, 12: 4}
+    self.assertEquals({0: 3, 1: 3, 2: 4},
+                      rollup.histogram(logstats.DYNAMIC, 500))
+
+  def testStringRoundTrip(self):
+    rollup = self.make_rollup(make_logs(500))
+    data = rollup.to_string()
+    self.assertTrue(len(data) < 8 * len(rollup.to_list()))
+    decoded = logstats.Rollup.from_string(data)
+    self.assertEquals(rollup.to_list(), decoded.to_list())
+    for category in logstats.CATEGORIES:
+      self.assertEquals(rollup.sketch[category].buckets,
+                        decoded.sketch[category].buckets)
+    self.assertEquals(0, logstats.Rollup.from_string(
+        logstats.Rollup().to_string()).count)
+
+  def testListRoundTrip(self):
+    rollup = self.make_rollup(make_logs(50))
+    decoded = logstats.Rollup.from_list(rollup.to_list())
+    self.assertEquals(rollup.to_list(), decoded.to_list())
+    self.assertRaises(ValueError, logstats.Rollup.from_list, [99])
+
+  def testListHasNoSketches(self):
+    rollup = logstats.Rollup()
+    rollup.sketch[logstats.STATIC].add(10)
+    self.assertEquals(
+        [logstats._ROLLUP_FORMAT, 0, 0, 0, 0, 0, 0, 0], rollup.to_list())
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -2,12 +2,17 @@
 
 import logging
 import urllib
+import base64
 import cgi
 import pprint
 import time
 import calendar
 import os
 import math
+import json
+import threading
+import Queue
+import itertools
 
 from google.appengine.ext import webapp
 from google.appengine.ext import db
@@ -17,12 +22,22 @@ from google.appengine.ext.webapp import util
 from google.appengine.ext.webapp import blobstore_handlers
 from google.appengine.api import app_identity
 from google.appengine.api import logservice
+from google.appengine.api import files
 
 from mapreduce import base_handler
+from mapreduce import input_readers
 from mapreduce import mapreduce_pipeline
-#from mapreduce import operation as op
+from mapreduce import operation as op
+from mapreduce import value_codec
 #from mapreduce import shuffler
 
+import logstats
+import pyramid
+import resultcache
+import chunked
+import logexport
+import topk
+
 LEVEL = {
   ''                            : '(All logs)',
   logservice.LOG_LEVEL_DEBUG    : 'DEBUG',
@@ -35,6 +50,41 @@ LEVEL = {
 MAX_LATENCY_WIDTH = 100
 TIME_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
 
+RESULT_CACHE = resultcache.ResultCache()
+
+# Maximum number of concurrent logservice.fetch() calls of a fan-out grep.
+FANOUT_WORKERS = 8
+
+# Requests pretty printed per page. The runtime buffers the whole response
+# and rejects it above 32MB, later requests are behind a 'continue' link.
+RAW_LOGS_PAGE_SIZE = 100
+
+# Logs a MapReduce shard fetches ahead of its mapper.
+LOG_PREFETCH_SIZE = 500
+
+# Map-side combiners of the MapReduce types which have one.
+COMBINERS = {
+  'graph'       : 'main.my_graph_combine',
+  'concurrency' : 'main.my_graph_combine',
+  'messages'    : 'main.my_messages_combine',
+}
+
+# Log fields read by the mapper of each MapReduce type. The mappers get
+# records of only these fields, and app logs are fetched only if listed.
+MAP_FIELDS = {
+  'collect'     : ['combined'],
+  'graph'       : ['start_time', 'end_time', 'latency'],
+  'concurrency' : ['start_time', 'end_time', 'latency'],
+  'messages'    : ['version_id', 'app_logs'],
+  'rollup'      : ['version_id', 'end_time', 'latency', 'pending_time',
+                   'status', 'response_size'],
+}
+
+# Number of logs passed at once to the mappers which take lists of logs.
+MAP_BATCH_SIZES = {
+  'rollup'      : 500,
+}
+
 def human_time(time_s):
     return time.strftime(TIME_FORMAT, time.localtime(time_s) )
 
@@ -43,32 +93,95 @@ def record_to_dict(rec):
 
 def pretty_level(level):
   return """<span class='ae-logs-severity ae-logs-severity-%s'>%s</span>""" % (level, LEVEL[level])
+
+def count_message(messages, line):
+  """Count an app log line in a topk.TopK under its template."""
+  # message may include binary data
+  key = "[%s] %s" % (LEVEL[line.level], pprint.pformat(topk.template(line.message)))
+  messages.add(key, pprint.pformat(line.message))
   
 class LogServiceMapReduceResult(db.Expando):
   start_minute = db.IntegerProperty()
+  # encoded logstats.Rollup, see Rollup.to_string()
+  rollup = db.BlobProperty()
   requests = db.ListProperty(int)
   blob_key = db.StringProperty()
+  pyramid_resolutions = db.ListProperty(int)
+  pyramid_keys = db.StringListProperty()
+
+def blob_key_of(filename):
+  """Blob key of a '/blobstore/<key>' MapReduce output file name."""
+  return filename.split('/blobstore/', 1)[-1]
+
+def write_blob(chunks):
+  """Write an iterable of strings to a new blob, returning its file name."""
+  filename = files.blobstore.create(mime_type='text/plain')
+  with files.open(filename, 'a') as f:
+    output = chunked.ChunkedOutput(f, chunk_size=logexport.BLOB_WRITE_BYTES)
+    for chunk in chunks:
+      output.write(chunk)
+    output.close()
+  files.finalize(filename)
+  return '/blobstore/%s' % files.blobstore.get_blob_key(filename)
+
+def rollup_key_name(version, minute):
+  return 'rollup:%s:%d' % (version, minute)
+
+def load_rollups(version, start_time, end_time):
+  """Returns [(minute, Rollup)] for the stored minutes of [start_time, end_time)."""
+  start_minute = int(start_time // 60)
+  end_minute = int(math.ceil(end_time / 60.0))
+  query = (LogServiceMapReduceResult.all()
+           .filter('version =', version)
+           .filter('start_minute >=', start_minute)
+           .filter('start_minute <', end_minute))
+  return [(result.start_minute, load_rollup(result))
+          for result in query.run(batch_size=500)]
+
+def load_rollup(result):
+  """Decode the logstats.Rollup stored in a LogServiceMapReduceResult."""
+  return logstats.Rollup.from_string(result.rollup)
 
 class MyPipeline(base_handler.PipelineBase):
 
-  def run(self, mr_type, shards, start_time, end_time, version):
-    logging.info('*********************************** MyPipeline.run(self, %s, %d, %f, %f, %s)' % (mr_type, shards, start_time, end_time, version) )
+  def run(self, mr_type, shards, start_time, end_time, version, split_mode='time'):
+    logging.info('*********************************** MyPipeline.run(self, %s, %d, %f, %f, %s, %s)' % (mr_type, shards, start_time, end_time, version, split_mode) )
+    mapper_params = {
+        "start_time": start_time,
+        "end_time": end_time,
+        "version_ids": [version],
+        "split_mode": split_mode,
+        # let the controller split shards which lag behind at runtime
+        "dynamic_split": True,
+        "prefetch_size": LOG_PREFETCH_SIZE,
+    }
+    if mr_type == 'messages':
+      mapper_params["include_app_logs"] = True
+    if mr_type in MAP_FIELDS:
+      mapper_params["fields"] = MAP_FIELDS[mr_type]
+    if mr_type in MAP_BATCH_SIZES:
+      mapper_params["handler_batch_size"] = MAP_BATCH_SIZES[mr_type]
     output = yield mapreduce_pipeline.MapreducePipeline(
         "My MapReduce",
         "main.my_%s_map" % mr_type,
         "main.my_%s_reduce" % mr_type,
         "mapreduce.input_readers.LogInputReader",
         "mapreduce.output_writers.BlobstoreOutputWriter",
-        mapper_params={
-            "start_time": start_time,
-            "end_time": end_time,
-            "version_ids": [version],
-        },
+        mapper_params=mapper_params,
         reducer_params={
             "mime_type": "text/plain",
         },
-        shards=shards)
-    yield StoreOutput(start_time, end_time, version, output)
+        shards=shards,
+        combiner_spec=COMBINERS.get(mr_type),
+        # hot keys are folded with the combiner instead of held in memory
+        streaming_values=mr_type in COMBINERS)
+    if mr_type == 'concurrency':
+      output = yield SweepConcurrency(output)
+    pyramid_keys = None
+    if mr_type in ('graph', 'concurrency'):
+      pyramid_keys = yield BuildPyramid(output)
+    if mr_type != 'rollup':
+      yield StoreOutput(start_time, end_time, version, output, pyramid_keys)
 
 def my_collect_map(log):
   """My map function."""
@@ -87,7 +200,10 @@ def my_graph_map(log):
   """My map function."""
 
   logging.info('--------------------------------------- Map Something ----------------------------------')
-  yield(log.start_time, '[1, 0]')
+  yield(log.start_time, value_codec.IntVector((1, 0)))
+  sketch = logstats.LatencySketch()
+  sketch.add(log.latency * 1000)
+  yield(int(math.floor(log.start_time)), sketch.to_string())
   logging.info('%f: hit' % log.start_time)
   start = int(math.floor(log.start_time))
   end = int(math.ceil(log.end_time))
@@ -95,30 +211,168 @@ def my_graph_map(log):
     if t != start:
       logging.info('%d: continued at %d **********************************************************' % (start, t) )
       logging.info('log.start_time = %f (start = %d), log.end_time = %f (end = %d)' % (log.start_time, start, log.end_time, end) )
-    yield(t, '[0, 1]')
+    yield(t, value_codec.IntVector((0, 1)))
+
+
+def my_concurrency_map(log):
+  """Map a request to its hit and the changes in concurrency it causes.
+
+  Produces the same graph as my_graph_map with a constant number of records
+  per request, see SweepConcurrency.
+  """
+
+  yield(log.start_time, value_codec.IntVector((1, 0)))
+  start = int(math.floor(log.start_time))
+  end = int(math.ceil(log.end_time))
+  sketch = logstats.LatencySketch()
+  sketch.add(log.latency * 1000)
+  yield(start, sketch.to_string())
+  # running during the seconds start .. end, both included
+  yield(start, value_codec.IntVector((0, 1)))
+  yield(end + 1, value_codec.IntVector((0, -1)))
+
+
+def my_graph_combine(key, values):
+  """Sum the vectors and merge the sketches of a key within a map slice."""
+
+  sketch = None
+  counts = []
+  for value in values:
+    if isinstance(value, value_codec.IntVector):
+      counts.append(value)
+    elif sketch is None:
+      sketch = logstats.LatencySketch.from_string(value)
+    else:
+      sketch.merge(logstats.LatencySketch.from_string(value))
+  if counts:
+    yield value_codec.sum_vectors(counts)
+  if sketch is not None:
+    yield sketch.to_string()
 
 
 def my_graph_reduce(key, values):
   """My reduce function."""
 
-  logging.info('--------------------------------------- REDUCE: key=%s, values=%s ----------------------------------' % (key, values) )
-  # convert list of list of strings -> list of list of ints
-  values = [eval(a) for a in values]
+  logging.debug('--------------------------------------- REDUCE: key=%s, %d values ----------------------------------', key, len(values))
+  # latency sketches are merged and written after the summed values, so
+  # pyramid levels can merge them again, see pyramid.parse_line()
+  sketch = logstats.LatencySketch()
+  counts = []
+  for value in values:
+    if isinstance(value, value_codec.IntVector):
+      counts.append(value)
+    else:
+      sketch.merge(logstats.LatencySketch.from_string(value))
+
+  values = list(value_codec.sum_vectors(counts))
+  if sketch.count:
+    yield "%s,%s,%s\n" % (key, values, sketch.to_string())
+  else:
+    yield "%s,%s\n" % (key, values)
+
+
+# Sums hits and concurrency changes of a second, the same way as my_graph_reduce
+# sums hits and running requests.
+my_concurrency_reduce = my_graph_reduce
+
+
+def my_messages_map(log):
+  """Count the app log messages of a request, keyed by version."""
+
+  if not log.app_logs:
+    return
+  messages = topk.TopK()
+  for line in log.app_logs:
+    count_message(messages, line)
+  yield (log.version_id, messages.to_string())
 
-  # sum elements of array
-  values = [sum(a) for a in zip(*values)]
 
-  yield "%s,%s\n" % (key, values)
+def my_messages_combine(key, values):
+  """Merge the message counts of a version within a map slice."""
+
+  yield topk.combine(values)
+
+
+def my_messages_reduce(key, values):
+  """Write the most frequent messages of a version as count, error, message."""
+
+  messages = topk.TopK.from_string(topk.combine(values))
+  for msg, count, error, example in messages.top():
+    yield "%d\t%d\t%s\t%s\n" % (count, error, msg, example)
+
+
+def my_rollup_map(logs):
+  """Map a batch of requests to the rollups of the minutes they completed in.
+
+  Called with lists of logs, see MAP_BATCH_SIZES.
+  """
+
+  rollups = {}
+  for log in logs:
+    key = '%s:%d' % (log.version_id, int(log.end_time // 60))
+    rollup = rollups.get(key)
+    if rollup is None:
+      rollup = rollups[key] = logstats.Rollup()
+    rollup.add(log)
+  for key, rollup in rollups.iteritems():
+    yield (key, rollup.to_string())
+
+
+def my_rollup_reduce(key, values):
+  """Merge the requests of one version and minute and store the rollup."""
+
+  version, minute = key.rsplit(':', 1)
+  rollup = logstats.Rollup()
+  for value in values:
+    rollup.merge(logstats.Rollup.from_string(value))
+  yield op.db.Put(LogServiceMapReduceResult(key_name=rollup_key_name(version, int(minute)),
+                                            version=version,
+                                            start_minute=int(minute),
+                                            rollup=db.Blob(rollup.to_string())))
+
+
+class BuildPyramid(base_handler.PipelineBase):
+  """A pipeline to aggregate graph MapReduce output into pyramid levels.
+
+  Returns one blob file name for every level of pyramid.RESOLUTIONS.
+  """
+
+  def run(self, blob_keys):
+    lines = itertools.chain.from_iterable(
+        blobstore.BlobReader(blob_key_of(blob_key)) for blob_key in blob_keys)
+    levels = pyramid.build(lines)
+
+    filenames = []
+    for resolution in pyramid.RESOLUTIONS:
+      points = levels[resolution]
+      filenames.append(write_blob(pyramid.format_level([point]) for point in points))
+      logging.info("pyramid level %ds: %d points" % (resolution, len(points)) )
+    return filenames
+
+
+class SweepConcurrency(base_handler.PipelineBase):
+  """A pipeline to turn 'concurrency' MapReduce output into graph output.
+
+  Returns a list with the file name of a single blob.
+  """
+
+  def run(self, blob_keys):
+    lines = itertools.chain.from_iterable(
+        blobstore.BlobReader(blob_key_of(blob_key)) for blob_key in blob_keys)
+    return [write_blob(pyramid.sweep_concurrency(lines))]
 
 
 class StoreOutput(base_handler.PipelineBase):
   """A pipeline to store the result of the MapReduce job in the datastore.
   """
 
-  def run(self, start_time, end_time, version, blob_keys):
+  def run(self, start_time, end_time, version, blob_keys, pyramid_keys=None):
     for blob_key in blob_keys: 
       logging.info("********************************************** StoreOutput.run(self, blob_key=%s, start_time=%f, end_time=%f, version=%s)" % (blob_key, start_time, end_time, version) )
       result = LogServiceMapReduceResult(blob_key=blob_key, start_time=start_time, end_time=end_time, version=version)
+      if pyramid_keys:
+        result.pyramid_resolutions = list(pyramid.RESOLUTIONS)
+        result.pyramid_keys = pyramid_keys
       db.put(result)
 
 
@@ -132,26 +386,96 @@ class DownloadHandler(blobstore_handlers.BlobstoreDownloadHandler):
     key = str(urllib.unquote(key)).strip()
     logging.debug("Retuning blob with key %s" % key)
     blob_info = blobstore.BlobInfo.get(key)
-    self.send_blob(blob_info)
+    self.send_blob(blob_info, save_as=self.request.get('save_as') or False)
 
 
 
 
-class MainHandler(webapp.RequestHandler):
+class GraphDataHandler(webapp.RequestHandler):
+  """Serve the points of a graph MapReduce result as JSON.
+
+  Points are read from the coarsest pyramid level giving the requested
+  smoothing, limited to the viewport and to max_points bins.
+  """
 
+  def get(self):
+    self.response.headers['Content-Type'] = 'application/json'
+    blob_key = self.request.get('blob_key')
+    result = LogServiceMapReduceResult.all().filter('blob_key =', blob_key).get()
+    if result is None or not result.pyramid_keys:
+      self.error(404)
+      self.response.out.write(json.dumps({'error': 'No graph data for %s' % blob_key}))
+      return
+
+    try:
+      smooth_seconds = int(self.request.get('smooth_seconds') or 60)
+      start_time = float(self.request.get('start_time') or result.start_time)
+      end_time = float(self.request.get('end_time') or result.end_time)
+      max_points = int(self.request.get('max_points') or pyramid.DEFAULT_MAX_POINTS)
+    except ValueError, e:
+      self.error(400)
+      self.response.out.write(json.dumps({'error': str(e)}))
+      return
+
+    resolution, bin_seconds = pyramid.plan(smooth_seconds, end_time - start_time,
+                                           max(1, max_points),
+                                           result.pyramid_resolutions)
+    level_key = result.pyramid_keys[result.pyramid_resolutions.index(resolution)]
+    # start at a bin boundary, so the first bin is complete
+    points = pyramid.parse_level(blobstore.BlobReader(blob_key_of(level_key)),
+                                 int(start_time) // bin_seconds * bin_seconds,
+                                 end_time)
+    self.response.out.write(json.dumps({
+        'resolution': resolution,
+        'bin_seconds': bin_seconds,
+        'columns': pyramid.COLUMNS + pyramid.PERCENTILE_COLUMNS,
+        'points': pyramid.downsample(points, bin_seconds),
+    }))
+
+
+class ExportHandler(webapp.RequestHandler):
+  """Status of a raw log export, redirecting to its blob once written."""
+
+  def get(self):
+    try:
+      log_export = logexport.LogExport.get(self.request.get('key'))
+    except db.BadKeyError:
+      log_export = None
+    if log_export is None:
+      self.error(404)
+      self.response.out.write('No such export')
+      return
+
+    if log_export.blob_key:
+      self.redirect('/blobstore/%s?save_as=%s' % (log_export.blob_key,
+                                                   urllib.quote(log_export.filename)))
+      return
+
+    if log_export.error:
+      status = 'Export failed after %d requests: %s' % (log_export.count,
+                                                       cgi.escape(log_export.error))
+      refresh = ''
+    else:
+      status = 'Exported %d of at most %d requests to %s ...' % (
+          log_export.count, log_export.max_requests, cgi.escape(log_export.filename))
+      refresh = "<meta http-equiv='refresh' content='5'>"
+    self.response.out.write("""
+      <html>
+        <head><title>Log export</title>%s</head>
+        <body style='font-family: arial;'>%s</body>
+      </html>
+      """ % (refresh, status))
 
-    def out(self, msg):
 
-       if not self.batch:
-         self.response.out.write(msg)
+class MainHandler(webapp.RequestHandler):
 
 
-    def batch_out(self, msg):
+    def out(self, msg):
 
-       self.response.out.write(msg)
+       self.output.write(msg)
 
 
-    def show_latency(self, precision_ms, latency, resource, name, comment):
+    def show_latency(self, precision_ms, latency, resource, name, comment, sketch=None):
 
         self.out("""<h1>Latency - %s</h1>""" % name)
         self.out("""<div class='comment'>%s</div>""" % comment)
@@ -159,6 +483,9 @@ class MainHandler(webapp.RequestHandler):
           self.out('No logs')
           return
 
+        if sketch is not None and sketch.count:
+          self.out("""<pre>%s</pre>""" % ', '.join('p%d: %d ms' % (p, ms) for p, ms in sketch.percentiles()) )
+
         scale = min(1, float(MAX_LATENCY_WIDTH) / max(latency.values()))
         self.out("""<pre>""")
         for k in range(0, max(latency) + 1 ):
@@ -172,10 +499,19 @@ class MainHandler(webapp.RequestHandler):
         self.out("""</pre>""")
 
 
-    def do_visualize(self, blob_key, smooth_seconds):
+    def do_visualize(self, blob_key, smooth_seconds, inline_data=None):
 
         # --------------- MapReduce results ---------------
         self.out("""<h1>MapReduce results</h1>""")
+        # results with a pyramid are served by GraphDataHandler at the
+        # resolution needed, others are binned in the browser
+        graph_url = ''
+        if blob_key and inline_data is None:
+          result = LogServiceMapReduceResult.all().filter('blob_key =', blob_key).get()
+          if result and result.pyramid_keys:
+            graph_url = '/graph.json?%s' % urllib.urlencode({'blob_key': blob_key, 'smooth_seconds': smooth_seconds})
+        # inline_data is CSV in the MapReduce output format, shown instead of blob_key
+        inline_data = json.dumps(inline_data).replace('</', '<\\/')
 
         self.out("""
           <div id='status' class='status'>Initializing visualization...</div>
@@ -192,6 +528,8 @@ class MainHandler(webapp.RequestHandler):
 
                 var smooth_seconds = %d;
                 var blob_key = "%s";
+                var inline_data = %s;
+                var graph_url = "%s";
                 var blob_url = window.location.protocol + "//" + window.location.host + blob_key;
 
                 function setStatus(status) {
@@ -199,8 +537,8 @@ class MainHandler(webapp.RequestHandler):
                   console.log(status);
                 }
 
-                function showGraph(url) {
-                  if (!url.match(/blobstore/)) {
+                function showGraph(url, show) {
+                  if (!url.match(/blobstore|graph[.]json/)) {
                     setStatus("Invalid blobstore URL " + url);
                     return;
                   }
@@ -212,7 +550,7 @@ class MainHandler(webapp.RequestHandler):
                     if (xhr.readyState == 4) {
                       setStatus("xhr.status = " + xhr.status);
                       if (xhr.status==200) {
-                        showData(xhr.responseText);
+                        show(xhr.responseText);
                       }
                     }
                   }
@@ -224,6 +562,46 @@ class MainHandler(webapp.RequestHandler):
                   xhr.send();
                 }
 
+                function showPoints(response) {
+                  var result = JSON.parse(response);
+                  var data = new google.visualization.DataTable();
+                  data.addColumn('datetime', 'request start time');
+                  for (var j = 0; j < result.columns.length; j++) {
+                    data.addColumn('number', result.columns[j]);
+                  }
+                  for (var i = 0; i < result.points.length; i++) {
+                    var point = result.points[i];
+                    data.addRow([new Date(point[0] * 1000)].concat(point.slice(1)));
+                  }
+                  // latency percentiles follow qps and concurrency, on their own axis
+                  var series = {};
+                  for (var j = 2; j < result.columns.length; j++) {
+                    series[j] = {targetAxisIndex: 1};
+                  }
+                  drawChart(data, result.points.length <= 1, series);
+                  setStatus("Showing " + result.points.length + " points smoothed over " + result.bin_seconds + " seconds for <a href='" + blob_url + "'>" + blob_url + "</a>");
+                }
+
+                function drawChart(data, columns, series) {
+                  setStatus("Visualizing results...");
+                  document.getElementById('visualization').style.visibility = "";
+
+                  if (columns) {
+                    chart =  new google.visualization.ColumnChart(document.getElementById('visualization'));
+                  } else {
+                    chart =  new google.visualization.AreaChart(document.getElementById('visualization'));
+                  }
+                  //new google.visualization.AreaChart(document.getElementById('visualization')).
+                  chart.draw(data, {legend: "top",
+                                    interpolateNulls: false,
+                                    hAxis: {title: 'Date Time',  titleTextStyle: {color: '#888'}},
+                                    width: 500, height: 400,
+                                    vAxis: {title: 'qps', titleTextStyle: {color: '#888'}},
+                                    series: series || {},
+                                    vAxes: {1: {title: 'latency ms', titleTextStyle: {color: '#888'}}},
+                             });
+                }
+
                 function showData(response) {
                   document.getElementById("blob_data").innerHTML = response;
 
@@ -290,153 +668,265 @@ class MainHandler(webapp.RequestHandler):
                     ]);
                   }
                   
-                  setStatus("Visualizing results...");
-                  document.getElementById('visualization').style.visibility = "";
-
-                  if (smooth_seconds >= (max - min) ) {
-                    chart =  new google.visualization.ColumnChart(document.getElementById('visualization'));
-                  } else {
-                    chart =  new google.visualization.AreaChart(document.getElementById('visualization'));
-                  }
-                  //new google.visualization.AreaChart(document.getElementById('visualization')).
-                  chart.draw(data, {legend: "top",
-                                    interpolateNulls: false,
-                                    hAxis: {title: 'Date Time',  titleTextStyle: {color: '#888'}},
-                                    width: 500, height: 400,
-                                    vAxis: {title: 'qps', titleTextStyle: {color: '#888'}},
-                             });
+                  drawChart(data, smooth_seconds >= (max - min));
                   setStatus("Showing results smoothed over " + smooth_seconds + " seconds for <a href='" + blob_url + "'>" + blob_url + "</a>");
                 }
             
-                google.setOnLoadCallback(function() { showGraph(blob_url); });
+                google.setOnLoadCallback(function() {
+                  if (inline_data !== null) {
+                    showData(inline_data);
+                  } else if (graph_url) {
+                    showGraph(graph_url, showPoints);
+                  } else {
+                    showGraph(blob_url, showData);
+                  }
+                });
 
                 setStatus("script block executed");
               </script>
-        """ % (smooth_seconds, blob_key) )
+        """ % (smooth_seconds, blob_key, inline_data, graph_url) )
+
+
+    def do_visualize_rollups(self, version, start_time, end_time, smooth_seconds):
+
+        rollups = load_rollups(version, start_time, end_time)
+        # one line per minute: [requests, request-seconds], which the graph
+        # turns into qps and concurrent requests when smoothing over >= 60s
+        lines = ['%d,[%d, %d]' % (minute * 60, rollup.count, rollup.busy_ms // 1000)
+                 for minute, rollup in rollups]
+        # the rollups are per minute, smooth over whole minutes
+        smooth_seconds = max(1, int(math.ceil(smooth_seconds / 60.0))) * 60
+        self.do_visualize('', smooth_seconds, '\n'.join(lines))
+
+
+    def do_grep_rollups(self, version, start_time, end_time, precision_ms):
+
+        start_minute = int(start_time // 60)
+        end_minute = int(math.ceil(end_time / 60.0))
+        rollups = load_rollups(version, start_time, end_time)
+        total = logstats.Rollup()
+        for minute, rollup in rollups:
+          total.merge(rollup)
+
+        self.out("""<h1>Per-minute rollups</h1>""")
+        self.out("""<pre>""")
+        self.out("""Window: %s - %s\n""" % (human_time(start_minute * 60), human_time(end_minute * 60)) )
+        self.out("""Minutes with rollups: %d of %d\n""" % (len(rollups), end_minute - start_minute) )
+        self.out("""Requests: %d\n""" % total.count)
+        for i, cnt in enumerate(total.status):
+          self.out("""%dxx: %d\n""" % (i + 1, cnt) )
+        self.out("""</pre>""")
+
+        if total.count == 0:
+          self.out("""
+            No rollups. Run the rollup MapReduce for this window first.
+            """)
+          return
+
+        if precision_ms % logstats.ROLLUP_PRECISION_MS:
+          self.out("""<div class='comment'>Rollups are stored with %dms precision, histogram buckets are approximate.</div>""" % logstats.ROLLUP_PRECISION_MS)
 
+        self.show_latency(precision_ms, total.histogram(logstats.DYNAMIC, precision_ms), {}, 'Dynamic Requests', 'log.response_size > 0 and log.status != 204 and log.status <= 399', total.sketch[logstats.DYNAMIC])
+        self.show_latency(precision_ms, total.histogram(logstats.ERRORS, precision_ms),  {}, 'Errors',           'log.status >= 400', total.sketch[logstats.ERRORS])
+        self.show_latency(precision_ms, total.histogram(logstats.STATIC, precision_ms),  {}, 'Static Requests',  'log.response_size == 0 and log.status <= 399', total.sketch[logstats.STATIC])
+        self.show_latency(precision_ms, total.histogram(logstats.CACHED, precision_ms),  {}, 'Cached Requests',  'log.status == 204', total.sketch[logstats.CACHED])
+        self.show_latency(precision_ms, total.histogram(logstats.PENDING, precision_ms), {}, 'Pending Time',     'log.pending_time > 0', total.sketch[logstats.PENDING])
 
-    def do_mapreduce(self, mr_type, shards, start_time, end_time, version):
+
+    def do_mapreduce(self, mr_type, shards, start_time, end_time, version, split_mode='time'):
         
         self.out("""<h1>MapReduce launched</h1>""")
         self.out("""
             <div class='status'>
             mr_type = %s<br>
             shards = %d<br>
+            split_mode = %s<br>
             start_time = %s (%f)<br>
             end_time = %s (%f)<br>
             version = %s<br>
             </div>
-          """ % (mr_type, shards, human_time(start_time), start_time, human_time(end_time), end_time, version) )
+          """ % (mr_type, shards, split_mode, human_time(start_time), start_time, human_time(end_time), end_time, version) )
         self.out("""<a href='/?version=%s'>&lt;&lt;%s</a>""" % (version, version) )
 
-        pipeline = MyPipeline(mr_type, shards, start_time, end_time, version)
+        pipeline = MyPipeline(mr_type, shards, start_time, end_time, version, split_mode)
         logging.info('************************************************************************************************************************************************')
         logging.info('*************************************************************** pipeline.start() ***************************************************************')
         logging.info('************************************************************************************************************************************************')
         pipeline.start()
 
 
-    def do_grep(self, version, max_requests, level, start_time, end_time, precision_ms, raw_logs):
-
-        latency_errors = {}
-        latency_cached = {}
-        latency_static = {}
-        latency_dynamic = {}
-        latency_pending = {}
-
-        resource_errors = {}
-        resource_cached = {}
-        resource_static = {}
-        resource_dynamic = {}
-        resource_pending = {}
-
-        messages = {}
-        include_app_logs = raw_logs == 'pretty' or raw_logs == 'download'
-        version_ids = [version]
-        include_incomplete = False
-
-        self.out("""<h1>logservice.fetch() parameters</h1>""")
-        self.out("""<pre>""")
-        self.out("""start_time: %f (%s)\n""" % (start_time, human_time(start_time)) )
-        self.out("""end_time: %f (%s)\n""" % (end_time, human_time(end_time)) )
-        level_str = LEVEL[level] if level is not None else 'None'
-        self.out("""minimum_log_level: %s (%s)\n""" % (pprint.pformat(level), level_str) )
-        self.out("""include_app_logs: %s\n""" % include_app_logs )
-        self.out("""include_incomplete: %s\n""" % include_incomplete )
-        self.out("""version_ids: %s\n""" % version_ids )
-        self.out("""</pre>""")
-        logging.info("fetch(start_time=%f, end_time=%f, minimum_log_level=%s, include_app_logs=%s, include_incomplete=%s, version_ids=%s)" % (start_time, end_time, level, include_app_logs, include_incomplete, version_ids) )
-        logs = logservice.fetch(start_time=start_time,
-                                end_time=end_time,
-                                minimum_log_level=level,
-                                include_app_logs=include_app_logs,
-                                include_incomplete=include_incomplete,
-                                version_ids=version_ids,
-			)
+    def aggregate_logs(self, logs, max_requests, precision_ms, raw_logs):
 
+        stats = logstats.LogAggregator(precision_ms)
+        messages = topk.TopK()
+        if raw_logs == '':
+          # only request fields are used, aggregate whole lists of logs
+          count = stats.add_all(logs, max_requests)
+          stats.flush()
+          return count, stats, messages
 
-        if raw_logs == 'pretty':
-          self.out("""<h1>Raw logs</h1>""")
-        if raw_logs == 'download':
-          self.response.headers['Content-Type'] = 'text/plain'
- 
+        batch = []
         count = 0
+        pretty = raw_logs == 'pretty'
+        offset = None
         for log in logs:
           #self.out('%s<br>' % log)
 
-          if raw_logs == 'pretty':
+          if pretty and count == RAW_LOGS_PAGE_SIZE:
+            # the remaining requests are aggregated, but not printed
+            pretty = False
+            self.continue_raw_logs(offset)
+          if pretty:
+            offset = log.offset
             data = record_to_dict(log)
             del data['app_logs']
             data = pprint.pformat(data)
             data = cgi.escape(data)
             self.out('<hr><pre>%s</pre><br>\n' % data)
-          if raw_logs == 'download':
-            self.batch_out('%s\n' % log.combined )
 
           for line in log.app_logs:
-            safe_msg = pprint.pformat(line.message) # message may include binary data
-            msg = "[%s] %s" % ( LEVEL[line.level], safe_msg )
             #self.out('[%s][%s] %s<br>' % (time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(line.time)), line.level, cgi.escape( safe_msg )) )
-            messages[msg] = messages.get(msg, 0) + 1
-            if raw_logs == 'pretty':
+            count_message(messages, line)
+            if pretty:
               data = record_to_dict(line)
               data = pprint.pformat(data)
               data = cgi.escape(data)
               self.out("""%s<pre class='errmsg'>%s</pre><br>""" % (pretty_level(line.level), data))
-            if raw_logs == 'download':
-              t = '%d:%f %s' % (line.level, line.time, line.message)
-              t = t.replace("\n", "\n: ") + "\n"
-              for l in t.splitlines(True):
-                self.batch_out("\t%s" % l)
-
-          res = """[%s] %s""" % (log.status, log.resource)
-          index = int( (log.latency - log.pending_time) * 1000 / precision_ms) 
-          if log.status >= 400:
-            latency_errors[index] = latency_errors.get(index, 0) + 1
-            resource_errors[res] = resource_errors.get(res, 0) + 1
-          elif log.response_size == 0:
-            latency_static[index] = latency_static.get(index, 0) + 1
-            resource_static[res] = resource_static.get(res, 0) + 1
-          elif log.status == 204:
-            latency_cached[index] = latency_cached.get(index, 0) + 1
-            resource_cached[res] = resource_cached.get(res, 0) + 1
-          else:
-            latency_dynamic[index] = latency_dynamic.get(index, 0) + 1
-            resource_dynamic[res] = resource_dynamic.get(res, 0) + 1
-
-          if log.pending_time > 0:
-            idx = int( log.pending_time / 1000 / precision_ms)
-            latency_pending[idx] = latency_pending.get(idx, 0) + 1
-            resource_pending[res] = resource_pending.get(res, 0) + 1
 
+          batch.append(log)
+          if len(batch) == logstats.DEFAULT_BATCH_SIZE:
+            stats.add_logs(batch)
+            batch = []
 
           count += 1
           if count == max_requests:
             break
+        stats.add_logs(batch)
+        stats.flush()
+        return count, stats, messages
+
+
+    def continue_raw_logs(self, offset):
+        """Link to the pretty printed raw logs following offset and to their download."""
+
+        params = dict((k, self.request.get(k).encode('utf-8')) for k in self.request.arguments())
+        params['offset'] = base64.urlsafe_b64encode(offset)
+        continue_url = '/?%s' % urllib.urlencode(params)
+        del params['offset']
+        params['raw_logs'] = 'download'
+        download_url = '/?%s' % urllib.urlencode(params)
+        self.out("""
+          <hr><div class='status'>Only the first %d requests are printed. <a href='%s'>Continue</a> with the next %d, or <a href='%s'>download</a> all of them.</div>
+          """ % (RAW_LOGS_PAGE_SIZE, cgi.escape(continue_url, True), RAW_LOGS_PAGE_SIZE, cgi.escape(download_url, True)) )
+
+
+    def aggregate_fanout(self, slices, version, max_requests, level, start_time, end_time, precision_ms):
+        """Fetch time slices concurrently, keeping the max_requests most recent requests."""
+
+        windows = input_readers.LogInputReader.split_time_range(start_time, end_time, slices)
+        parts = [None] * len(windows)
+        errors = []
+        pending = Queue.Queue()
+        for i, window in enumerate(windows):
+          pending.put((i, window))
+
+        def worker():
+          while True:
+            try:
+              i, (s, e) = pending.get_nowait()
+            except Queue.Empty:
+              return
+            try:
+              logs = logservice.fetch(start_time=s,
+                                      end_time=e,
+                                      minimum_log_level=level,
+                                      include_app_logs=False,
+                                      include_incomplete=False,
+                                      version_ids=[version],
+                                      )
+              # buffer without aggregating: only the newest max_requests
+              # requests across all slices are kept
+              part = logstats.LogAggregator(precision_ms, batch_size=None)
+              part.add_all(logs, max_requests)
+              parts[i] = part
+            except Exception, e:
+              logging.exception("fetch of slice %d failed", i)
+              errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(min(FANOUT_WORKERS, len(windows)))]
+        for t in threads:
+          t.start()
+        for t in threads:
+          t.join()
+        if errors:
+          raise errors[0]
+
+        # logs are fetched newest first, so merge the newest slice first
+        stats = logstats.LogAggregator(precision_ms)
+        remaining = max_requests
+        for part in reversed(parts):
+          remaining -= stats.extend(part, remaining)
+          if remaining <= 0:
+            break
+        stats.flush()
+        return stats.count, stats, topk.TopK()
+
+
+    def do_grep(self, version, max_requests, level, start_time, end_time, precision_ms, raw_logs, fanout=1, offset=None):
+
+        include_app_logs = raw_logs == 'pretty'
+        version_ids = [version]
+        include_incomplete = False
+
+        self.out("""<h1>logservice.fetch() parameters</h1>""")
+        self.out("""<pre>""")
+        self.out("""start_time: %f (%s)\n""" % (start_time, human_time(start_time)) )
+        self.out("""end_time: %f (%s)\n""" % (end_time, human_time(end_time)) )
+        level_str = LEVEL[level] if level is not None else 'None'
+        self.out("""minimum_log_level: %s (%s)\n""" % (pprint.pformat(level), level_str) )
+        self.out("""include_app_logs: %s\n""" % include_app_logs )
+        self.out("""include_incomplete: %s\n""" % include_incomplete )
+        self.out("""version_ids: %s\n""" % version_ids )
+        if offset:
+          self.out("""offset: %s\n""" % base64.urlsafe_b64encode(offset) )
+        self.out("""</pre>""")
+
+        # summaries of windows whose logs are final can be reused
+        cache_key = None
+        result = None
+        if raw_logs == '' and offset is None and resultcache.is_closed_window(end_time):
+          cache_key = resultcache.make_key('grep', version, max_requests, level, start_time, end_time, precision_ms)
+          result = RESULT_CACHE.get(cache_key)
+        cached = result is not None
+
+        if not cached and fanout > 1 and raw_logs == '' and offset is None:
+          logging.info("fetch() of %d slices of [%f, %f)" % (fanout, start_time, end_time) )
+          result = self.aggregate_fanout(fanout, version, max_requests, level, start_time, end_time, precision_ms)
+          if cache_key:
+            RESULT_CACHE.set(cache_key, result)
+        elif not cached:
+          logging.info("fetch(start_time=%f, end_time=%f, minimum_log_level=%s, include_app_logs=%s, include_incomplete=%s, version_ids=%s)" % (start_time, end_time, level, include_app_logs, include_incomplete, version_ids) )
+          logs = logservice.fetch(start_time=start_time,
+                                  end_time=end_time,
+                                  minimum_log_level=level,
+                                  include_app_logs=include_app_logs,
+                                  include_incomplete=include_incomplete,
+                                  version_ids=version_ids,
+                                  offset=offset,
+                                  )
+
+          if raw_logs == 'pretty':
+            self.out("""<h1>Raw logs</h1>""")
+          result = self.aggregate_logs(logs, max_requests, precision_ms, raw_logs)
+          if cache_key:
+            RESULT_CACHE.set(cache_key, result)
+        count, stats, messages = result
 
         self.out("""<h1>Summary</h1>""")
         self.out("""<pre>""")
         self.out("""Rows retrieved: %d\n""" % count)
+        if cached:
+          self.out("""Served from cache\n""")
         self.out("""</pre>""")
 
         if raw_logs == 'pretty':
@@ -449,11 +939,11 @@ class MainHandler(webapp.RequestHandler):
           return
 
         # --------------- Latency ---------------
-        self.show_latency(precision_ms, latency_dynamic, resource_dynamic, 'Dynamic Requests', 'log.response_size > 0 and log.status != 204 and log.status <= 399')
-        self.show_latency(precision_ms, latency_errors,  resource_errors,  'Errors',           'log.status >= 400')
-        self.show_latency(precision_ms, latency_static,  resource_static,  'Static Requests',  'log.response_size == 0 and log.status <= 399')
-        self.show_latency(precision_ms, latency_cached,  resource_cached,  'Cached Requests',  'log.status == 204')
-        self.show_latency(precision_ms, latency_pending, resource_pending, 'Pending Time',     'log.pending_time > 0')
+        self.show_latency(precision_ms, stats.latency[logstats.DYNAMIC], stats.resource[logstats.DYNAMIC], 'Dynamic Requests', 'log.response_size > 0 and log.status != 204 and log.status <= 399', stats.sketch[logstats.DYNAMIC])
+        self.show_latency(precision_ms, stats.latency[logstats.ERRORS],  stats.resource[logstats.ERRORS],  'Errors',           'log.status >= 400', stats.sketch[logstats.ERRORS])
+        self.show_latency(precision_ms, stats.latency[logstats.STATIC],  stats.resource[logstats.STATIC],  'Static Requests',  'log.response_size == 0 and log.status <= 399', stats.sketch[logstats.STATIC])
+        self.show_latency(precision_ms, stats.latency[logstats.CACHED],  stats.resource[logstats.CACHED],  'Cached Requests',  'log.status == 204', stats.sketch[logstats.CACHED])
+        self.show_latency(precision_ms, stats.latency[logstats.PENDING], stats.resource[logstats.PENDING], 'Pending Time',     'log.pending_time > 0', stats.sketch[logstats.PENDING])
 
         # --------------- Errors ---------------
         self.out("""<h1>Log message frequency</h1>""")
@@ -462,14 +952,40 @@ class MainHandler(webapp.RequestHandler):
             No messages.
             """)
         else:
-          for msg in sorted(messages, key=messages.get, reverse=True):
+          self.out("""
+            <div class='status'>%d messages, the %d most frequent templates are tracked.
+            Counts are upper bounds, the true count is at most the overcount lower.</div>
+            """ % (messages.total, messages.capacity) )
+          for msg, count, error, example in messages.top():
             self.out("""
-              Count: <b>%d</b><br>
-              <pre class='errmsg'>%s</pre><br>
-              """ % (messages[msg], cgi.escape(msg)) )
+              Count: <b>%d</b>%s<br>
+              <pre class='errmsg'>%s</pre>
+              <pre class='small'>e.g. %s</pre><br>
+              """ % (count, " (overcount up to %d)" % error if error else "", cgi.escape(msg), cgi.escape(example)) )
 
 
     def get(self):
+        self.export_format = self.request.get('export_format') or 'text'
+        if self.request.get('raw_logs') == 'download':
+          self.export()
+          return
+
+        self.output = self.response.out
+        self.render()
+
+
+    def export(self):
+        # exports take longer than the request deadline, a task writes them
+        # to a blob while the user waits on the status page of the export
+        version, level, max_requests, start_time, end_time = self.logs_filter()
+        log_export = logexport.start(version, level, start_time, end_time, max_requests,
+                                     self.export_format, bool(self.request.get('gzip')))
+        self.redirect('/export?key=%s' % log_export.key())
+
+
+    def logs_filter(self):
+        """The version, level, max_requests, start_time and end_time request parameters."""
+
         # version
         version = self.request.get('version')
         if not version:
@@ -487,16 +1003,6 @@ class MainHandler(webapp.RequestHandler):
         except ValueError:
           max_requests = 10
 
-        # precision_ms
-        try:
-          precision_ms = int(self.request.get('precision_ms'))
-        except ValueError:
-          precision_ms = 100
-
-        # raw_logs
-        raw_logs = self.request.get('raw_logs')
-        self.batch = raw_logs == 'download'
-
         # start_time
         try:
           s = self.request.get('start_time_str')
@@ -515,6 +1021,31 @@ class MainHandler(webapp.RequestHandler):
           # default to 'now'
           end_time = time.time()
 
+        return version, level, max_requests, start_time, end_time
+
+
+    def render(self):
+        version, level, max_requests, start_time, end_time = self.logs_filter()
+
+        # precision_ms
+        try:
+          precision_ms = int(self.request.get('precision_ms'))
+        except ValueError:
+          precision_ms = 100
+
+        # fanout
+        try:
+          fanout = max(1, int(self.request.get('fanout')))
+        except ValueError:
+          fanout = 1
+
+        # raw_logs
+        raw_logs = self.request.get('raw_logs')
+
+        # offset of the last request printed by a previous page of raw logs
+        offset = self.request.get('offset')
+        offset = base64.urlsafe_b64decode(str(offset)) if offset else None
+
         # desired_action
         desired_action=self.request.get("desired_action")
 
@@ -538,6 +1069,12 @@ class MainHandler(webapp.RequestHandler):
           mr_type = self.request.get('mr_type')
         except ValueError:
           mr_type = ""
+
+        # source
+        source = self.request.get('source')
+
+        # split_mode
+        split_mode = 'density' if self.request.get('split_mode') == 'density' else 'time'
         
         #logging.debug("%%%%%%%%%%%%%%%%%%%%%%%%%%%%%DEBUG")
         #logging.info("%%%%%%%%%%%%%%%%%%%%%%%%%%%%%INFO")
@@ -656,6 +1193,10 @@ class MainHandler(webapp.RequestHandler):
               Histogram precision: <input name='precision_ms' value='%s' size='5'>ms<br>
           """ % precision_ms)
 
+        self.out("""
+              Fetch summaries in <input name='fanout' value='%d' size='5'> parallel time slices<br>
+          """ % fanout)
+
         self.out("""
               <label for='raw_logs_none'>
                 <input type='radio' name='raw_logs' value='' id='raw_logs_none' %s>
@@ -668,10 +1209,21 @@ class MainHandler(webapp.RequestHandler):
               <label for='raw_logs_download'>
                 <input type='radio' name='raw_logs' value='download' id='raw_logs_download' %s>
                 Download raw logs
+              </label>
+              as <select name='export_format'>
+                <option value='text' %s>text</option>
+                <option value='ndjson' %s>newline-delimited JSON</option>
+              </select>
+              <label for='gzip'>
+                <input type='checkbox' name='gzip' value='1' id='gzip' %s>
+                gzip compressed
               </label><br>
           """ % ("checked" if raw_logs == '' else "",
                 "checked" if raw_logs == 'pretty' else "",
-                "checked" if raw_logs == 'download' else "") )
+                "checked" if raw_logs == 'download' else "",
+                "selected" if self.export_format == 'text' else "",
+                "selected" if self.export_format == 'ndjson' else "",
+                "checked" if self.request.get('gzip') else "") )
 
         self.out("""
               <input type='hidden' name='desired_action' value='grep'>
@@ -696,23 +1248,42 @@ class MainHandler(webapp.RequestHandler):
  
         self.out("""
               Each shard should fetch log records for <input name='seconds_per_shard' value='%d' size='10'> seconds elapsed time<br>
-          """ % seconds_per_shard )
+              <label for='split_mode'>
+                <input type='checkbox' name='split_mode' value='density' id='split_mode' %s>
+                Balance shards by sampled log density instead of elapsed time
+              </label><br>
+          """ % (seconds_per_shard, "checked" if split_mode == 'density' else "") )
 
         self.out("""
               <label for='mr_type_graph'>
                 <input type='radio' name='mr_type' value='graph' id='mr_type_graph' %s>
                 Create fun graphs
               </label><br>
+              <label for='mr_type_concurrency'>
+                <input type='radio' name='mr_type' value='concurrency' id='mr_type_concurrency' %s>
+                Create fun graphs, computing concurrency with a sweep over request start and end times
+              </label><br>
               <label for='mr_type_collect'>
                 <input type='radio' name='mr_type' value='collect' id='mr_type_collect' %s>
                 Collect in Blobstore for later download
               </label><br>
+              <label for='mr_type_rollup'>
+                <input type='radio' name='mr_type' value='rollup' id='mr_type_rollup' %s>
+                Compute per-minute rollups
+              </label><br>
+              <label for='mr_type_messages'>
+                <input type='radio' name='mr_type' value='messages' id='mr_type_messages' %s>
+                Find the most frequent log messages
+              </label><br>
           """ % ("checked" if mr_type == 'graph' else "",
-                "checked" if mr_type == 'collect' else "") )
+                "checked" if mr_type == 'concurrency' else "",
+                "checked" if mr_type == 'collect' else "",
+                "checked" if mr_type == 'rollup' else "",
+                "checked" if mr_type == 'messages' else "") )
 
         self.out("""
               <input type='hidden' name='desired_action' value='mapreduce'>
-              <input type='submit' value='MapReduce' onclick='return document.getElementById("mr_type_collect").checked || document.getElementById("mr_type_graph").checked;'> 
+              <input type='submit' value='MapReduce' onclick='return document.getElementById("mr_type_collect").checked || document.getElementById("mr_type_graph").checked || document.getElementById("mr_type_concurrency").checked || document.getElementById("mr_type_rollup").checked || document.getElementById("mr_type_messages").checked;'> 
           """)
 
         self.out("""
@@ -720,6 +1291,23 @@ class MainHandler(webapp.RequestHandler):
           </fieldset>
           """)
 
+        # --------------- 3rd FORM ---------------
+        self.out("""
+          <fieldset>
+            <legend>Per-minute rollups</legend>
+            <form action='/'>
+              Application version: <input name='version' value='%s' size='20'><br>
+              Only include requests between <input name='start_time_str' value='%s' size='20'>
+              and <input name='end_time_str' value='%s' size='20'><br>
+              Histogram precision: <input name='precision_ms' value='%s' size='5'>ms<br>
+              Smooth graph over <input name='smooth_seconds' value='%s' size='10'> seconds<br>
+              <input type='hidden' name='source' value='rollups'>
+              <button type='submit' name='desired_action' value='grep'>Summarize</button>
+              <button type='submit' name='desired_action' value='visualize'>Visualize</button>
+            </form>
+          </fieldset>
+          """ % (version, start_time_str, end_time_str, precision_ms, smooth_seconds) )
+
         results = db.Query(LogServiceMapReduceResult).order('-end_time').fetch(limit=10)
         if results:
           self.out("""
@@ -788,10 +1376,18 @@ class MainHandler(webapp.RequestHandler):
 
         # --------------- Conditional content ---------------
         if desired_action == "mapreduce":
+          if mr_type == 'rollup':
+            # rollups are stored per minute, so only ever compute whole minutes
+            start_time = math.floor(start_time / 60.0) * 60
+            end_time = math.ceil(end_time / 60.0) * 60
           shards = int(math.ceil(float(end_time - start_time) / float(seconds_per_shard)))
-          self.do_mapreduce(mr_type, shards, start_time, end_time, version)
+          self.do_mapreduce(mr_type, shards, start_time, end_time, version, split_mode)
+        elif desired_action == "grep" and source == 'rollups':
+          self.do_grep_rollups(version, start_time, end_time, precision_ms)
         elif desired_action == "grep":
-          self.do_grep(version, max_requests, level, start_time, end_time, precision_ms, raw_logs)
+          self.do_grep(version, max_requests, level, start_time, end_time, precision_ms, raw_logs, fanout, offset)
+        elif desired_action == "visualize" and source == 'rollups':
+          self.do_visualize_rollups(version, start_time, end_time, smooth_seconds)
         elif desired_action == "visualize":
           self.do_visualize(blob_key, smooth_seconds)
 
@@ -807,6 +1403,8 @@ APP = webapp.WSGIApplication(
     [
         ('/', MainHandler),
         (r'/blobstore/(.*)', DownloadHandler),
+        ('/export', ExportHandler),
+        ('/graph.json', GraphDataHandler),
     ],
     debug=True)
 
@@ -24,8 +24,12 @@ from handlers such as counters, log messages, mutation pools.
 
 
 __all__ = ["MAX_ENTITY_COUNT", "MAX_POOL_SIZE", "Context", "MutationPool",
-           "Counters", "ItemList", "EntityList", "get", "COUNTER_MAPPER_CALLS",
-           "DATASTORE_DEADLINE"]
+           "Counters", "CombinerPool", "ItemList", "EntityList", "get",
+           "COUNTER_MAPPER_CALLS", "COUNTER_COMBINER_INPUT",
+           "COUNTER_COMBINER_OUTPUT", "DATASTORE_DEADLINE",
+           "COMBINER_MAX_VALUES", "COMBINER_MAX_KEY_VALUES"]
+
+import collections
 
 from google.appengine.api import datastore
 from google.appengine.ext import db
@@ -45,6 +49,17 @@ DATASTORE_DEADLINE = 15
 # The name of the counter which counts all mapper calls.
 COUNTER_MAPPER_CALLS = "mapper_calls"
 
+# The names of the counters of values passed to and emitted by combiners.
+COUNTER_COMBINER_INPUT = "combiner_input"
+COUNTER_COMBINER_OUTPUT = "combiner_output"
+
+# Maximum number of values held by a combiner pool. Pool will be flushed when
+# reaches this amount.
+COMBINER_MAX_VALUES = 10000
+
+# Number of values of a single key after which they are combined in place.
+COMBINER_MAX_KEY_VALUES = 100
+
 
 def _normalize_entity(value):
   """Return an entity from an entity or model instance."""
@@ -210,6 +225,73 @@ class Counters(object):
     pass
 
 
+class CombinerPool(object):
+  """Pre-aggregates mapper output per key before it is written.
+
+  Values are collected per key in memory. When a key has collected
+  max_key_values values they are replaced with the combiner output, and when
+  the pool holds max_values values altogether all keys are combined and
+  written to the output writer. Combiner output may be combined again, so
+  the combiner has to be associative, like the reducer it runs ahead of.
+
+  The pool must be registered before the pools of the output writer, so its
+  output is flushed together with them.
+  """
+
+  def __init__(self,
+               combiner,
+               output_writer,
+               ctx,
+               max_values=COMBINER_MAX_VALUES,
+               max_key_values=COMBINER_MAX_KEY_VALUES):
+    """Constructor.
+
+    Args:
+      combiner: combiner function. Called as combiner(key, values), it has
+        to yield or return the combined values.
+      output_writer: output writer to write (key, value) tuples to.
+      ctx: mapreduce context as Context.
+      max_values: maximum number of values held before flushing.
+      max_key_values: number of values of a key which are combined in place.
+    """
+    self._combiner = combiner
+    self._output_writer = output_writer
+    self._ctx = ctx
+    self._max_values = max_values
+    self._max_key_values = max_key_values
+    self._values = {}
+    self._size = 0
+
+  def append(self, data):
+    """Add a mapper output tuple.
+
+    Args:
+      data: (key, value) tuple.
+    """
+    key, value = data
+    values = self._values.get(key)
+    if values is None:
+      values = self._values[key] = []
+    values.append(value)
+    self._size += 1
+    self._ctx.counters.increment(COUNTER_COMBINER_INPUT)
+    if len(values) >= self._max_key_values:
+      combined = list(self._combiner(key, values))
+      self._values[key] = combined
+      self._size += len(combined) - len(values)
+    if self._size >= self._max_values:
+      self.flush()
+
+  def flush(self):
+    """Combine all keys and write the result to the output writer."""
+    values, self._values = self._values, {}
+    self._size = 0
+    for key, key_values in values.iteritems():
+      for value in self._combiner(key, key_values):
+        self._ctx.counters.increment(COUNTER_COMBINER_OUTPUT)
+        self._output_writer.write((key, value), self._ctx)
+
+
 class Context(object):
   """MapReduce execution context.
 
@@ -250,14 +332,20 @@ class Context(object):
         max_entity_count=(MAX_ENTITY_COUNT/(2**self.task_retry_count)))
     self.counters = Counters(shard_state)
 
-    self._pools = {}
+    # pools are flushed in the order they were registered
+    self._pools = collections.OrderedDict()
     self.register_pool("mutation_pool", self.mutation_pool)
     self.register_pool("counters", self.counters)
 
   def flush(self):
     """Flush all information recorded in context."""
-    for pool in self._pools.values():
-      pool.flush()
+    # flushing a pool may register further pools, which are flushed as well
+    flushed = set()
+    while len(flushed) < len(self._pools):
+      for key, pool in self._pools.items():
+        if key not in flushed:
+          flushed.add(key)
+          pool.flush()
 
   # TODO(user): Add convenience method for mapper params.
 
@@ -268,6 +356,9 @@ class Context(object):
   def register_pool(self, key, pool):
     """Register an arbitrary pool to be flushed together with this context.
 
+    Pools are flushed in registration order, so a pool writing into another
+    pool has to be registered first.
+
     Args:
       key: pool key as string.
       pool: a pool instance. Pool should implement flush(self) method.
@@ -23,7 +23,6 @@
 # pylint: disable-msg=C6409
 
 import datetime
-import gc
 import logging
 import math
 import os
@@ -35,6 +34,7 @@ from google.appengine.ext import db
 from mapreduce import base_handler
 from mapreduce import context
 from mapreduce import input_readers
+from mapreduce import memory
 from mapreduce import model
 from mapreduce import operation
 from mapreduce import quota
@@ -51,6 +51,15 @@ _SLICE_DURATION_SEC = 15
 # Delay between consecutive controller callback invocations.
 _CONTROLLER_PERIOD_SEC = 2
 
+# Shards projected to finish sooner than this are never split at runtime.
+_MIN_SPLIT_REMAINING_SEC = 30
+
+# Maximum number of new shards a single shard is split into at a time.
+_MAX_SPLIT_SHARDS = 8
+
+# Runtime splits do not grow a job beyond this number of shards.
+_MAX_DYNAMIC_SHARD_COUNT = 256
+
 
 class Error(Exception):
   """Base class for exceptions in this module."""
@@ -91,6 +100,11 @@ def _run_task_hook(hooks, method, task, queue_name):
 class MapperWorkerCallbackHandler(util.HugeTaskHandler):
   """Callback handler for mapreduce worker task.
 
+  With the "handler_batch_size" mapper parameter set, the handler is called
+  with lists of up to that many input items instead of single items. Batches
+  end early at checkpoints of the input reader, and the slice only ends
+  between batches.
+
   Request Parameters:
     mapreduce_spec: MapreduceSpec of the mapreduce serialized to json.
     shard_id: id of the shard.
@@ -109,10 +123,15 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
     self._start_time = self._time()
     shard_id = tstate.shard_id
 
-    shard_state, control = db.get([
-        model.ShardState.get_key_by_shard_id(shard_id),
-        model.MapreduceControl.get_key_by_job_id(spec.mapreduce_id),
-    ])
+    keys = [model.ShardState.get_key_by_shard_id(shard_id),
+            model.MapreduceControl.get_key_by_job_id(spec.mapreduce_id)]
+    # Split requests are only ever recorded for jobs with dynamic splitting.
+    dynamic_split = spec.mapper.params.get("dynamic_split")
+    if dynamic_split:
+      keys.append(model.MapreduceState.get_key_by_job_id(spec.mapreduce_id))
+    entities = db.get(keys)
+    shard_state, control = entities[:2]
+    mapreduce_state = entities[2] if dynamic_split else None
     if not shard_state:
       # We're letting this task to die. It's up to controller code to
       # reinitialize and restart the task.
@@ -136,6 +155,19 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
 
     input_reader = tstate.input_reader
 
+    if mapreduce_state and mapreduce_state.shard_splits:
+      split = mapreduce_state.shard_splits.get(str(shard_state.shard_number))
+      if split and split["first_shard"] > tstate.last_split:
+        self._split_shard(mapreduce_state, tstate, split)
+        tstate.last_split = split["first_shard"]
+
+    # The combiner pool writes into the pools of the output writer, so it
+    # is registered before any of them.
+    combiner_spec = spec.mapper.params.get("combiner_spec")
+    if combiner_spec and tstate.output_writer:
+      ctx.register_pool("combiner_pool", context.CombinerPool(
+          util.for_name(combiner_spec), tstate.output_writer, ctx))
+
     if spec.mapper.params.get("enable_quota", True):
       quota_consumer = quota.QuotaConsumer(
           quota.QuotaManager(memcache.Client()),
@@ -144,6 +176,9 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
     else:
       quota_consumer = None
 
+    batch_size = int(spec.mapper.params.get("handler_batch_size") or 0)
+
+    memory.start_slice()
     context.Context._set(ctx)
     try:
       # consume quota ahead, because we do not want to run a datastore
@@ -151,6 +186,7 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
       if not quota_consumer or quota_consumer.check():
         scan_aborted = False
         entity = None
+        batch = []
 
         # We shouldn't fetch an entity from the reader if there's not enough
         # quota to process it. Perform all quota checks proactively.
@@ -161,8 +197,17 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
             else:
               shard_state.last_work_item = repr(entity)[:100]
 
-            scan_aborted = not self.process_data(
-                entity, input_reader, ctx, tstate)
+            if not batch_size:
+              scan_aborted = not self.process_data(
+                  entity, input_reader, ctx, tstate)
+            else:
+              if entity is not input_readers.ALLOW_CHECKPOINT:
+                batch.append(entity)
+              if (len(batch) >= batch_size or
+                  entity is input_readers.ALLOW_CHECKPOINT):
+                scan_aborted = not self.process_batch(
+                    batch, input_reader, ctx, tstate)
+                batch = []
 
             # Check if we've got enough quota for the next entity.
             if (quota_consumer and not scan_aborted and
@@ -170,6 +215,11 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
               scan_aborted = True
             if scan_aborted:
               break
+
+          # The reader has moved past a partial batch at the end of the input
+          # or when running out of quota, so it is processed in this slice.
+          if batch:
+            self.process_batch(batch, input_reader, ctx, tstate)
         else:
           scan_aborted = True
 
@@ -192,10 +242,20 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
       # exception while scanning. Figure out when it's appropriate to skip.
       ctx.flush()
 
+      # Collect once the pools released their buffers. Counters are kept in
+      # the shard state, so the time spent still shows up in this slice.
+      memory.collect()
+      collections, gc_msec = memory.end_slice(ctx)
+      if collections:
+        logging.debug("Slice of shard %d of job '%s' ran %d full garbage "
+                      "collections in %d msec", shard_state.shard_number,
+                      shard_state.mapreduce_id, collections, gc_msec)
+
       if not shard_state.active:
         # shard is going to stop. Finalize output writer if any.
         if tstate.output_writer:
           tstate.output_writer.finalize(ctx, shard_state.shard_number)
+      shard_state.progress = input_reader.progress()
       shard_state.put(config=util.create_datastore_write_config(spec))
     finally:
       context.Context._set(None)
@@ -206,7 +266,84 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
     # if there were any exceptions in code before it.
     if shard_state.active:
       self.reschedule(shard_state, tstate)
-    gc.collect()
+
+  def _split_shard(self, mapreduce_state, transient_shard_state, split):
+    """Hand off part of the shard's remaining input to new shards.
+
+    Splitting is deterministic for a given task payload, so a retried task
+    creates the same shards again, which are then found to exist.
+
+    Args:
+      mapreduce_state: current MapreduceState holding the split request. Its
+        spec and writer state already cover the new shards.
+      transient_shard_state: TransientShardState of the shard to split. Its
+        input reader is left with the rest of the input.
+      split: the split request as dict, see MapreduceState.shard_splits.
+    """
+    spec = mapreduce_state.mapreduce_spec
+    first_shard = split["first_shard"]
+    shard_numbers = range(first_shard, first_shard + split["count"])
+    input_readers = transient_shard_state.input_reader.split_remaining(
+        split["fraction"], split["count"])[:len(shard_numbers)]
+    logging.info("Shard %s of job '%s' hands off input to %d of shards %s",
+                 transient_shard_state.shard_id, spec.mapreduce_id,
+                 len(input_readers), shard_numbers)
+
+    if input_readers:
+      output_writer_class = spec.mapper.output_writer_class()
+      output_writers = []
+      for shard_number in shard_numbers[:len(input_readers)]:
+        if output_writer_class:
+          output_writers.append(
+              output_writer_class.create(mapreduce_state, shard_number))
+        else:
+          output_writers.append(None)
+      KickOffJobHandler._schedule_shards(
+          spec, input_readers, output_writers,
+          os.environ.get("HTTP_X_APPENGINE_QUEUENAME", "default"),
+          transient_shard_state.base_path,
+          first_shard_number=first_shard)
+
+    # Shards without input still have to exist for the job to complete.
+    self._finish_empty_shards(mapreduce_state,
+                              shard_numbers[len(input_readers):])
+
+  @classmethod
+  def _finish_empty_shards(cls, mapreduce_state, shard_numbers):
+    """Create shard states of shards without input as finished.
+
+    Shards which already exist are left alone.
+
+    Args:
+      mapreduce_state: current MapreduceState.
+      shard_numbers: list of shard numbers as int.
+
+    Returns:
+      list of the created ShardStates.
+    """
+    if not shard_numbers:
+      return []
+    spec = mapreduce_state.mapreduce_spec
+    keys = [model.ShardState.get_key_by_shard_id(
+                model.ShardState.shard_id_from_number(spec.mapreduce_id, n))
+            for n in shard_numbers]
+    existing = set(state.shard_number for state in db.get(keys) if state)
+
+    output_writer_class = spec.mapper.output_writer_class()
+    shard_states = []
+    for shard_number in shard_numbers:
+      if shard_number in existing:
+        continue
+      shard_state = model.ShardState.create_new(spec.mapreduce_id,
+                                                shard_number)
+      shard_state.active = False
+      shard_state.result_status = model.ShardState.RESULT_SUCCESS
+      if output_writer_class:
+        output_writer_class.create(mapreduce_state, shard_number).finalize(
+            context.Context(spec, shard_state), shard_number)
+      shard_states.append(shard_state)
+    db.put(shard_states, config=util.create_datastore_write_config(spec))
+    return shard_states
 
   def process_data(self, data, input_reader, ctx, transient_shard_state):
     """Process a single data piece.
@@ -231,22 +368,64 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
         result = handler(data)
 
       if util.is_generator_function(handler):
-        for output in result:
-          if isinstance(output, operation.Operation):
-            output(ctx)
-          else:
-            output_writer = transient_shard_state.output_writer
-            if not output_writer:
-              logging.error(
-                  "Handler yielded %s, but no output writer is set.", output)
-            else:
-              output_writer.write(output, ctx)
+        self.process_outputs(result, ctx, transient_shard_state)
+
+    return not self._slice_done()
+
+  def process_batch(self, batch, input_reader, ctx, transient_shard_state):
+    """Process a batch of data pieces.
+
+    Call mapper handler on the list of data pieces.
 
+    Args:
+      batch: a list of data to process.
+      input_reader: input reader.
+      ctx: current execution context.
+
+    Returns:
+      True if scan should be continued, False if scan should be aborted.
+    """
+    if batch:
+      ctx.counters.increment(context.COUNTER_MAPPER_CALLS, len(batch))
+
+      handler = ctx.mapreduce_spec.mapper.handler
+      result = handler(batch)
+
+      if util.is_generator_function(handler):
+        self.process_outputs(result, ctx, transient_shard_state)
+
+    return not self._slice_done()
+
+  def process_outputs(self, outputs, ctx, transient_shard_state):
+    """Dispatch the values yielded by the mapper handler.
+
+    Operations are executed, everything else goes to the combiner pool if
+    there is one, otherwise to the output writer.
+
+    Args:
+      outputs: iterable of values yielded by the handler.
+      ctx: current execution context.
+    """
+    combiner_pool = ctx.get_pool("combiner_pool")
+    output_writer = transient_shard_state.output_writer
+    for output in outputs:
+      if isinstance(output, operation.Operation):
+        output(ctx)
+      elif combiner_pool:
+        combiner_pool.append(output)
+      elif not output_writer:
+        logging.error(
+            "Handler yielded %s, but no output writer is set.", output)
+      else:
+        output_writer.write(output, ctx)
+
+  def _slice_done(self):
+    """Whether the slice has run for long enough to be rescheduled."""
     if self._time() - self._start_time > _SLICE_DURATION_SEC:
       logging.debug("Spent %s seconds. Rescheduling",
                     self._time() - self._start_time)
-      return False
-    return True
+      return True
+    return False
 
   @staticmethod
   def get_task_name(shard_id, slice_id):
@@ -355,9 +534,13 @@ class ControllerCallbackHandler(util.HugeTaskHandler):
       logging.error("State not found for mapreduce_id '%s'; skipping",
                     spec.mapreduce_id)
       return
+    # Only the stored spec has the shards added by runtime splits.
+    spec = state.mapreduce_spec
 
     shard_states = model.ShardState.find_by_mapreduce_state(state)
-    if state.active and len(shard_states) != spec.mapper.shard_count:
+    pending_shards = self.resolve_splits(state, shard_states)
+    if (state.active and
+        len(shard_states) + pending_shards != spec.mapper.shard_count):
       # Some shards were lost
       logging.error("Incorrect number of shard states: %d vs %d; "
                     "aborting job '%s'",
@@ -378,6 +561,9 @@ class ControllerCallbackHandler(util.HugeTaskHandler):
       state.failed_shards = len(failed_shards)
       state.aborted_shards = len(aborted_shards)
 
+    if state.active and spec.mapper.params.get("dynamic_split"):
+      self.split_stragglers(state, shard_states)
+
     if (not state.active and control and
         control.command == model.MapreduceControl.ABORT):
       # User-initiated abort *after* all shards have completed.
@@ -440,6 +626,112 @@ class ControllerCallbackHandler(util.HugeTaskHandler):
     ControllerCallbackHandler.reschedule(
         state, self.base_path(), spec, self.serial_id() + 1)
 
+  def resolve_splits(self, mapreduce_state, shard_states):
+    """Drop the runtime split requests which were carried out.
+
+    A request is done once all its shards exist. If the shard to split has
+    finished before taking the request, the new shards are created as
+    finished without input.
+
+    Args:
+      mapreduce_state: current mapreduce state as MapreduceState.
+      shard_states: all existing shard states. Shards created here are
+        appended.
+
+    Returns:
+      the number of shards of pending requests which do not exist yet.
+    """
+    splits = mapreduce_state.shard_splits
+    if not splits:
+      return 0
+
+    shard_numbers = set(s.shard_number for s in shard_states)
+    active_shard_numbers = set(s.shard_number for s in shard_states
+                               if s.active)
+    pending_shards = 0
+    for parent, split in splits.items():
+      first_shard = split["first_shard"]
+      missing = [n for n in range(first_shard, first_shard + split["count"])
+                 if n not in shard_numbers]
+      if missing and int(parent) in active_shard_numbers:
+        pending_shards += len(missing)
+        continue
+      if missing:
+        shard_states.extend(MapperWorkerCallbackHandler._finish_empty_shards(
+            mapreduce_state, missing))
+      del splits[parent]
+    mapreduce_state.shard_splits = splits
+    return pending_shards
+
+  def split_stragglers(self, mapreduce_state, shard_states):
+    """Request runtime splits of shards which lag behind the others.
+
+    The remaining time of a shard is projected from its mapper wall time and
+    the progress its input reader reports. A shard whose remaining time is
+    well above the median hands off part of its remaining input to new
+    shards, which are added to the job here and created by the shard itself.
+
+    Args:
+      mapreduce_state: current mapreduce state as MapreduceState. The spec,
+        writer state and split requests are updated.
+      shard_states: all shard states (active and inactive). list of ShardState.
+    """
+    spec = mapreduce_state.mapreduce_spec
+    splits = mapreduce_state.shard_splits or {}
+
+    remaining = {}
+    for shard_state in shard_states:
+      if not shard_state.active:
+        remaining[shard_state.shard_number] = 0.0
+      elif shard_state.progress:
+        walltime = shard_state.counters_map.get("mapper-walltime-msec") / 1000.0
+        remaining[shard_state.shard_number] = (
+            walltime * (1 - shard_state.progress) / shard_state.progress)
+    if len(remaining) < 2:
+      return
+
+    times = sorted(remaining.values())
+    median = times[len(times) // 2]
+    threshold = max(_MIN_SPLIT_REMAINING_SEC, 2 * median)
+    stragglers = sorted(((seconds, shard_number)
+                         for shard_number, seconds in remaining.iteritems()
+                         if seconds > threshold and
+                         str(shard_number) not in splits),
+                        reverse=True)
+
+    shard_count = spec.mapper.shard_count
+    new_splits = {}
+    for seconds, shard_number in stragglers:
+      count = min(_MAX_SPLIT_SHARDS,
+                  _MAX_DYNAMIC_SHARD_COUNT - shard_count,
+                  int(seconds / max(median, _MIN_SPLIT_REMAINING_SEC)))
+      if count < 1:
+        break
+      new_splits[str(shard_number)] = {
+          "first_shard": shard_count,
+          "count": count,
+          "fraction": count / (count + 1.0),
+      }
+      shard_count += count
+    if not new_splits:
+      return
+
+    output_writer_class = spec.mapper.output_writer_class()
+    if output_writer_class:
+      try:
+        output_writer_class.extend_job(mapreduce_state, shard_count)
+      except NotImplementedError:
+        logging.debug("%s can not add shards to job '%s'",
+                      output_writer_class.__name__, spec.mapreduce_id)
+        return
+
+    logging.info("Splitting shards of job '%s': %s",
+                 spec.mapreduce_id, new_splits)
+    splits.update(new_splits)
+    mapreduce_state.shard_splits = splits
+    spec.mapper.shard_count = shard_count
+    mapreduce_state.mapreduce_spec = spec
+
   def aggregate_state(self, mapreduce_state, shard_states):
     """Update current mapreduce state by aggregating shard states.
 
@@ -652,7 +944,8 @@ class KickOffJobHandler(util.HugeTaskHandler):
                        input_readers,
                        output_writers,
                        queue_name,
-                       base_path):
+                       base_path,
+                       first_shard_number=0):
     """Prepares shard states and schedules their execution.
 
     Args:
@@ -660,13 +953,16 @@ class KickOffJobHandler(util.HugeTaskHandler):
       input_readers: list of InputReaders describing shard splits.
       queue_name: The queue to run this job on.
       base_path: The base url path of mapreduce callbacks.
+      first_shard_number: number of the first shard as int. Shards added
+        to a running job are numbered after the existing ones.
     """
     assert len(input_readers) == len(output_writers)
     # Note: it's safe to re-attempt this handler because:
     # - shard state has deterministic and unique key.
     # - _schedule_slice will fall back gracefully if a task already exists.
     shard_states = []
-    for shard_number, input_reader in enumerate(input_readers):
+    for shard_number, input_reader in enumerate(input_readers,
+                                                first_shard_number):
       shard_state = model.ShardState.create_new(spec.mapreduce_id, shard_number)
       shard_state.shard_description = str(input_reader)
       shard_states.append(shard_state)
@@ -690,12 +986,12 @@ class KickOffJobHandler(util.HugeTaskHandler):
       quota_manager.put(shard_state.shard_id, quota_refill)
 
     # Schedule shard tasks.
-    for shard_number, (input_reader, output_writer) in enumerate(
+    for i, (input_reader, output_writer) in enumerate(
         zip(input_readers, output_writers)):
       shard_id = model.ShardState.shard_id_from_number(
-          spec.mapreduce_id, shard_number)
+          spec.mapreduce_id, first_shard_number + i)
       MapperWorkerCallbackHandler._schedule_slice(
-          shard_states[shard_number],
+          shard_states[i],
           model.TransientShardState(
               base_path, spec, shard_id, 0, input_reader,
               output_writer=output_writer),
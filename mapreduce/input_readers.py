@@ -40,8 +40,13 @@ __all__ = [
 
 # pylint: disable-msg=C6409
 
+import collections
 import copy
+import operator
 import StringIO
+import Queue
+import sys
+import threading
 import time
 import zipfile
 import logging
@@ -163,6 +168,32 @@ class InputReader(model.JsonMixin):
     """
     raise NotImplementedError("validate() not implemented in %s" % cls)
 
+  def progress(self):
+    """Returns the fraction of this reader's input already read.
+
+    Readers which can not tell return None, and their shards are never split
+    at runtime.
+
+    Returns:
+      A float between 0 and 1, or None.
+    """
+    return None
+
+  def split_remaining(self, fraction, count):
+    """Hands off part of the unread input to new readers.
+
+    Readers implementing this give up a prefix of their unread input and
+    continue with the rest.
+
+    Args:
+      fraction: fraction of the unread input to hand off.
+      count: number of readers to split the handed off input into.
+
+    Returns:
+      A list of at most count new InputReaders, empty if nothing was split.
+    """
+    return []
+
 
 # TODO(user): This should probably be renamed something like
 # "DatastoreInputReader" and DatastoreInputReader should be called
@@ -1534,9 +1565,10 @@ class RecordsReader(InputReader):
       position: file position to start reading from as int.
     """
     self._filenames = filenames
+    self._file = None
     if self._filenames:
-      self._reader = records.RecordsReader(
-          files.BufferedFile(self._filenames[0]))
+      self._file = files.BufferedFile(self._filenames[0])
+      self._reader = records.RecordsReader(self._file)
       self._reader.seek(position)
     else:
       self._reader = None
@@ -1548,22 +1580,30 @@ class RecordsReader(InputReader):
     """
     ctx = context.get()
 
-    while self._reader:
-      try:
-        start_time = time.time()
-        record = self._reader.read()
-        if ctx:
-          operation.counters.Increment(
-              COUNTER_IO_READ_MSEC, int((time.time() - start_time) * 1000))(ctx)
-          operation.counters.Increment(COUNTER_IO_READ_BYTES, len(record))(ctx)
-        yield record
-      except EOFError:
-        self._filenames.pop(0)
-        if not self._filenames:
-          self._reader = None
-        else:
-          self._reader = records.RecordsReader(
-              files.BufferedFile(self._filenames[0]))
+    try:
+      while self._reader:
+        try:
+          start_time = time.time()
+          record = self._reader.read()
+          if ctx:
+            operation.counters.Increment(
+                COUNTER_IO_READ_MSEC,
+                int((time.time() - start_time) * 1000))(ctx)
+            operation.counters.Increment(
+                COUNTER_IO_READ_BYTES, len(record))(ctx)
+          yield record
+        except EOFError:
+          self._filenames.pop(0)
+          if not self._filenames:
+            self._reader = None
+          else:
+            self._file = files.BufferedFile(self._filenames[0])
+            self._reader = records.RecordsReader(self._file)
+    finally:
+      # The slice is over, do not leave a read ahead in flight. The file is
+      # opened again if reading goes on.
+      if self._file is not None:
+        self._file.close()
 
   @classmethod
   def from_json(cls, json):
@@ -1646,12 +1686,119 @@ class RecordsReader(InputReader):
     return "%s:%s" % (self._filenames, position)
 
 
+# Marks the end of the input of a _prefetch() thread.
+_PREFETCH_END = object()
+
+# Interval in seconds at which a _prefetch() thread waiting for buffer space
+# checks whether it should stop.
+_PREFETCH_POLL_SEC = 0.5
+
+
+def _prefetch(iterable, buffer_size):
+  """Iterates over iterable while a background thread reads ahead.
+
+  Up to buffer_size items are read before they are consumed, so slow
+  iteration, e.g. one waiting on RPCs, overlaps with the consumer's work.
+  Exceptions raised by iterable are re-raised to the consumer. Once the
+  generator is closed, the thread stops and read ahead items are discarded.
+
+  Args:
+    iterable: the iterable to read from.
+    buffer_size: maximum number of items read ahead as int.
+
+  Yields:
+    the items of iterable.
+  """
+  items = Queue.Queue(buffer_size)
+  stopped = threading.Event()
+
+  def put(item):
+    while not stopped.is_set():
+      try:
+        items.put(item, timeout=_PREFETCH_POLL_SEC)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def read_ahead():
+    exc_info = None
+    try:
+      for item in iterable:
+        if not put((item, None)):
+          return
+    # pylint: disable-msg=W0702
+    except:
+      exc_info = sys.exc_info()
+    put((_PREFETCH_END, exc_info))
+
+  thread = threading.Thread(target=read_ahead)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      item, exc_info = items.get()
+      if item is _PREFETCH_END:
+        if exc_info:
+          raise exc_info[0], exc_info[1], exc_info[2]
+        return
+      yield item
+  finally:
+    stopped.set()
+
+
+# Record projection functions by tuple of field names, see _log_projection().
+_LOG_PROJECTIONS = {}
+
+
+def _log_projection(fields):
+  """Returns a function projecting a RequestLog onto the given fields.
+
+  The function returns a namedtuple of the field values, which holds no
+  per-instance dict and nothing but the requested values.
+
+  Args:
+    fields: tuple of RequestLog attribute names.
+
+  Returns:
+    a function of a RequestLog.
+  """
+  projection = _LOG_PROJECTIONS.get(fields)
+  if projection is None:
+    record_class = collections.namedtuple("LogRecord", fields)
+    getter = operator.attrgetter(*fields)
+    if len(fields) == 1:
+      projection = lambda log: record_class(getter(log))
+    else:
+      projection = lambda log: tuple.__new__(record_class, getter(log))
+    _LOG_PROJECTIONS[fields] = projection
+  return projection
+
+
 class LogInputReader(InputReader):
   """Input reader for a time range of logs via the Logs Reader API.
 
   The number of input shards may be specified by the SHARDS_PARAM mapper
   parameter.  A starting and ending time (in seconds since the Unix epoch) are
   required to generate time ranges over which to shard the input.
+
+  By default the time range is split into ranges of equal length. With the
+  SPLIT_MODE_PARAM mapper parameter set to SPLIT_MODE_DENSITY the density of
+  logs is sampled first, and the ranges are chosen to hold roughly the same
+  number of logs each.
+
+  Logs are read newest first, so a running reader can hand off the oldest
+  part of its remaining time range to new readers, see split_remaining().
+
+  With the PREFETCH_SIZE_PARAM mapper parameter set, up to that many logs
+  are fetched by a background thread while the mapper runs. The checkpointed
+  offset is always the one of the last log passed to the mapper, so logs
+  fetched ahead at the end of a slice are fetched again by the next one.
+
+  With the FIELDS_PARAM mapper parameter set to a list of RequestLog
+  attribute names, the mapper gets records holding only those attributes
+  instead of RequestLogs. Application logs are only fetched if "app_logs" is
+  one of the fields.
   """
   START_TIME_PARAM = "start_time"
   END_TIME_PARAM = "end_time"
@@ -1659,9 +1806,16 @@ class LogInputReader(InputReader):
   INCLUDE_INCOMPLETE_PARAM = "include_incomplete"
   INCLUDE_APP_LOGS_PARAM = "include_app_logs"
   VERSION_IDS_PARAM = "version_ids"
+  SPLIT_MODE_PARAM = "split_mode"
+  PREFETCH_SIZE_PARAM = "prefetch_size"
+  FIELDS_PARAM = "fields"
+
+  SPLIT_MODE_TIME = "time"
+  SPLIT_MODE_DENSITY = "density"
 
   _OFFSET_PARAM = "offset"
   _PROTOTYPE_REQUEST_PARAM = "prototype_request"
+  _POSITION_PARAM = "position"
 
   _PARAMS = frozenset([START_TIME_PARAM, END_TIME_PARAM, _OFFSET_PARAM,
                        MINIMUM_LOG_LEVEL_PARAM, INCLUDE_INCOMPLETE_PARAM,
@@ -1669,6 +1823,15 @@ class LogInputReader(InputReader):
                        _PROTOTYPE_REQUEST_PARAM])
   _KWARGS = frozenset([_OFFSET_PARAM, _PROTOTYPE_REQUEST_PARAM])
 
+  # Fields which are only set when application logs are fetched.
+  _APP_LOG_FIELDS = frozenset(["app_logs"])
+
+  # Number of logs read by a single density probe.
+  _PROBE_SIZE = 100
+
+  # Maximum number of intervals whose density is probed.
+  _MAX_PROBES = 32
+
   @datastore_rpc._positional(1)
   def __init__(self,
                start_time=None,
@@ -1696,6 +1859,12 @@ class LogInputReader(InputReader):
     """
     InputReader.__init__(self)
 
+    # end time of the last log read; older logs remain to be read
+    self.__position = kwargs.pop(self._POSITION_PARAM, None)
+    self.__prefetch_size = kwargs.pop(self.PREFETCH_SIZE_PARAM, None)
+    self.__fields = kwargs.pop(self.FIELDS_PARAM, None)
+    if self.__fields:
+      self.__fields = tuple(str(field) for field in self.__fields)
     self.__params = dict(kwargs)
 
     if start_time is not None:
@@ -1710,6 +1879,9 @@ class LogInputReader(InputReader):
       self.__params[self.INCLUDE_APP_LOGS_PARAM] = include_app_logs
     if version_ids:
       self.__params[self.VERSION_IDS_PARAM] = version_ids
+    if (self.__fields and
+        self._APP_LOG_FIELDS.isdisjoint(self.__fields)):
+      self.__params[self.INCLUDE_APP_LOGS_PARAM] = False
 
     if self._PROTOTYPE_REQUEST_PARAM in self.__params:
       prototype_request = log_service_pb.LogReadRequest(
@@ -1725,12 +1897,27 @@ class LogInputReader(InputReader):
     """Iterates over logs in a given range of time.
 
     Yields:
-      A RequestLog containing all the information for a single request.
+      A RequestLog containing all the information for a single request, or a
+      record of the requested fields of it.
     """
     logging.debug('for log in logservice.fetch(log.offset = %s)' % pprint.pformat(self.__params.get(self._OFFSET_PARAM, None)))
-    for log in logservice.fetch(**self.__params):
-      self.__params[self._OFFSET_PARAM] = log.offset
-      yield log
+    logs = logservice.fetch(**self.__params)
+    if self.__prefetch_size:
+      logs = _prefetch(logs, self.__prefetch_size)
+    project = None
+    if self.__fields:
+      project = _log_projection(self.__fields)
+    try:
+      for log in logs:
+        self.__params[self._OFFSET_PARAM] = log.offset
+        self.__position = log.end_time
+        if project:
+          yield project(log)
+        else:
+          yield log
+    finally:
+      if self.__prefetch_size:
+        logs.close()
 
   @classmethod
   def from_json(cls, json):
@@ -1743,11 +1930,20 @@ class LogInputReader(InputReader):
       An instance of the InputReader configured using the given JSON parameters.
     """
     params = cls.__kwargs(json)
+    position = params.get(cls._POSITION_PARAM)
+    prefetch_size = params.get(cls.PREFETCH_SIZE_PARAM)
+    fields = params.get(cls.FIELDS_PARAM)
 
     params = dict((k, v) for k, v in params.iteritems() if k in cls._PARAMS)
 
     if cls._OFFSET_PARAM in params:
       params[cls._OFFSET_PARAM] = base64.b64decode(params[cls._OFFSET_PARAM])
+    if position is not None:
+      params[cls._POSITION_PARAM] = position
+    if prefetch_size:
+      params[cls.PREFETCH_SIZE_PARAM] = prefetch_size
+    if fields:
+      params[cls.FIELDS_PARAM] = fields
     return cls(**params)
 
   def to_json(self):
@@ -1763,8 +1959,60 @@ class LogInputReader(InputReader):
       params[self._PROTOTYPE_REQUEST_PARAM] = prototype_request.Encode()
     if self._OFFSET_PARAM in params:
       params[self._OFFSET_PARAM] = base64.b64encode(params[self._OFFSET_PARAM])
+    if self.__position is not None:
+      params[self._POSITION_PARAM] = self.__position
+    if self.__prefetch_size:
+      params[self.PREFETCH_SIZE_PARAM] = self.__prefetch_size
+    if self.__fields:
+      params[self.FIELDS_PARAM] = list(self.__fields)
     return params
 
+  def progress(self):
+    """Returns the fraction of the time range already read.
+
+    Returns:
+      A float between 0 and 1.
+    """
+    start_time = self.__params[self.START_TIME_PARAM]
+    end_time = self.__params[self.END_TIME_PARAM]
+    if self.__position is None or end_time <= start_time:
+      return 0.0
+    read = float(end_time - max(start_time, self.__position))
+    return min(1.0, read / (end_time - start_time))
+
+  def split_remaining(self, fraction, count):
+    """Hands off the oldest part of the unread time range to new readers.
+
+    The time range still to be read is [start_time, position]. Its oldest
+    fraction is split into count ranges of equal length, and this reader
+    continues from its offset with start_time moved up to the cut.
+
+    Args:
+      fraction: fraction of the unread time range to hand off.
+      count: number of readers to split the handed off range into.
+
+    Returns:
+      A list of count LogInputReaders, empty if there is nothing to split.
+    """
+    start_time = self.__params[self.START_TIME_PARAM]
+    upper = self.__params[self.END_TIME_PARAM]
+    if self.__position is not None:
+      upper = min(upper, self.__position)
+    cut = start_time + (upper - start_time) * fraction
+    if count < 1 or cut <= start_time:
+      return []
+
+    params = self.to_json()
+    params.pop(self._OFFSET_PARAM, None)
+    params.pop(self._POSITION_PARAM, None)
+    readers = []
+    for lo, hi in self.split_time_range(start_time, cut, count):
+      params[self.START_TIME_PARAM] = lo
+      params[self.END_TIME_PARAM] = hi
+      readers.append(self.from_json(params))
+    self.__params[self.START_TIME_PARAM] = cut
+    return readers
+
   @classmethod
   def split_input(cls, mapper_spec):
     """Returns a list of input readers for the given input specification.
@@ -1777,23 +2025,137 @@ class LogInputReader(InputReader):
     """
     params = cls.__kwargs(mapper_spec.params)
     shard_count = mapper_spec.shard_count
+    split_mode = params.get(cls.SPLIT_MODE_PARAM, cls.SPLIT_MODE_TIME)
+    prefetch_size = params.get(cls.PREFETCH_SIZE_PARAM)
+    fields = params.get(cls.FIELDS_PARAM)
+    params = dict((k, v) for k, v in params.iteritems() if k in cls._PARAMS)
 
-    # Pick out the overall start and end times and time step per shard.
-    start_time = params[cls.START_TIME_PARAM]
-    end_time = params[cls.END_TIME_PARAM]
-    seconds_per_shard = (end_time - start_time) / shard_count
+    if split_mode == cls.SPLIT_MODE_DENSITY and shard_count > 1:
+      ranges = cls._split_time_range_by_density(params, shard_count)
+    else:
+      ranges = cls.split_time_range(params[cls.START_TIME_PARAM],
+                                    params[cls.END_TIME_PARAM], shard_count)
 
     # Create a LogInputReader for each shard, modulating the params as we go.
     shards = []
+    for start_time, end_time in ranges:
+      params[cls.START_TIME_PARAM] = start_time
+      params[cls.END_TIME_PARAM] = end_time
+      shards.append(LogInputReader(prefetch_size=prefetch_size, fields=fields,
+                                   **params))
+    return shards
+
+  @staticmethod
+  def split_time_range(start_time, end_time, shard_count):
+    """Splits a time range into consecutive ranges of equal length.
+
+    Args:
+      start_time: start of the time range in seconds since the Unix epoch.
+      end_time: end of the time range in seconds since the Unix epoch.
+      shard_count: number of ranges to split into as int.
+
+    Returns:
+      A list of shard_count (start_time, end_time) tuples in ascending order.
+    """
+    seconds_per_shard = (end_time - start_time) / shard_count
+
+    ranges = []
     for _ in xrange(shard_count - 1):
-      params[cls.END_TIME_PARAM] = (params[cls.START_TIME_PARAM] +
-                                    seconds_per_shard)
-      shards.append(LogInputReader(**params))
-      params[cls.START_TIME_PARAM] = params[cls.END_TIME_PARAM]
+      ranges.append((start_time, start_time + seconds_per_shard))
+      start_time += seconds_per_shard
+
+    # Create a final range that we're confident will complete the time range.
+    ranges.append((start_time, end_time))
+    return ranges
+
+  @classmethod
+  def _split_time_range_by_density(cls, params, shard_count):
+    """Splits a time range into ranges holding about equally many logs.
+
+    The time range is divided into up to _MAX_PROBES intervals of equal
+    length. The number of logs in each interval is estimated with a fetch
+    of at most _PROBE_SIZE logs from its end: the count is exact if fewer
+    logs are found, and extrapolated from the time they span otherwise.
+
+    Args:
+      params: mapper parameters, as passed to logservice.fetch().
+      shard_count: number of ranges to split into as int.
+
+    Returns:
+      A list of shard_count (start_time, end_time) tuples in ascending order.
+    """
+    start_time = params[cls.START_TIME_PARAM]
+    end_time = params[cls.END_TIME_PARAM]
+    probe_count = min(cls._MAX_PROBES, 4 * shard_count)
+    edges = [start_time + (end_time - start_time) * i / float(probe_count)
+             for i in xrange(probe_count + 1)]
+    edges[-1] = end_time
+
+    probe_params = dict(params)
+    probe_params.pop(cls._OFFSET_PARAM, None)
+    probe_params[cls.INCLUDE_APP_LOGS_PARAM] = False
+
+    weights = []
+    for lo, hi in zip(edges, edges[1:]):
+      probe_params[cls.START_TIME_PARAM] = lo
+      probe_params[cls.END_TIME_PARAM] = hi
+      count = 0
+      oldest = hi
+      try:
+        # logs are returned newest first
+        for log in logservice.fetch(batch_size=cls._PROBE_SIZE,
+                                    **probe_params):
+          count += 1
+          oldest = log.end_time
+          if count == cls._PROBE_SIZE:
+            break
+      except logservice.Error, e:
+        logging.warning("Density probe failed, splitting by time: %s", e)
+        return cls.split_time_range(start_time, end_time, shard_count)
+      if count == cls._PROBE_SIZE:
+        weights.append(count * (hi - lo) / max(hi - oldest, 0.001))
+      else:
+        weights.append(count)
+
+    logging.debug("Log density of %d intervals: %s", probe_count, weights)
+    return cls.split_weighted_range(edges, weights, shard_count)
+
+  @staticmethod
+  def split_weighted_range(edges, weights, shard_count):
+    """Splits a range into ranges of equal weight.
+
+    Weight is assumed to be spread evenly within each interval.
 
-    # Create a final shard that we're confident will complete the time range.
-    params[cls.END_TIME_PARAM] = end_time
-    return shards + [LogInputReader(**params)]
+    Args:
+      edges: ascending boundaries of consecutive intervals.
+      weights: weight of each interval, one less than edges.
+      shard_count: number of ranges to split into as int.
+
+    Returns:
+      A list of shard_count (start, end) tuples in ascending order. If the
+      total weight is zero the range is split into equal lengths.
+    """
+    total = float(sum(weights))
+    if total <= 0:
+      return LogInputReader.split_time_range(edges[0], edges[-1], shard_count)
+
+    points = [edges[0]]
+    interval = 0
+    before = 0.0
+    for shard in xrange(1, shard_count):
+      target = total * shard / shard_count
+      while (interval < len(weights) - 1 and
+             before + weights[interval] < target):
+        before += weights[interval]
+        interval += 1
+      lo, hi = edges[interval], edges[interval + 1]
+      if weights[interval] > 0:
+        fraction = min(1.0, (target - before) / weights[interval])
+      else:
+        fraction = 0.0
+      points.append(max(points[-1], lo + (hi - lo) * fraction))
+    points.append(edges[-1])
+    return zip(points, points[1:])
 
   @classmethod
   def validate(cls, mapper_spec):
@@ -1811,10 +2173,25 @@ class LogInputReader(InputReader):
       raise errors.BadReaderParamsError("Input reader class mismatch")
 
     params = cls.__kwargs(mapper_spec.params)
-    params_diff = set(params.keys()) - cls._PARAMS
-    if params_diff:
-      raise errors.BadReaderParamsError("Invalid mapper parameters: %s" %
-                                        ",".join(params_diff))
+    split_mode = params.get(cls.SPLIT_MODE_PARAM, cls.SPLIT_MODE_TIME)
+    if split_mode not in (cls.SPLIT_MODE_TIME, cls.SPLIT_MODE_DENSITY):
+      raise errors.BadReaderParamsError("Invalid split mode: %s" % split_mode)
+    prefetch_size = params.get(cls.PREFETCH_SIZE_PARAM, 0)
+    if not isinstance(prefetch_size, (int, long)) or prefetch_size < 0:
+      raise errors.BadReaderParamsError("Invalid prefetch size: %r" %
+                                        prefetch_size)
+    fields = params.get(cls.FIELDS_PARAM)
+    if fields is not None:
+      if (not isinstance(fields, (list, tuple)) or not fields or
+          [f for f in fields if not isinstance(f, basestring)]):
+        raise errors.BadReaderParamsError("Fields must be a non-empty list "
+                                          "of names: %r" % (fields,))
+      unknown = [f for f in fields if not hasattr(logservice.RequestLog, f)]
+      if unknown:
+        raise errors.BadReaderParamsError("Unknown log fields: %s" %
+                                          ",".join(unknown))
+    # other mapper parameters belong to the framework or to other readers
+    params = dict((k, v) for k, v in params.iteritems() if k in cls._PARAMS)
     if cls.VERSION_IDS_PARAM not in params:
       raise errors.BadReaderParamsError("Must specify a list of version ids "
                                         "for mapper input")
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""Tests for mapreduce.lib.files.crc32c."""
+
+import array
+import random
+import unittest
+
+from mapreduce.lib.files import crc32c
+
+
+def _implementations():
+  """(name, update function) of every implementation available here."""
+  result = [("table", crc32c._crc_update_table),
+            ("slice8", crc32c._crc_update_slice8)]
+  if crc32c._crc_update_crcmod is not None:
+    result.append(("crcmod", crc32c._crc_update_crcmod))
+  return result
+
+
+class Crc32cTest(unittest.TestCase):
+  """Tests CRC-32C implementations."""
+
+  def testRfc3720Vectors(self):
+    # rfc3720 section B.4
+    vectors = [("\x00" * 32, 0x8a9136aaL),
+               ("\xff" * 32, 0x62a8ab43L),
+               ("".join(chr(i) for i in range(32)), 0x46dd794eL),
+               ("".join(chr(i) for i in range(31, -1, -1)), 0x113fdb5cL)]
+    for data, expected in vectors:
+      self.assertEquals(expected, crc32c.crc(data))
+      for name, update in _implementations():
+        self.assertEquals(
+            expected, crc32c.crc_finalize(update(crc32c.CRC_INIT, data)),
+            name)
+
+  def testEmpty(self):
+    self.assertEquals(0, crc32c.crc(""))
+
+  def testImplementationsAgree(self):
+    rand = random.Random(0)
+    lengths = range(0, 40) + [255, 1000, 32 * 1024,
+                              3 * crc32c._CHUNK_SIZE + 5]
+    for length in lengths:
+      data = "".join(chr(rand.randint(0, 255)) for _ in xrange(min(length, 64)))
+      data = (data * (length // max(1, len(data)) + 1))[:length]
+      expected = crc32c._crc_update_table(crc32c.CRC_INIT, data)
+      for name, update in _implementations():
+        self.assertEquals(expected, update(crc32c.CRC_INIT, data),
+                          (name, length))
+
+  def testIncrementalUpdate(self):
+    data = "".join(chr(i % 251) for i in xrange(1000))
+    expected = crc32c.crc(data)
+    for name, update in _implementations():
+      for split in (0, 1, 7, 8, 9, 500, 999, 1000):
+        crc = update(update(crc32c.CRC_INIT, data[:split]), data[split:])
+        self.assertEquals(expected, crc32c.crc_finalize(crc), (name, split))
+
+  def testInputTypes(self):
+    data = "".join(chr(i % 256) for i in xrange(300))
+    expected = crc32c.crc(data)
+    for name, update in _implementations():
+      for value in (data, bytearray(data), array.array("B", data),
+                    [ord(c) for c in data]):
+        self.assertEquals(
+            expected, crc32c.crc_finalize(update(crc32c.CRC_INIT, value)),
+            (name, type(value)))
+    # records pass buffers of their blocks
+    self.assertEquals(crc32c.crc(data[10:20]),
+                      crc32c.crc_finalize(crc32c.crc_update(
+                          crc32c.CRC_INIT, buffer(data, 10, 10))))
+
+  def testResultIsLong(self):
+    for name, update in _implementations():
+      self.assertTrue(isinstance(update(crc32c.CRC_INIT, "abc"), long), name)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -54,7 +54,6 @@ __all__ = [
            ]
 
 import logging
-import gc
 import os
 
 from google.appengine.api import apiproxy_stub_map
@@ -227,8 +226,35 @@ def _make_call(method, request, response,
     Error or it's descendant if any File API specific error has happened.
   """
 
+  _wait_call(_start_call(method, request, response, deadline=deadline))
+
+
+def _start_call(method, request, response, deadline=30):
+  """Start File RPC call without waiting for it.
+
+  Args:
+    method: Service method name as string.
+    request: Request protocol buffer.
+    response: Response protocol buffer.
+    deadline: Request deadline in seconds.
+
+  Returns:
+    RPC object to pass to _wait_call().
+  """
   rpc = _create_rpc(deadline=deadline)
   rpc.make_call(method, request, response)
+  return rpc
+
+
+def _wait_call(rpc):
+  """Wait for File RPC call started by _start_call().
+
+  Args:
+    rpc: RPC object.
+
+  Raises:
+    Error or it's descendant if any File API specific error has happened.
+  """
   rpc.wait()
   try:
     rpc.check_success()
@@ -347,6 +373,23 @@ class _File(object):
     Returns:
       A string with data read.
     """
+    result = self._read_async(self._offset, size)()
+    self._offset += len(result)
+    return result
+
+  def _read_async(self, offset, size):
+    """Start reading data from RAW file without waiting for it.
+
+    Does not change the file's current position.
+
+    Args:
+      offset: file offset to read from as integer.
+      size: Number of bytes to read as integer, as in read().
+
+    Returns:
+      A function without arguments which waits for the read and returns the
+      data read as string.
+    """
     self._verify_read_mode()
     if self._content_type != RAW:
       raise UnsupportedContentTypeError(
@@ -355,11 +398,13 @@ class _File(object):
     request = file_service_pb.ReadRequest()
     response = file_service_pb.ReadResponse()
     request.set_filename(self._filename)
-    request.set_pos(self._offset)
+    request.set_pos(offset)
     request.set_max_bytes(size)
-    self._make_rpc_call_with_retry('Read', request, response)
-    result = response.data()
-    self._offset += len(result)
+    rpc = _start_call('Read', request, response)
+
+    def result():
+      self._make_rpc_call_with_retry('Read', request, response, rpc=rpc)
+      return response.data()
     return result
 
   def _verify_read_mode(self):
@@ -383,9 +428,12 @@ class _File(object):
 
     self._make_rpc_call_with_retry('Open', request, response)
 
-  def _make_rpc_call_with_retry(self, method, request, response):
+  def _make_rpc_call_with_retry(self, method, request, response, rpc=None):
     try:
-      _make_call(method, request, response)
+      if rpc is None:
+        _make_call(method, request, response)
+      else:
+        _wait_call(rpc)
     except (ApiTemporaryUnavailableError, FileTemporaryUnavailableError):
 
       if method == 'Open':
@@ -523,27 +571,91 @@ def _get_capabilities():
 
 
 class BufferedFile(object):
-  """BufferedFile is a file-like object reading underlying file in chunks."""
+  """BufferedFile is a file-like object reading underlying file in chunks.
+
+  The file is kept open between reads, and unless disabled the chunk
+  following the buffer is read asynchronously while the buffer is being
+  consumed. The file is closed when its end is reached or by close(), which
+  callers have to call if they stop reading earlier, e.g. by using the file in
+  a with statement.
+  """
 
   _BUFFER_SIZE = 512 * 1024
 
-  def __init__(self, filename, buffer_size=_BUFFER_SIZE):
+  def __init__(self, filename, buffer_size=_BUFFER_SIZE, read_ahead=True):
     """Constructor.
 
     Args:
       filename: the name of the file to read as string.
       buffer_size: buffer read size to use as int.
+      read_ahead: whether to read the next chunk while the buffer is being
+        consumed. Readers which only read a few records should disable it.
     """
     self._filename = filename
     self._position = 0
     self._buffer = ''
     self._buffer_pos = 0
     self._buffer_size = buffer_size
+    self._file = None
+    self._read_ahead_enabled = read_ahead
+    # (offset, result function) of the chunk being read ahead, if any.
+    self._read_ahead = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, atype, value, traceback):
+    self.close()
+
+  def close(self):
+    """Close the underlying file. It is opened again if reading goes on."""
+    self._discard_read_ahead()
+    if self._file is not None:
+      self._file.close()
+      self._file = None
 
   def tell(self):
     """Return file's current position."""
     return self._position
 
+  def _discard_read_ahead(self):
+    """Wait for the chunk being read ahead, if any, and drop it."""
+    if self._read_ahead is None:
+      return
+    result = self._read_ahead[1]
+    self._read_ahead = None
+    try:
+      result()
+    except Error:
+      # the chunk is not used, so failing to read it does not matter
+      pass
+
+  def _fetch(self, offset):
+    """Get the chunk at offset and start reading the chunk after it.
+
+    Args:
+      offset: file offset of the chunk as integer.
+
+    Returns:
+      A string with the chunk data, empty at the end of file.
+    """
+    if self._read_ahead and self._read_ahead[0] == offset:
+      data = self._read_ahead[1]()
+    else:
+      self._discard_read_ahead()
+      if self._file is None:
+        self._file = open(self._filename, 'r')
+      data = self._file._read_async(offset, self._buffer_size)()
+    self._read_ahead = None
+
+    if not data:
+      self.close()
+    elif self._read_ahead_enabled:
+      offset += len(data)
+      self._read_ahead = (
+          offset, self._file._read_async(offset, self._buffer_size))
+    return data
+
   def read(self, size):
     """Read data from RAW file.
 
@@ -554,44 +666,51 @@ class BufferedFile(object):
     Returns:
       A string with data read.
     """
-    while len(self._buffer) - self._buffer_pos < size:
-      self._buffer = self._buffer[self._buffer_pos:]
-      self._buffer_pos = 0
-      with open(self._filename, 'r') as f:
-        f.seek(self._position + len(self._buffer))
-        data = f.read(self._buffer_size)
+    end = self._buffer_pos + size
+    if end <= len(self._buffer):
+      result = self._buffer[self._buffer_pos:end]
+      self._buffer_pos = end
+    else:
+      parts = [self._buffer[self._buffer_pos:]]
+      self._buffer_pos = len(self._buffer)
+      needed = size - len(parts[0])
+      offset = self._position + len(parts[0])
+      while needed > 0:
+        data = self._fetch(offset)
         if not data:
           break
-        self._buffer += data
-      gc.collect()
-
-    if len(self._buffer) - self._buffer_pos < size:
-      result = self._buffer[self._buffer_pos:]
-      self._buffer = ''
-      self._buffer_pos = 0
-      self._position += len(result)
-      return result
-    else:
-      result = self._buffer[self._buffer_pos:self._buffer_pos + size]
-      self._buffer_pos += size
-      self._position += size
-      return result
+        offset += len(data)
+        self._buffer = data
+        self._buffer_pos = min(needed, len(data))
+        parts.append(data[:self._buffer_pos])
+        needed -= self._buffer_pos
+      result = ''.join(parts)
+    self._position += len(result)
+    return result
 
   def seek(self, offset, whence=os.SEEK_SET):
     """Set the file's current position.
 
+    Seeking within the current buffer keeps it. Seeking elsewhere waits for
+    the chunk being read ahead and drops it, unless reading goes on where the
+    chunk starts.
+
     Args:
       offset: seek offset as number.
       whence: seek mode. Supported modes are os.SEEK_SET (absolute seek),
         and os.SEEK_CUR (seek relative to the current position).
     """
-    if whence == os.SEEK_SET:
-      self._position = offset
-      self._buffer = ''
-      self._buffer_pos = 0
-    elif whence == os.SEEK_CUR:
-      self._position += offset
+    if whence == os.SEEK_CUR:
+      offset += self._position
+    elif whence != os.SEEK_SET:
+      raise InvalidArgumentError('Whence mode %d is not supported', whence)
+
+    buffer_start = self._position - self._buffer_pos
+    if buffer_start <= offset <= buffer_start + len(self._buffer):
+      self._buffer_pos = offset - buffer_start
+    else:
       self._buffer = ''
       self._buffer_pos = 0
-    else:
-      raise InvalidArgumentError('Whence mode %d is not supported', whence)
+      if self._read_ahead and self._read_ahead[0] != offset:
+        self._discard_read_ahead()
+    self._position = offset
@@ -81,6 +81,7 @@ C will be stored as a FULL record in the fourth block.
 """
 
 
+import os
 import struct
 
 import google
@@ -97,6 +98,14 @@ HEADER_FORMAT = '<IHB'
 HEADER_LENGTH = struct.calcsize(HEADER_FORMAT)
 
 
+_PADDING = '\x00' * BLOCK_SIZE
+
+
+# CRC of every possible record type byte, which starts the CRC of a record.
+_RECORD_TYPE_CRCS = [crc32c.crc_update(crc32c.CRC_INIT, [record_type])
+                     for record_type in range(256)]
+
+
 RECORD_TYPE_NONE = 0
 
 
@@ -127,7 +136,9 @@ class FileWriter(object):
     """Write data to the file.
 
     Args:
-      data: byte array, string or iterable over bytes.
+      data: byte array, string or iterable over bytes. RecordsWriter passes
+        buffers over memory it reuses, so data has to be consumed or copied
+        before write() returns.
     """
     raise NotImplementedError()
 
@@ -196,6 +207,9 @@ class RecordsWriter(object):
       writer.write("record")
 
   RecordsWriter will pad last block with 0 when exiting with statement scope.
+
+  Blocks are passed to the writer as buffers over a block buffer which is
+  reused for the next block, see FileWriter.write().
   """
 
   def __init__(self, writer, _pad_last_block=True):
@@ -208,19 +222,35 @@ class RecordsWriter(object):
     self.__position = 0
     self.__entered = False
     self.__pad_last_block = _pad_last_block
+    # Records are assembled in place in this buffer, which is reused once a
+    # block is complete.
+    self.__block = bytearray(BLOCK_SIZE)
+
+  def __advance(self, length):
+    """Move past length bytes of the block, writing it out when complete."""
+    self.__position += length
+    if self.__position % BLOCK_SIZE == 0:
+      self.__writer.write(buffer(self.__block))
+
+  def __pad(self, length):
+    """Fill the next length bytes of the block with zeros."""
+    offset = self.__position % BLOCK_SIZE
+    self.__block[offset:offset + length] = buffer(_PADDING, 0, length)
+    self.__advance(length)
 
   def __write_record(self, record_type, data):
     """Write single physical record."""
     length = len(data)
 
-    crc = crc32c.crc_update(crc32c.CRC_INIT, [record_type])
-    crc = crc32c.crc_update(crc, data)
+    crc = crc32c.crc_update(_RECORD_TYPE_CRCS[record_type], data)
     crc = crc32c.crc_finalize(crc)
 
-    self.__writer.write(
-        struct.pack(HEADER_FORMAT, _mask_crc(crc), length, record_type))
-    self.__writer.write(data)
-    self.__position += HEADER_LENGTH + length
+    offset = self.__position % BLOCK_SIZE
+    struct.pack_into(HEADER_FORMAT, self.__block, offset,
+                     _mask_crc(crc), length, record_type)
+    offset += HEADER_LENGTH
+    self.__block[offset:offset + length] = data
+    self.__advance(HEADER_LENGTH + length)
 
   def write(self, data):
     """Write single record.
@@ -230,28 +260,30 @@ class RecordsWriter(object):
     """
     if not self.__entered:
       raise Exception("RecordWriter should be used only with 'with' statement.")
+    if not isinstance(data, (str, bytearray)):
+      data = bytearray(data)
     block_remaining = BLOCK_SIZE - self.__position % BLOCK_SIZE
 
     if block_remaining < HEADER_LENGTH:
 
-      self.__writer.write('\x00' * block_remaining)
-      self.__position += block_remaining
+      self.__pad(block_remaining)
       block_remaining = BLOCK_SIZE
 
-    if block_remaining < len(data) + HEADER_LENGTH:
-      first_chunk = data[:block_remaining - HEADER_LENGTH]
-      self.__write_record(RECORD_TYPE_FIRST, first_chunk)
-      data = data[len(first_chunk):]
+    length = len(data)
+    if block_remaining < length + HEADER_LENGTH:
+      start = block_remaining - HEADER_LENGTH
+      self.__write_record(RECORD_TYPE_FIRST, buffer(data, 0, start))
 
       while True:
         block_remaining = BLOCK_SIZE - self.__position % BLOCK_SIZE
-        if block_remaining >= len(data) + HEADER_LENGTH:
-          self.__write_record(RECORD_TYPE_LAST, data)
+        if block_remaining >= length - start + HEADER_LENGTH:
+          self.__write_record(RECORD_TYPE_LAST, buffer(data, start))
           break
         else:
-          chunk = data[:block_remaining - HEADER_LENGTH]
-          self.__write_record(RECORD_TYPE_MIDDLE, chunk)
-          data = data[len(chunk):]
+          chunk_length = block_remaining - HEADER_LENGTH
+          self.__write_record(RECORD_TYPE_MIDDLE,
+                              buffer(data, start, chunk_length))
+          start += chunk_length
     else:
       self.__write_record(RECORD_TYPE_FULL, data)
 
@@ -263,17 +295,33 @@ class RecordsWriter(object):
     self.close()
 
   def close(self):
+    pending = self.__position % BLOCK_SIZE
+    if not pending:
+      return
     if self.__pad_last_block:
-      pad_length = BLOCK_SIZE - self.__position % BLOCK_SIZE
-      if pad_length and pad_length != BLOCK_SIZE:
-        self.__writer.write('\x00' * pad_length)
+      self.__pad(BLOCK_SIZE - pending)
+    else:
+      self.__writer.write(buffer(self.__block, 0, pending))
 
 
 class RecordsReader(object):
-  """A reader for records format."""
+  """A reader for records format.
+
+  The reader reads the rest of the current block from the underlying reader
+  at once and parses records out of it, so the underlying reader is ahead of
+  tell() while a block is being parsed.
+  """
 
   def __init__(self, reader):
     self.__reader = reader
+    # Data read up to the end of the current block, its offset within the
+    # block and the offset of the first byte in it which was not parsed yet.
+    self.__block = ''
+    self.__block_start = 0
+    self.__offset = 0
+    # A seek may land in the middle of a record, so its MIDDLE and LAST
+    # fragments are skipped until the first record following the seek starts.
+    self.__skip_fragments = False
 
   def __try_read_record(self):
     """Try reading a record.
@@ -284,68 +332,92 @@ class RecordsReader(object):
       EOFError: when end of file was reached.
       InvalidRecordError: when valid record could not be read.
     """
-    block_remaining = BLOCK_SIZE - self.__reader.tell() % BLOCK_SIZE
+    if self.__offset == len(self.__block):
+      position = self.__reader.tell()
+      self.__block_start = position % BLOCK_SIZE
+      self.__block = self.__reader.read(BLOCK_SIZE - self.__block_start)
+      self.__offset = 0
+      if not self.__block:
+        raise EOFError('Read 0 bytes instead of %s' % HEADER_LENGTH)
+
+    block_remaining = BLOCK_SIZE - self.__block_start - self.__offset
     if block_remaining < HEADER_LENGTH:
       return ('', RECORD_TYPE_NONE)
 
-    header = self.__reader.read(HEADER_LENGTH)
-    if len(header) != HEADER_LENGTH:
+    available = len(self.__block) - self.__offset
+    if available < HEADER_LENGTH:
+      self.__offset = len(self.__block)
       raise EOFError('Read %s bytes instead of %s' %
-                     (len(header), HEADER_LENGTH))
+                     (available, HEADER_LENGTH))
 
-    (masked_crc, length, record_type) = struct.unpack(HEADER_FORMAT, header)
+    (masked_crc, length, record_type) = struct.unpack_from(
+        HEADER_FORMAT, self.__block, self.__offset)
     crc = _unmask_crc(masked_crc)
+    self.__offset += HEADER_LENGTH
 
     if length + HEADER_LENGTH > block_remaining:
 
       raise InvalidRecordError('Length is too big')
 
-    data = self.__reader.read(length)
-    if len(data) != length:
+    start = self.__offset
+    available -= HEADER_LENGTH
+    if available < length:
+      self.__offset = len(self.__block)
       raise EOFError('Not enough data read. Expected: %s but got %s' %
-                     (length, len(data)))
+                     (length, available))
+    self.__offset += length
 
     if record_type == RECORD_TYPE_NONE:
       return ('', record_type)
 
-    actual_crc = crc32c.crc_update(crc32c.CRC_INIT, [record_type])
-    actual_crc = crc32c.crc_update(actual_crc, data)
+    actual_crc = crc32c.crc_update(_RECORD_TYPE_CRCS[record_type],
+                                   buffer(self.__block, start, length))
     actual_crc = crc32c.crc_finalize(actual_crc)
 
     if actual_crc != crc:
       raise InvalidRecordError('Data crc does not match')
-    return (data, record_type)
+    return (self.__block[start:start + length], record_type)
 
   def __sync(self):
     """Skip reader to the block boundary."""
-    pad_length = BLOCK_SIZE - self.__reader.tell() % BLOCK_SIZE
+    pad_length = BLOCK_SIZE - self.tell() % BLOCK_SIZE
     if pad_length and pad_length != BLOCK_SIZE:
-      self.__reader.read(pad_length)
+      skipped = min(pad_length, len(self.__block) - self.__offset)
+      self.__offset += skipped
+      if skipped < pad_length:
+        self.__reader.read(pad_length - skipped)
 
   def read(self):
     """Reads record from current position in reader."""
-    data = None
+    chunks = None
     while True:
       try:
         (chunk, record_type) = self.__try_read_record()
         if record_type == RECORD_TYPE_NONE:
           self.__sync()
         elif record_type == RECORD_TYPE_FULL:
+          self.__skip_fragments = False
           return chunk
         elif record_type == RECORD_TYPE_FIRST:
-          if data is not None:
+          if chunks is not None:
             raise InvalidRecordError()
-          data = chunk
+          self.__skip_fragments = False
+          chunks = [chunk]
         elif record_type == RECORD_TYPE_MIDDLE:
-          if data is None:
-            raise InvalidRecordError()
-          data += chunk
+          if chunks is None:
+            if not self.__skip_fragments:
+              raise InvalidRecordError()
+          else:
+            chunks.append(chunk)
         elif record_type == RECORD_TYPE_LAST:
-          if data is None:
-            raise InvalidRecordError()
-          result = data + chunk
-          data = None
-          return result
+          if chunks is None:
+            if not self.__skip_fragments:
+              raise InvalidRecordError()
+          else:
+            chunks.append(chunk)
+            result = ''.join(chunks)
+            chunks = None
+            return result
         else:
           raise InvalidRecordError('Unsupported record type: %s' %
                                    (record_type))
@@ -361,11 +433,18 @@ class RecordsReader(object):
 
   def tell(self):
     """Return file's current position."""
-    return self.__reader.tell()
+    return self.__reader.tell() - (len(self.__block) - self.__offset)
 
-  def seek(self, *args, **kwargs):
+  def seek(self, offset, whence=os.SEEK_SET):
     """Set the file's current position.
 
-    Arguments are passed directly to the underlying reader.
+    Arguments are passed to the underlying reader, offsets relative to the
+    current position are made absolute first.
     """
-    return self.__reader.seek(*args, **kwargs)
+    if whence == os.SEEK_CUR:
+      offset += self.tell()
+      whence = os.SEEK_SET
+    self.__block = ''
+    self.__offset = 0
+    self.__skip_fragments = True
+    return self.__reader.seek(offset, whence)
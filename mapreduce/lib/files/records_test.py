@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""Tests for mapreduce.lib.files.records."""
+
+import hashlib
+import os
+import struct
+import unittest
+
+from mapreduce.lib.files import crc32c
+from mapreduce.lib.files import records
+
+
+# Lengths of the test records, chosen to end records exactly at, just
+# before and just after block boundaries and to span several blocks.
+_LENGTHS = [0, 1, 100,
+            records.BLOCK_SIZE - 2 * records.HEADER_LENGTH - 101,
+            3, 0,
+            records.BLOCK_SIZE - records.HEADER_LENGTH - 5,
+            records.BLOCK_SIZE,
+            3 * records.BLOCK_SIZE + 5,
+            1000, 70000, 17,
+            records.BLOCK_SIZE - 2 * records.HEADER_LENGTH]
+
+# MD5 digests of the test records as written by the byte-at-a-time writer
+# which preceded the in-place block writer, with and without padding the
+# last block.
+_PADDED_MD5 = "8de3715d2d87779fe1b424ab6f785698"
+_UNPADDED_MD5 = "ae498b3afdab08fcf437419c94861a50"
+
+
+def _test_records():
+  return [("%05d" % i * (length // 5 + 1))[:length]
+          for i, length in enumerate(_LENGTHS)]
+
+
+class StringWriter(object):
+  """FileWriter collecting data in memory."""
+
+  def __init__(self):
+    self.parts = []
+
+  def write(self, data):
+    # data is only valid until write() returns
+    self.parts.append(str(data))
+
+  def getvalue(self):
+    return "".join(self.parts)
+
+
+class StringReader(object):
+  """FileReader over a string."""
+
+  def __init__(self, data):
+    self.data = data
+    self.position = 0
+
+  def read(self, size):
+    result = self.data[self.position:self.position + size]
+    self.position += len(result)
+    return result
+
+  def tell(self):
+    return self.position
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence != os.SEEK_SET:
+      raise ValueError("Unsupported whence %s" % whence)
+    self.position = offset
+
+
+def _write(data_list, pad_last_block=True):
+  writer = StringWriter()
+  with records.RecordsWriter(writer, _pad_last_block=pad_last_block) as w:
+    for data in data_list:
+      w.write(data)
+  return writer
+
+
+def _read_all(data):
+  return list(records.RecordsReader(StringReader(data)))
+
+
+def _header(record_type, data):
+  crc = crc32c.crc_finalize(crc32c.crc_update(
+      crc32c.crc_update(crc32c.CRC_INIT, [record_type]), data))
+  return struct.pack(records.HEADER_FORMAT, records._mask_crc(crc),
+                     len(data), record_type)
+
+
+class RecordsWriterTest(unittest.TestCase):
+  """Tests RecordsWriter."""
+
+  def testSingleRecord(self):
+    data = _write(["abc"]).getvalue()
+    expected = _header(records.RECORD_TYPE_FULL, "abc") + "abc"
+    self.assertEquals(records.BLOCK_SIZE, len(data))
+    self.assertEquals(expected, data[:len(expected)])
+    self.assertEquals("\x00" * (records.BLOCK_SIZE - len(expected)),
+                      data[len(expected):])
+
+  def testUnpadded(self):
+    data = _write(["abc"], pad_last_block=False).getvalue()
+    self.assertEquals(_header(records.RECORD_TYPE_FULL, "abc") + "abc", data)
+
+  def testFragments(self):
+    first_length = records.BLOCK_SIZE - records.HEADER_LENGTH
+    record = "x" * first_length + "y" * 10
+    data = _write([record], pad_last_block=False).getvalue()
+    self.assertEquals(
+        _header(records.RECORD_TYPE_FIRST, "x" * first_length) +
+        "x" * first_length +
+        _header(records.RECORD_TYPE_LAST, "y" * 10) + "y" * 10,
+        data)
+
+  def testTrailer(self):
+    # leaves fewer than HEADER_LENGTH bytes in the first block
+    first = "a" * (records.BLOCK_SIZE - records.HEADER_LENGTH - 3)
+    data = _write([first, "b"], pad_last_block=False).getvalue()
+    offset = records.HEADER_LENGTH + len(first)
+    self.assertEquals("\x00" * 3, data[offset:records.BLOCK_SIZE])
+    self.assertEquals(_header(records.RECORD_TYPE_FULL, "b") + "b",
+                      data[records.BLOCK_SIZE:])
+
+  def testMatchesBaselineEncoding(self):
+    self.assertEquals(
+        _PADDED_MD5, hashlib.md5(_write(_test_records()).getvalue()).hexdigest())
+    self.assertEquals(
+        _UNPADDED_MD5,
+        hashlib.md5(_write(_test_records(), False).getvalue()).hexdigest())
+
+  def testInputTypes(self):
+    expected = _write(["abc", "de"]).getvalue()
+    self.assertEquals(expected,
+                      _write([bytearray("abc"), [100, 101]]).getvalue())
+
+  def testPassesBlockBuffers(self):
+    received = []
+
+    class BufferWriter(object):
+
+      def write(self, data):
+        received.append((type(data), len(data)))
+
+    with records.RecordsWriter(BufferWriter()) as w:
+      for data in _test_records():
+        w.write(data)
+    self.assertTrue(received)
+    for data_type, length in received:
+      self.assertEquals(buffer, data_type)
+      self.assertEquals(records.BLOCK_SIZE, length)
+
+  def testRequiresWith(self):
+    writer = records.RecordsWriter(StringWriter())
+    self.assertRaises(Exception, writer.write, "abc")
+
+
+class RecordsReaderTest(unittest.TestCase):
+  """Tests RecordsReader."""
+
+  def testRoundTrip(self):
+    data_list = _test_records()
+    for pad in (True, False):
+      self.assertEquals(data_list, _read_all(_write(data_list, pad).getvalue()))
+
+  def testEmpty(self):
+    self.assertEquals([], _read_all(""))
+    self.assertRaises(EOFError,
+                      records.RecordsReader(StringReader("")).read)
+
+  def testTellAndSeek(self):
+    data_list = _test_records()
+    data = _write(data_list).getvalue()
+    reader = records.RecordsReader(StringReader(data))
+    positions = []
+    for _ in data_list:
+      positions.append(reader.tell())
+      reader.read()
+    for i, position in enumerate(positions):
+      reader = records.RecordsReader(StringReader(data))
+      reader.seek(position)
+      self.assertEquals(data_list[i:], list(reader))
+
+  def testSeekCurrent(self):
+    data = _write(["abc", "def"]).getvalue()
+    reader = records.RecordsReader(StringReader(data))
+    reader.read()
+    reader.seek(0, os.SEEK_CUR)
+    self.assertEquals("def", reader.read())
+
+  def testSeekToBlock(self):
+    data_list = _test_records() + ["%05d" % i * 20 for i in xrange(1000)]
+    data = _write(data_list).getvalue()
+    reader = records.RecordsReader(StringReader(data))
+    starts = []
+    for _ in data_list:
+      reader.read()
+      # the record ends where the next one may start
+      starts.append(reader.tell())
+    starts = [0] + starts[:-1]
+    for block in xrange(len(data) // records.BLOCK_SIZE):
+      offset = block * records.BLOCK_SIZE
+      reader = records.RecordsReader(StringReader(data))
+      reader.seek(offset)
+      # fragments of records started before the block are skipped, a
+      # record starting in the trailer of the block before starts at it
+      expected = [record for record, start in zip(data_list, starts)
+                  if start > offset - records.HEADER_LENGTH]
+      self.assertEquals(expected, list(reader))
+
+  def testCorruptRecordSkipsBlock(self):
+    first = "a" * 100
+    # fills the rest of the first block
+    second = "b" * (records.BLOCK_SIZE - 2 * records.HEADER_LENGTH - 100)
+    data = bytearray(_write([first, second, "c"]).getvalue())
+    data[records.HEADER_LENGTH + 5] = "x"
+    # the corrupt record and the rest of its block are skipped
+    self.assertEquals(["c"], _read_all(str(data)))
+
+  def testOrphanFragmentSkipsBlock(self):
+    # the first record ends with a LAST fragment at the start of the second
+    # block, the filler fills the rest of it
+    first = "a" * records.BLOCK_SIZE
+    filler = "f" * (records.BLOCK_SIZE - 4 * records.HEADER_LENGTH - 1)
+    data = bytearray(_write([first, "b", filler, "d"]).getvalue())
+    data[records.HEADER_LENGTH + 5] = "x"
+    # without a seek, the orphan LAST fragment is invalid like a corrupt
+    # record, and the rest of its block is skipped
+    self.assertEquals(["d"], _read_all(str(data)))
+    # after a seek to the second block it is skipped on its own
+    reader = records.RecordsReader(StringReader(str(data)))
+    reader.seek(records.BLOCK_SIZE)
+    self.assertEquals(["b", filler, "d"], list(reader))
+
+  def testTruncated(self):
+    data = _write(["abc", "d" * 1000], pad_last_block=False).getvalue()
+    for end in (len(data) - 1, len(data) - 998, 10 + records.HEADER_LENGTH):
+      self.assertEquals(["abc"], _read_all(data[:end]))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -20,17 +20,25 @@ from __future__ import with_statement
 
 
 
+import base64
+import heapq
+import itertools
+import logging
 
 
 from mapreduce.lib import pipeline
 from mapreduce.lib.pipeline import common as pipeline_common
 from mapreduce.lib import files
 from mapreduce.lib.files import file_service_pb
+from mapreduce.lib.files import records
 from mapreduce import output_writers
 from mapreduce import base_handler
+from mapreduce import context
 from mapreduce import input_readers
 from mapreduce import mapper_pipeline
 from mapreduce import shuffler
+from mapreduce import util
+from mapreduce import value_codec
 
 
 # Mapper pipeline is extracted only to remove dependency cycle with shuffler.py
@@ -42,7 +50,11 @@ ShufflePipeline = shuffler.ShufflePipeline
 
 class KeyValueBlobstoreOutputWriter(
     output_writers.BlobstoreRecordsOutputWriter):
-  """Output writer for KeyValue records files in blobstore."""
+  """Output writer for KeyValue records files in blobstore.
+
+  Values are encoded with value_codec, so typed values like
+  value_codec.IntVector are stored packed instead of as strings.
+  """
 
   def write(self, data, ctx):
     if len(data) != 2:
@@ -51,7 +63,7 @@ class KeyValueBlobstoreOutputWriter(
 
     try:
       key = str(data[0])
-      value = str(data[1])
+      value = value_codec.encode(data[1])
     except TypeError:
       logging.error("Expecting a tuple, but got %s: %s",
                     data.__class__.__name__, data)
@@ -74,6 +86,10 @@ class MapPipeline(base_handler.PipelineBase):
     input_reader_spec: input reader specification as string.
     params: mapper and input reader parameters as dict.
     shards: number of shards to start as int.
+    combiner_spec: optional specification of a combiner function as string.
+      It is called as combiner(key, values) on the values yielded by the
+      mapper for a key and yields combined values, see
+      context.CombinerPool.
 
   Returns:
     list of filenames list sharded by hash code.
@@ -84,7 +100,11 @@ class MapPipeline(base_handler.PipelineBase):
           mapper_spec,
           input_reader_spec,
           params,
-          shards=None):
+          shards=None,
+          combiner_spec=None):
+    if combiner_spec:
+      params = dict(params or {})
+      params["combiner_spec"] = combiner_spec
     yield MapperPipeline(
         job_name + "-map",
         mapper_spec,
@@ -95,15 +115,160 @@ class MapPipeline(base_handler.PipelineBase):
 
 
 class KeyValuesReader(input_readers.RecordsReader):
-  """Reader to read KeyValues records files from Files API."""
+  """Reader to read KeyValues records files from Files API.
+
+  Values are decoded with value_codec.decode().
+  """
 
   expand_parameters = True
 
   def __iter__(self):
+    decode = value_codec.decode
     for binary_record in input_readers.RecordsReader.__iter__(self):
       proto = file_service_pb.KeyValues()
       proto.ParseFromString(binary_record)
-      yield (proto.key(), proto.value_list())
+      yield (proto.key(), [decode(v) for v in proto.value_list()])
+
+
+class StreamingKeyValuesReader(shuffler._MergingReader):
+  """Reader merging sorted KeyValue files and streaming the values of keys.
+
+  Reads the sorted runs of a shuffle without merge, one list of files per
+  shard, and yields (key, values) like KeyValuesReader. Values are decoded
+  with value_codec.decode().
+
+  Without a combiner, values is an iterator drawing from the merge of the
+  files, so reducers which sum or count run in constant memory however many
+  values a key has. If the reducer does not exhaust it, the remaining values
+  of the key are skipped, also in a following slice.
+
+  With the "combiner_spec" parameter, values of a key are read in chunks of
+  CHUNK_VALUES. While more values follow, each chunk is folded with the
+  combiner and a checkpoint is allowed, so a slice can end in the middle of
+  a key with the combined values in the reader state. The reducer gets a
+  list of the combined values and the last chunk.
+  """
+
+  expand_parameters = True
+
+  _SPLIT_BY_KEY_RANGE = False
+
+  COMBINER_PARAM = "combiner_spec"
+
+  # Number of values of a key read before combining them.
+  CHUNK_VALUES = 1000
+
+  def __init__(self, offsets, key=None, partial=None):
+    """Constructor.
+
+    Args:
+      offsets: offsets for each input file to start from as list of ints.
+      key: key whose values were partly read, or None.
+      partial: None if the reducer was called for key, and its remaining
+        values are to be skipped. Otherwise the list of combined values of
+        key read so far.
+    """
+    shuffler._MergingReader.__init__(self, offsets)
+    self._key = key
+    self._partial = partial
+
+  def __iter__(self):
+    """Iterate over keys and their values in input files.
+
+    self._offsets, self._key and self._partial are always updated so that
+    stopping iterations doesn't skip values and doesn't read the same value
+    twice.
+    """
+    ctx = context.get()
+    mapper_spec = ctx.mapreduce_spec.mapper
+    shard_number = ctx.shard_state.shard_number
+    filenames = mapper_spec.params[self.FILES_PARAM][shard_number]
+    combiner_spec = mapper_spec.params.get(self.COMBINER_PARAM)
+    combiner = None
+    if combiner_spec:
+      combiner = util.for_name(combiner_spec)
+
+    if len(filenames) != len(self._offsets):
+      raise Exception("Files list and offsets do not match.")
+
+    buffered_files = []
+    try:
+      # Heap with (key, index, record, end offset, reader) tuples.
+      heap = []
+      for (i, filename) in enumerate(filenames):
+        buffered_file = files.BufferedFile(filename)
+        buffered_files.append(buffered_file)
+        reader = records.RecordsReader(buffered_file)
+        reader.seek(self._offsets[i])
+        shuffler._MergingRecordsReader._push(heap, i, reader)
+
+      decode = value_codec.decode
+      record_key_value = shuffler._record_key_value
+
+      def values(key):
+        while heap and heap[0][0] == key:
+          (_, index, record, end, reader) = heap[0]
+          self._offsets[index] = end
+          heapq.heappop(heap)
+          shuffler._MergingRecordsReader._push(heap, index, reader)
+          yield decode(record_key_value(record)[1])
+
+      if self._key is not None and self._partial is None:
+        # The reducer has seen this key already.
+        for _ in values(self._key):
+          pass
+        self._key = None
+
+      while heap or self._key is not None:
+        key = self._key
+        if key is None:
+          key = heap[0][0]
+
+        if not combiner:
+          self._key = key
+          key_values = values(key)
+          yield (key, key_values)
+          for _ in key_values:
+            pass
+          self._key = None
+          continue
+
+        chunk = list(itertools.islice(values(key), self.CHUNK_VALUES))
+        if heap and heap[0][0] == key:
+          self._partial = list(combiner(key, (self._partial or []) + chunk))
+          self._key = key
+          yield input_readers.ALLOW_CHECKPOINT
+          continue
+
+        key_values = (self._partial or []) + chunk
+        self._key = key
+        self._partial = None
+        yield (key, key_values)
+        self._key = None
+    finally:
+      for buffered_file in buffered_files:
+        buffered_file.close()
+
+  @classmethod
+  def from_json(cls, json):
+    """Restore reader from json state."""
+    key = json.get("key")
+    if key is not None:
+      key = base64.b64decode(key)
+    partial = json.get("partial")
+    if partial is not None:
+      partial = [value_codec.decode(base64.b64decode(v)) for v in partial]
+    return cls(json["offsets"], key, partial)
+
+  def to_json(self):
+    """Serialize reader state to json."""
+    json = {"offsets": self._offsets}
+    if self._key is not None:
+      json["key"] = base64.b64encode(self._key)
+    if self._partial is not None:
+      json["partial"] = [base64.b64encode(value_codec.encode(v))
+                         for v in self._partial]
+    return json
 
 
 class ReducePipeline(base_handler.PipelineBase):
@@ -118,6 +283,11 @@ class ReducePipeline(base_handler.PipelineBase):
       function.
     params: mapper parameters to use as dict.
     filenames: list of filenames to reduce.
+    streaming_values: if True, filenames is a list of lists of sorted runs
+      from a shuffle without merge, which are read with
+      StreamingKeyValuesReader.
+    combiner_spec: optional specification of a combiner function used by
+      StreamingKeyValuesReader for keys with many values.
 
   Returns:
     filenames from output writer.
@@ -128,17 +298,31 @@ class ReducePipeline(base_handler.PipelineBase):
           reducer_spec,
           output_writer_spec,
           params,
-          filenames):
+          filenames,
+          streaming_values=False,
+          combiner_spec=None):
     new_params = dict(params or {})
     new_params.update({
         "files": filenames
         })
+    if not streaming_values:
+      yield mapper_pipeline.MapperPipeline(
+          job_name + "-reduce",
+          reducer_spec,
+          __name__ + ".KeyValuesReader",
+          output_writer_spec,
+          new_params)
+      return
+
+    if combiner_spec:
+      new_params[StreamingKeyValuesReader.COMBINER_PARAM] = combiner_spec
     yield mapper_pipeline.MapperPipeline(
         job_name + "-reduce",
         reducer_spec,
-        __name__ + ".KeyValuesReader",
+        __name__ + ".StreamingKeyValuesReader",
         output_writer_spec,
-        new_params)
+        new_params,
+        shards=len(filenames))
 
 
 
@@ -154,6 +338,11 @@ class MapreducePipeline(base_handler.PipelineBase):
     mapper_params: parameters to use for mapper phase.
     reducer_params: parameters to use for reduce phase.
     shards: number of shards to use as int.
+    combiner_spec: optional specification of a combiner function to
+      pre-aggregate mapper output with, see MapPipeline.
+    streaming_values: if True, the reducer gets the values of a key as they
+      are merged from the sorted shuffle output instead of all at once, see
+      StreamingKeyValuesReader.
 
   Returns:
     filenames from output writer.
@@ -167,18 +356,25 @@ class MapreducePipeline(base_handler.PipelineBase):
           output_writer_spec=None,
           mapper_params=None,
           reducer_params=None,
-          shards=None):
+          shards=None,
+          combiner_spec=None,
+          streaming_values=False):
     map_pipeline = yield MapPipeline(job_name,
                                      mapper_spec,
                                      input_reader_spec,
                                      params=mapper_params,
-                                     shards=shards)
-    shuffler_pipeline = yield ShufflePipeline(job_name, map_pipeline)
+                                     shards=shards,
+                                     combiner_spec=combiner_spec)
+    shuffler_pipeline = yield ShufflePipeline(job_name, map_pipeline,
+                                              merge=not streaming_values,
+                                              shards=shards)
     reducer_pipeline = yield ReducePipeline(job_name,
                                             reducer_spec,
                                             output_writer_spec,
                                             reducer_params,
-                                            shuffler_pipeline)
+                                            shuffler_pipeline,
+                                            streaming_values=streaming_values,
+                                            combiner_spec=combiner_spec)
     with pipeline.After(reducer_pipeline):
       all_temp_files = yield pipeline_common.Extend(
           map_pipeline, shuffler_pipeline)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""Tests for mapreduce.mapreduce_pipeline.StreamingKeyValuesReader."""
+
+import unittest
+
+from mapreduce import input_readers
+from mapreduce import mapreduce_pipeline
+from mapreduce import shuffler_test
+from mapreduce import value_codec
+
+
+def sum_combiner(key, values):
+  """Combiner summing int values."""
+  yield value_codec.IntVector([sum(v[0] for v in values)])
+
+
+class StreamingKeyValuesReaderTest(shuffler_test.FilesTestBase):
+  """Tests StreamingKeyValuesReader."""
+
+  def setUp(self):
+    shuffler_test.FilesTestBase.setUp(self)
+    self.chunk_values = mapreduce_pipeline.StreamingKeyValuesReader.CHUNK_VALUES
+    mapreduce_pipeline.StreamingKeyValuesReader.CHUNK_VALUES = 3
+    # key "a" has one value, "b" two in every run and "c" many in one run
+    self.filenames = ["/run-0", "/run-1", "/run-2"]
+    self.values = {}
+    for run, filename in enumerate(self.filenames):
+      pairs = [("a", run), ("b", run), ("b", run + 10)]
+      if run == 1:
+        pairs.extend(("c", i) for i in xrange(20))
+      pairs.append(("d%d" % run, 100))
+      for key, value in pairs:
+        self.values.setdefault(key, []).append(value)
+      shuffler_test.write_run(filename, [
+          (key, value_codec.encode(value_codec.IntVector([value])))
+          for key, value in pairs])
+
+  def tearDown(self):
+    mapreduce_pipeline.StreamingKeyValuesReader.CHUNK_VALUES = self.chunk_values
+    shuffler_test.FilesTestBase.tearDown(self)
+
+  def set_context(self, combiner_spec=None):
+    params = {"files": [self.filenames]}
+    if combiner_spec:
+      params[mapreduce_pipeline.StreamingKeyValuesReader.COMBINER_PARAM] = (
+          combiner_spec)
+    shuffler_test.set_context(
+        "mapreduce.mapreduce_pipeline.StreamingKeyValuesReader", params)
+
+  def new_reader(self):
+    return mapreduce_pipeline.StreamingKeyValuesReader([0] * len(self.filenames))
+
+  def expected(self):
+    return sorted((key, sorted(values))
+                  for key, values in self.values.iteritems())
+
+  def testStreamsValues(self):
+    self.set_context()
+    result = []
+    for key, values in self.new_reader():
+      self.assertFalse(isinstance(values, list))
+      result.append((key, sorted(v[0] for v in values)))
+    self.assertEquals(self.expected(), result)
+
+  def testUnreadValuesAreSkipped(self):
+    self.set_context()
+    keys = [key for key, _ in self.new_reader()]
+    self.assertEquals(["a", "b", "c", "d0", "d1", "d2"], keys)
+
+  def testCheckpointInKey(self):
+    self.set_context()
+    reader = self.new_reader()
+    for key, values in reader:
+      if key == "c":
+        values.next()
+        break
+    reader = mapreduce_pipeline.StreamingKeyValuesReader.from_json(
+        reader.to_json())
+    # the reducer was called for "c", its remaining values are skipped
+    self.assertEquals(["d0", "d1", "d2"], [key for key, _ in reader])
+
+  def testCombiner(self):
+    self.set_context("mapreduce.mapreduce_pipeline_test.sum_combiner")
+    reader = self.new_reader()
+    result = []
+    checkpoints = 0
+    while True:
+      for item in reader:
+        if item is input_readers.ALLOW_CHECKPOINT:
+          checkpoints += 1
+          # end the slice and resume from the saved state
+          reader = mapreduce_pipeline.StreamingKeyValuesReader.from_json(
+              reader.to_json())
+          break
+        key, values = item
+        self.assertTrue(isinstance(values, list))
+        result.append((key, sum(v[0] for v in values)))
+      else:
+        break
+    self.assertTrue(checkpoints > 0)
+    self.assertEquals(
+        sorted((key, sum(values)) for key, values in self.values.iteritems()),
+        result)
+
+  def testJsonRoundTrip(self):
+    reader = mapreduce_pipeline.StreamingKeyValuesReader(
+        [1, 2], "key\x00", [value_codec.IntVector([5]), "abc"])
+    json = reader.to_json()
+    restored = mapreduce_pipeline.StreamingKeyValuesReader.from_json(json)
+    self.assertEquals(json, restored.to_json())
+    self.assertEquals(
+        {"offsets": [1, 2]},
+        mapreduce_pipeline.StreamingKeyValuesReader([1, 2]).to_json())
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""Garbage collection policy for mapreduce hot paths.
+
+A full collection walks every live object, which is slow once a slice holds
+large buffers and many records. Instead of calling gc.collect() after every
+flush or batch, hot paths call collect(), which only runs a full collection
+once enough bytes were released or enough young collections ran since the
+previous one.
+
+Bytes are reported by the callers. Young collections are read from the
+counts the gc module keeps for its older generations. The worker handler
+calls start_slice() and end_slice() around every slice, so bytes reported
+by an earlier slice, possibly of another shard, do not count toward the
+threshold, and the counters of the context grow by the collections of the
+slice only.
+"""
+
+
+
+__all__ = ["collect",
+           "start_slice",
+           "end_slice",
+           "COUNTER_GC_COLLECTIONS",
+           "COUNTER_GC_MSEC",
+           "BYTES_THRESHOLD",
+           "COLLECTIONS_THRESHOLD",
+           "BYTES_THRESHOLD_PARAM",
+           "COLLECTIONS_THRESHOLD_PARAM"]
+
+
+import gc
+import time
+
+from mapreduce import context
+from mapreduce import operation
+
+
+# Counter of full collections run by collect().
+COUNTER_GC_COLLECTIONS = "gc-collections"
+
+# Counter of milliseconds spent in full collections run by collect().
+COUNTER_GC_MSEC = "gc-msec"
+
+# Default number of bytes reported to collect() after which it runs a full
+# collection. Output flushes report up to 1MB, sort batches 16MB.
+BYTES_THRESHOLD = 8 * 1024 * 1024
+
+# Default number of generation 0 collections since the last full collection
+# after which collect() runs one. With the default gc thresholds this is
+# about 70000 container objects allocated and not freed.
+COLLECTIONS_THRESHOLD = 100
+
+# Mapper parameters overriding the thresholds.
+BYTES_THRESHOLD_PARAM = "gc_bytes_threshold"
+COLLECTIONS_THRESHOLD_PARAM = "gc_collections_threshold"
+
+# Bytes reported since the last full collection or the start of the slice.
+_allocated_bytes = 0
+
+# Full collections run in the current slice and milliseconds spent in them.
+_slice_collections = 0
+_slice_msec = 0
+
+
+def _young_collections():
+  """Number of generation 0 collections since the last full collection.
+
+  Generation 1 counts the generation 0 collections since it was collected
+  itself, which happens every threshold1 of them; generation 2 counts the
+  generation 1 collections.
+  """
+  _, count1, count2 = gc.get_count()
+  _, threshold1, _ = gc.get_threshold()
+  return count1 + count2 * threshold1
+
+
+def collect(allocated_bytes=0):
+  """Run a full collection if enough memory was allocated since the last one.
+
+  Args:
+    allocated_bytes: number of bytes the caller allocated since its previous
+      call, e.g. the size of a buffer it just released.
+
+  Returns:
+    True if a collection was run.
+  """
+  global _allocated_bytes, _slice_collections, _slice_msec
+  _allocated_bytes += allocated_bytes
+
+  ctx = context.get()
+  bytes_threshold = BYTES_THRESHOLD
+  collections_threshold = COLLECTIONS_THRESHOLD
+  if ctx:
+    params = ctx.mapreduce_spec.mapper.params
+    bytes_threshold = int(params.get(BYTES_THRESHOLD_PARAM, bytes_threshold))
+    collections_threshold = int(params.get(COLLECTIONS_THRESHOLD_PARAM,
+                                           collections_threshold))
+
+  if (_allocated_bytes < bytes_threshold and
+      _young_collections() < collections_threshold):
+    return False
+
+  start_time = time.time()
+  gc.collect()
+  _allocated_bytes = 0
+  _slice_collections += 1
+  _slice_msec += int((time.time() - start_time) * 1000)
+  return True
+
+
+def start_slice():
+  """Start accounting for a new slice."""
+  global _allocated_bytes, _slice_collections, _slice_msec
+  _allocated_bytes = 0
+  _slice_collections = 0
+  _slice_msec = 0
+
+
+def end_slice(ctx):
+  """Add the full collections of the slice to the counters of ctx.
+
+  Args:
+    ctx: mapreduce context of the slice.
+
+  Returns:
+    The number of full collections run in the slice and the milliseconds
+    spent in them, as a tuple.
+  """
+  collections, msec = _slice_collections, _slice_msec
+  start_slice()
+  if collections:
+    operation.counters.Increment(COUNTER_GC_COLLECTIONS, collections)(ctx)
+    operation.counters.Increment(COUNTER_GC_MSEC, msec)(ctx)
+  return collections, msec
@@ -543,6 +543,11 @@ class MapreduceState(db.Model):
     active_shards: How many shards are still processing.
     start_time: When the job started.
     writer_state: Json property to be used by writer to store its state.
+    shard_splits: Json property holding the pending runtime splits of
+      straggling shards, as a dict of parent shard number (as string) to a
+      dict with "first_shard", "count" and "fraction" entries. The parent
+      hands off the oldest fraction of its remaining input to count new
+      shards numbered from first_shard.
   """
 
   RESULT_SUCCESS = "success"
@@ -558,6 +563,7 @@ class MapreduceState(db.Model):
   counters_map = JsonProperty(CountersMap, default=CountersMap(), indexed=False)
   app_id = db.StringProperty(required=False, indexed=True)
   writer_state = JsonProperty(dict, indexed=False)
+  shard_splits = JsonProperty(dict, indexed=False)
 
   # For UI purposes only.
   chart_url = db.TextProperty(default="")
@@ -657,19 +663,23 @@ class TransientShardState(object):
                shard_id,
                slice_id,
                input_reader,
-               output_writer=None):
+               output_writer=None,
+               last_split=-1):
     self.base_path = base_path
     self.mapreduce_spec = mapreduce_spec
     self.shard_id = shard_id
     self.slice_id = slice_id
     self.input_reader = input_reader
     self.output_writer = output_writer
+    # first shard number of the last runtime split this shard carried out
+    self.last_split = last_split
 
   def to_dict(self):
     """Convert state to dictionary to save in task payload."""
     result = {"mapreduce_spec": self.mapreduce_spec.to_json_str(),
               "shard_id": self.shard_id,
               "slice_id": str(self.slice_id),
+              "last_split": str(self.last_split),
               "input_reader_state": self.input_reader.to_json_str()}
     if self.output_writer:
       result["output_writer_state"] = self.output_writer.to_json_str()
@@ -701,7 +711,8 @@ class TransientShardState(object):
                str(request.get("shard_id")),
                int(request.get("slice_id")),
                input_reader,
-               output_writer=output_writer)
+               output_writer=output_writer,
+               last_split=int(request.get("last_split", -1)))
 
 
 class ShardState(db.Model):
@@ -718,6 +729,8 @@ class ShardState(db.Model):
     shard_id: unique id of this shard as string.
     shard_number: ordered number for this shard.
     result_status: If not None, the final status of this shard.
+    progress: Fraction of its current input the shard has read, if the
+      input reader reports it.
     update_time: The last time this shard state was updated.
     shard_description: A string description of the work this shard will do.
     last_work_item: A string description of the last work item processed.
@@ -733,6 +746,7 @@ class ShardState(db.Model):
   active = db.BooleanProperty(default=True, indexed=False)
   counters_map = JsonProperty(CountersMap, default=CountersMap(), indexed=False)
   result_status = db.StringProperty(choices=_RESULTS, indexed=False)
+  progress = db.FloatProperty(indexed=False)
 
   # For UI purposes only.
   mapreduce_id = db.StringProperty(required=True)
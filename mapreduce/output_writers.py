@@ -30,13 +30,13 @@ __all__ = [
     "RecordsPool",
     ]
 
-import gc
 import string
 import time
 
 from mapreduce.lib import files
 from mapreduce.lib.files import records
 from mapreduce import errors
+from mapreduce import memory
 from mapreduce import model
 from mapreduce import operation
 
@@ -64,6 +64,9 @@ class OutputWriter(model.JsonMixin):
     4) write() method is called to write data.
     5) finalize() is called when shard processing is done.
     5) finalize_job() is called when job is completed.
+
+  extend_job() may be called between 1) and the end of the job when shards
+  are added to a running job.
   """
 
   @classmethod
@@ -85,6 +88,20 @@ class OutputWriter(model.JsonMixin):
     """
     raise NotImplementedError("init_job() not implemented in %s" % cls)
 
+  @classmethod
+  def extend_job(cls, mapreduce_state, shard_count):
+    """Extend job-level writer state to a larger number of shards.
+
+    Writers which can not add shards to a running job leave this
+    unimplemented, and their jobs are never split at runtime.
+
+    Args:
+      mapreduce_state: an instance of model.MapreduceState describing current
+      job. State can be modified.
+      shard_count: new number of shards as int.
+    """
+    raise NotImplementedError("extend_job() not implemented in %s" % cls)
+
   @classmethod
   def finalize_job(cls, mapreduce_state):
     """Finalize job-level writer state.
@@ -230,20 +247,20 @@ class _FilePool(object):
 
 
 class _StringWriter(object):
-  """Simple writer for records api that writes to a string buffer."""
+  """Simple writer for records api that writes to a byte buffer."""
 
   def __init__(self):
-    self._buffer = ""
+    self._buffer = bytearray()
 
-  def to_string(self):
-    """Convert writer buffer to string."""
+  def to_bytes(self):
+    """Writer buffer as byte array, without copying it."""
     return self._buffer
 
   def write(self, data):
     """Write data.
 
     Args:
-      data: data to append to the buffer as string.
+      data: data to append to the buffer as string, byte array or buffer.
     """
     self._buffer += data
 
@@ -299,21 +316,22 @@ class RecordsPool(object):
       for record in self._buffer:
         w.write(record)
 
-    str_buf = buf.to_string()
-    if not self._exclusive and len(str_buf) > _FILES_API_MAX_SIZE:
+    # the files API encodes the request from the byte array directly
+    data = buf.to_bytes()
+    if not self._exclusive and len(data) > _FILES_API_MAX_SIZE:
       # Shouldn't really happen because of flush size.
       raise errors.Error(
           "Buffer too big. Can't write more than %s bytes in one request: "
           "risk of writes interleaving. Got: %s" %
-          (_FILES_API_MAX_SIZE, len(str_buf)))
+          (_FILES_API_MAX_SIZE, len(data)))
 
     # Write data to file.
     start_time = time.time()
     with files.open(self._filename, "a", exclusive_lock=self._exclusive) as f:
-      f.write(str_buf)
+      f.write(data)
       if self._ctx:
         operation.counters.Increment(
-            COUNTER_IO_WRITE_BYTES, len(str_buf))(self._ctx)
+            COUNTER_IO_WRITE_BYTES, len(data))(self._ctx)
     if self._ctx:
       operation.counters.Increment(
           COUNTER_IO_WRITE_MSEC,
@@ -322,7 +340,7 @@ class RecordsPool(object):
     # reset buffer
     self._buffer = []
     self._size = 0
-    gc.collect()
+    memory.collect(len(data))
 
   def __enter__(self):
     return self
@@ -407,8 +425,6 @@ class BlobstoreOutputWriterBase(OutputWriter):
       job.
     """
     output_sharding = _get_output_sharding(mapreduce_state=mapreduce_state)
-    mapper_spec = mapreduce_state.mapreduce_spec.mapper
-    mime_type = mapper_spec.params.get("mime_type", "application/octet-stream")
 
     number_of_files = 1
     if output_sharding == cls.OUTPUT_SHARDING_INPUT_SHARDS:
@@ -417,18 +433,59 @@ class BlobstoreOutputWriterBase(OutputWriter):
 
     filenames = []
     for i in range(number_of_files):
-      blob_file_name = (mapreduce_state.mapreduce_spec.name +
-                        "-" + mapreduce_state.mapreduce_spec.mapreduce_id +
-                        "-output")
       if number_of_files > 1:
-        blob_file_name += "-" + str(i)
-      filenames.append(files.blobstore.create(
-          mime_type=mime_type,
-          _blobinfo_uploaded_filename=blob_file_name))
+        filenames.append(cls._create_file(mapreduce_state, i))
+      else:
+        filenames.append(cls._create_file(mapreduce_state))
 
     mapreduce_state.writer_state = \
         cls._State(filenames).to_json()
 
+  @classmethod
+  def extend_job(cls, mapreduce_state, shard_count):
+    """Extend job-level writer state to a larger number of shards.
+
+    A file is created for every new shard when output is sharded by input
+    shards. Otherwise new shards write to the existing single file.
+
+    Args:
+      mapreduce_state: an instance of model.MapreduceState describing current
+      job.
+      shard_count: new number of shards as int.
+    """
+    output_sharding = _get_output_sharding(mapreduce_state=mapreduce_state)
+    if output_sharding != cls.OUTPUT_SHARDING_INPUT_SHARDS:
+      return
+
+    state = cls._State.from_json(mapreduce_state.writer_state)
+    for i in range(len(state.filenames), shard_count):
+      state.filenames.append(cls._create_file(mapreduce_state, i))
+    mapreduce_state.writer_state = state.to_json()
+
+  @classmethod
+  def _create_file(cls, mapreduce_state, shard_number=None):
+    """Create a blobstore file for the job's output.
+
+    Args:
+      mapreduce_state: an instance of model.MapreduceState describing current
+      job.
+      shard_number: shard number to name the file after, if output is
+        sharded.
+
+    Returns:
+      The writable file name as string.
+    """
+    mapper_spec = mapreduce_state.mapreduce_spec.mapper
+    mime_type = mapper_spec.params.get("mime_type", "application/octet-stream")
+    blob_file_name = (mapreduce_state.mapreduce_spec.name +
+                      "-" + mapreduce_state.mapreduce_spec.mapreduce_id +
+                      "-output")
+    if shard_number is not None:
+      blob_file_name += "-" + str(shard_number)
+    return files.blobstore.create(
+        mime_type=mime_type,
+        _blobinfo_uploaded_filename=blob_file_name)
+
   @classmethod
   def finalize_job(cls, mapreduce_state):
     """Finalize job-level writer state.
@@ -21,7 +21,7 @@ from __future__ import with_statement
 
 
 
-import gc
+import base64
 import heapq
 import logging
 import time
@@ -31,12 +31,14 @@ from mapreduce.lib.pipeline import common as pipeline_common
 from mapreduce.lib import files
 from mapreduce.lib.files import file_service_pb
 from mapreduce.lib.files import records
+from google.appengine.ext import blobstore
 from google.appengine.ext import db
 from mapreduce import base_handler
 from mapreduce import context
 from mapreduce import errors
 from mapreduce import input_readers
 from mapreduce import mapper_pipeline
+from mapreduce import memory
 from mapreduce import operation
 from mapreduce import output_writers
 
@@ -65,55 +67,127 @@ class _OutputFile(db.Model):
     return db.Key.from_path(cls.kind(), job_id)
 
 
-def _compare_keys(key_record1, key_record2):
-  """Compare two (key, records) protos by key."""
-  return cmp(key_record1[0], key_record2[0])
+# Memory in bytes a sort mapper may use for the records of a run.
+_SORT_MEMORY_BYTES = 16 * 1024 * 1024
+
+# Estimated memory in bytes used per record in addition to its length: the
+# string object, its key and the list and sort slots pointing to them.
+_SORT_RECORD_OVERHEAD_BYTES = 120
+
+# Number of keys sampled from the sorted runs of a file per key range it is
+# split into for merging.
+_SPLIT_SAMPLES_PER_RANGE = 8
+
+# Maximum number of sorted runs of an input file. Files with more runs are
+# merged, at most this many runs at a time, which bounds the number of files
+# read at once by any merge.
+_MAX_MERGE_FAN_IN = 16
+
+
+def _read_prefixed_string(record, pos):
+  """Read a length prefixed string field value.
+
+  Args:
+    record: serialized proto as string.
+    pos: position of the length varint.
+
+  Returns:
+    (value, position after the value).
+  """
+  length = 0
+  shift = 0
+  while True:
+    b = ord(record[pos])
+    pos += 1
+    length |= (b & 0x7f) << shift
+    if b < 0x80:
+      break
+    shift += 7
+  return record[pos:pos + length], pos + length
+
+
+def _record_key(record):
+  """Key of a serialized KeyValue proto.
+
+  The key is field 1 and is written first, so it is sliced out after its
+  length varint without parsing the value.
+
+  Args:
+    record: serialized file_service_pb.KeyValue as string.
+
+  Returns:
+    the key as string.
+  """
+  if record[:1] == "\x0a":
+    return _read_prefixed_string(record, 1)[0]
+  proto = file_service_pb.KeyValue()
+  proto.ParseFromString(record)
+  return proto.key()
+
+
+def _record_key_value(record):
+  """Key and value of a serialized KeyValue proto, see _record_key().
+
+  Args:
+    record: serialized file_service_pb.KeyValue as string.
+
+  Returns:
+    (key, value) as strings.
+  """
+  if record[:1] == "\x0a":
+    key, pos = _read_prefixed_string(record, 1)
+    if record[pos:pos + 1] == "\x12":
+      return key, _read_prefixed_string(record, pos + 1)[0]
+  proto = file_service_pb.KeyValue()
+  proto.ParseFromString(record)
+  return proto.key(), proto.value()
 
 
 class _BatchRecordsReader(input_readers.RecordsReader):
-  """Records reader that reads in big batches."""
+  """Records reader that reads in big batches.
+
+  A batch is as large as fits into the "sort_memory_bytes" mapper parameter,
+  counting the estimated per record overhead.
+  """
 
-  BATCH_SIZE = 1024*1024 * 3
+  MEMORY_BYTES_PARAM = "sort_memory_bytes"
 
   def __iter__(self):
+    ctx = context.get()
+    memory_bytes = _SORT_MEMORY_BYTES
+    if ctx:
+      memory_bytes = int(ctx.mapreduce_spec.mapper.params.get(
+          self.MEMORY_BYTES_PARAM, memory_bytes))
+
     records = []
     size = 0
     for record in input_readers.RecordsReader.__iter__(self):
       records.append(record)
-      size += len(record)
-      if size > self.BATCH_SIZE:
+      size += len(record) + _SORT_RECORD_OVERHEAD_BYTES
+      if size > memory_bytes:
         yield records
-        size = 0
         records = []
-        gc.collect()
+        memory.collect(size)
+        size = 0
     if records:
       yield records
       records = []
-      gc.collect()
+      memory.collect(size)
 
 
 def _sort_records_map(records):
   """Map function sorting records.
 
-  Converts records to KeyValue protos, sorts them by key and writes them
-  into new blobstore file. Creates _OutputFile entity to record resulting
-  file name.
+  Sorts records by key and writes them into new blobstore file. Creates
+  _OutputFile entity to record resulting file name.
 
   Args:
     records: list of records which are serialized KeyValue protos.
   """
   ctx = context.get()
-  l = len(records)
-  key_records = [None] * l
-
-  logging.debug("Parsing")
-  for i in range(l):
-    proto = file_service_pb.KeyValue()
-    proto.ParseFromString(records[i])
-    key_records[i] = (proto.key(), records[i])
 
   logging.debug("Sorting")
-  key_records.sort(cmp=_compare_keys)
+  records.sort(key=_record_key)
 
   logging.debug("Writing")
   blob_file_name = (ctx.mapreduce_spec.name + "-" +
@@ -121,8 +195,8 @@ def _sort_records_map(records):
   output_path = files.blobstore.create(
       _blobinfo_uploaded_filename=blob_file_name)
   with output_writers.RecordsPool(output_path, ctx=ctx) as pool:
-    for key_record in key_records:
-      pool.append(key_record[1])
+    for record in records:
+      pool.append(record)
 
   logging.debug("Finalizing")
   files.finalize(output_path)
@@ -143,7 +217,8 @@ class _SortChunksPipeline(base_handler.PipelineBase):
 
   Returns:
     The list of lists of sorted filenames. Each list corresponds to one
-    input file. Each filenames contains a chunk of sorted data.
+    input file. Each filenames contains a chunk of sorted data. No list has
+    more than _MAX_MERGE_FAN_IN files.
   """
   def run(self, job_name, filenames):
     sort_mappers = []
@@ -157,6 +232,7 @@ class _SortChunksPipeline(base_handler.PipelineBase):
           {
               "files": [filename],
               "processing_rate": 1000000,
+              _BatchRecordsReader.MEMORY_BYTES_PARAM: _SORT_MEMORY_BYTES,
           },
           shards=1)
       sort_mappers.append(sort_mapper)
@@ -166,7 +242,98 @@ class _SortChunksPipeline(base_handler.PipelineBase):
       result = yield _CollectOutputFiles(job_ids)
       with pipeline.After(result):
         yield _CleanupOutputFiles(job_ids)
-      yield pipeline_common.Return(result)
+      yield _MergeRunsPipeline(job_name, result)
+
+
+def _merge_groups(filenames, max_runs):
+  """Choose the sorted runs to merge in one merge pass.
+
+  The runs of every file with more than max_runs runs are split into groups
+  of at most _MAX_MERGE_FAN_IN runs. Groups of a single run are left alone.
+
+  Args:
+    filenames: list of lists of sorted runs, one list per input file.
+    max_runs: maximum number of runs a file may keep.
+
+  Returns:
+    list of (file index, list of runs) to merge into one run each.
+  """
+  groups = []
+  for i, runs in enumerate(filenames):
+    if len(runs) <= max_runs:
+      continue
+    for start in xrange(0, len(runs), _MAX_MERGE_FAN_IN):
+      group = runs[start:start + _MAX_MERGE_FAN_IN]
+      if len(group) > 1:
+        groups.append((i, group))
+  return groups
+
+
+def _merge_runs_map(record):
+  """A map function used to merge sorted runs, passing records through."""
+  yield record
+
+
+class _MergeRunsPipeline(base_handler.PipelineBase):
+  """A pipeline to merge sorted runs of files which have too many.
+
+  Every pass merges groups of runs with a mapper job of one shard per
+  group, and the pipeline repeats until no file has more than max_runs
+  runs. Merged runs are deleted.
+
+  Args:
+    job_name: root job name.
+    filenames: list of lists of sorted runs, one list per input file.
+    max_runs: maximum number of runs a file may keep.
+    merge_pass: number of passes done so far, used in job names.
+
+  Returns:
+    The list of lists of sorted runs, in the order of filenames.
+  """
+
+  def run(self, job_name, filenames, max_runs=_MAX_MERGE_FAN_IN,
+          merge_pass=0):
+    groups = _merge_groups(filenames, max_runs)
+    if not groups:
+      yield pipeline_common.Return(filenames)
+      return
+
+    group_runs = [runs for _, runs in groups]
+    merged = yield mapper_pipeline.MapperPipeline(
+        "%s-shuffle-sort-merge-%d" % (job_name, merge_pass),
+        __name__ + "._merge_runs_map",
+        __name__ + "._MergingRecordsReader",
+        output_writer_spec=
+            output_writers.__name__ + ".BlobstoreRecordsOutputWriter",
+        params={"files": group_runs,
+                "processing_rate": 1000000},
+        shards=len(group_runs))
+    result = yield _ReplaceMergedRuns(filenames, max_runs, merged)
+    with pipeline.After(result):
+      yield mapper_pipeline._CleanupPipeline(group_runs)
+    yield _MergeRunsPipeline(job_name, result, max_runs, merge_pass + 1)
+
+
+class _ReplaceMergedRuns(base_handler.PipelineBase):
+  """Replace the runs merged by _MergeRunsPipeline with the merged runs.
+
+  Args:
+    filenames: list of lists of sorted runs before the merge pass.
+    max_runs: max_runs of the merge pass.
+    merged: list of merged runs, one per group of _merge_groups().
+
+  Returns:
+    The list of lists of sorted runs after the merge pass.
+  """
+
+  def run(self, filenames, max_runs, merged):
+    result = [list(runs) for runs in filenames]
+    for (i, runs), merged_run in zip(_merge_groups(filenames, max_runs),
+                                     merged):
+      runs = set(runs)
+      result[i] = [run for run in result[i] if run not in runs]
+      result[i].append(merged_run)
+    return result
 
 
 class _CollectOutputFiles(base_handler.PipelineBase):
@@ -200,11 +367,113 @@ class _CleanupOutputFiles(base_handler.PipelineBase):
       db.delete(_OutputFile.all().ancestor(_OutputFile.get_root_key(job_id)))
 
 
+def _run_sizes(filenames):
+  """Sizes in bytes of finalized blobstore files."""
+  blob_infos = blobstore.BlobInfo.get(
+      [files.blobstore.get_blob_key(filename) for filename in filenames])
+  return [blob_info.size if blob_info else 0 for blob_info in blob_infos]
+
+
+def _first_key_in_block(filename, block):
+  """Key of the first record starting in or after a block of a records file.
+
+  Args:
+    filename: name of a records file of serialized KeyValue protos.
+    block: block number as int.
+
+  Returns:
+    the key as string, or None if no record starts there.
+  """
+  with files.BufferedFile(filename, records.BLOCK_SIZE,
+                          read_ahead=False) as buffered_file:
+    reader = records.RecordsReader(buffered_file)
+    reader.seek(block * records.BLOCK_SIZE)
+    try:
+      return _record_key(reader.read())
+    except EOFError:
+      return None
+
+
+def _block_count(size):
+  """Number of records blocks of a file of size bytes."""
+  return (size + records.BLOCK_SIZE - 1) // records.BLOCK_SIZE
+
+
+def _start_offset(filename, size, start_key):
+  """Offset in a sorted run to read the records of keys >= start_key from.
+
+  Reading from any block boundary yields the first record starting after it,
+  so the last block whose first key is below start_key is found by binary
+  search. Keys below start_key are still read from that block and have to be
+  skipped.
+
+  Args:
+    filename: name of a sorted records file of serialized KeyValue protos.
+    size: size of the file in bytes.
+    start_key: first key to read as string.
+
+  Returns:
+    offset as int.
+  """
+  lo = 0
+  hi = _block_count(size) - 1
+  while lo < hi:
+    mid = (lo + hi + 1) // 2
+    key = _first_key_in_block(filename, mid)
+    if key is not None and key < start_key:
+      lo = mid
+    else:
+      hi = mid - 1
+  return lo * records.BLOCK_SIZE
+
+
+def _split_keys(filenames, range_count):
+  """Choose keys splitting sorted runs into ranges of similar size.
+
+  Keys are sampled at evenly spaced blocks of the runs, with a number of
+  samples proportional to each run's size.
+
+  Args:
+    filenames: names of sorted records files of serialized KeyValue protos.
+    range_count: number of ranges to split into.
+
+  Returns:
+    ascending list of at most range_count - 1 distinct split keys.
+  """
+  sizes = _run_sizes(filenames)
+  total_blocks = sum(_block_count(size) for size in sizes)
+  if not total_blocks:
+    return []
+  sample_count = _SPLIT_SAMPLES_PER_RANGE * range_count
+
+  samples = []
+  for filename, size in zip(filenames, sizes):
+    blocks = _block_count(size)
+    count = min(blocks, int(round(float(sample_count) * blocks / total_blocks)))
+    for i in xrange(count):
+      key = _first_key_in_block(filename, i * blocks // count)
+      if key is not None:
+        samples.append(key)
+  samples.sort()
+
+  split_keys = []
+  for i in xrange(1, range_count):
+    if not samples:
+      break
+    key = samples[i * len(samples) // range_count]
+    if not split_keys or key > split_keys[-1]:
+      split_keys.append(key)
+  return split_keys
+
+
 class _MergingReader(input_readers.InputReader):
   """Reader which merge-reads multiple sorted KeyValue files.
 
-  Reads list of lists of filenames. Each filename list constitutes one shard
-  and is merged together.
+  Reads list of lists of filenames. Each filename list is merged together.
+  With more shards than lists, lists are split into key ranges chosen from
+  sampled keys, and every shard reads one key range of every file of its
+  list. With fewer shards than lists, a shard merges several lists one after
+  another.
 
   Yields (key, values) tuple.
   """
@@ -213,13 +482,29 @@ class _MergingReader(input_readers.InputReader):
 
   FILES_PARAM = "files"
 
-  def __init__(self, offsets):
+  # Whether split_input() may split file lists into key ranges and group
+  # them into fewer shards. Subclasses which only read the whole list of
+  # their shard number in __iter__ turn it off.
+  _SPLIT_BY_KEY_RANGE = True
+
+  def __init__(self, offsets, files_index=None, key_range=None,
+               next_indexes=None):
     """Constructor.
 
     Args:
-      offsets: offsets for each input file to start from as list of ints.
+      offsets: offsets for each input file to start from as list of ints,
+        or None to start from the first key of key_range.
+      files_index: index of the files list to read. Defaults to the shard
+        number.
+      key_range: (start key, end key) of the keys to read, each None for an
+        open end, or None to read all keys.
+      next_indexes: indexes of the files lists to read after files_index,
+        as list of ints.
     """
     self._offsets = offsets
+    self._files_index = files_index
+    self._start_key, self._end_key = key_range or (None, None)
+    self._next_indexes = next_indexes or []
 
   def __iter__(self):
     """Iterate over records in input files.
@@ -229,8 +514,28 @@ class _MergingReader(input_readers.InputReader):
     """
     ctx = context.get()
     mapper_spec = ctx.mapreduce_spec.mapper
-    shard_number = ctx.shard_state.shard_number
-    filenames = mapper_spec.params[self.FILES_PARAM][shard_number]
+    files_index = self._files_index
+    if files_index is None:
+      files_index = ctx.shard_state.shard_number
+    while True:
+      filenames = mapper_spec.params[self.FILES_PARAM][files_index]
+      for result in self._merge(filenames):
+        yield result
+      if not self._next_indexes:
+        return
+      # keys of different lists are disjoint, the next list starts over
+      files_index = self._files_index = self._next_indexes.pop(0)
+      self._offsets = None
+
+  def _merge(self, filenames):
+    """Merge-read the files of a list, see __iter__()."""
+    if self._offsets is None:
+      if self._start_key is None:
+        self._offsets = [0] * len(filenames)
+      else:
+        self._offsets = [
+            _start_offset(filename, size, self._start_key)
+            for filename, size in zip(filenames, _run_sizes(filenames))]
 
     if len(filenames) != len(self._offsets):
       raise Exception("Files list and offsets do not match.")
@@ -238,68 +543,116 @@ class _MergingReader(input_readers.InputReader):
     # Heap with (Key, Value, Index, reader) pairs.
     readers = []
 
-    # Initialize heap
-    for (i, filename) in enumerate(filenames):
-      offset = self._offsets[i]
-      reader = records.RecordsReader(files.BufferedFile(filename))
-      reader.seek(offset)
-      readers.append((None, None, i, reader))
-
-    # Read records from heap and merge values with the same key.
-    current_result = None
-    while readers:
-      (key, value, index, reader) = readers[0]
-
-      if key is not None:
-        if current_result and key != current_result[0]:
-          # New key encountered. Yield corrent key.
-          yield current_result
-        if not current_result or key != current_result[0]:
-          current_result = (key, [])
-        current_result[1].append(value)
-
-      # Read next key/value from reader.
-      try:
-        self._offsets[index] = reader.tell()
-        start_time = time.time()
-        binary_record = reader.read()
-        # update counters
-        if context.get():
-          operation.counters.Increment(
-              input_readers.COUNTER_IO_READ_BYTES,
-              len(binary_record))(context.get())
-          operation.counters.Increment(
-              input_readers.COUNTER_IO_READ_MSEC,
-              int((time.time() - start_time) * 1000))(context.get())
-        proto = file_service_pb.KeyValue()
-        proto.ParseFromString(binary_record)
-        # Put read data back into heap.
-        heapq.heapreplace(readers,
-                          (proto.key(), proto.value(), index, reader))
-      except EOFError:
-        heapq.heappop(readers)
-
-    # Yield leftovers.
-    if current_result:
-      yield current_result
+    buffered_files = []
+    try:
+      # Initialize heap
+      for (i, filename) in enumerate(filenames):
+        offset = self._offsets[i]
+        buffered_file = files.BufferedFile(filename)
+        buffered_files.append(buffered_file)
+        reader = records.RecordsReader(buffered_file)
+        reader.seek(offset)
+        readers.append((None, None, i, reader))
+
+      # Read records from heap and merge values with the same key.
+      current_result = None
+      while readers:
+        (key, value, index, reader) = readers[0]
+
+        if key is not None:
+          if current_result and key != current_result[0]:
+            # New key encountered. Yield corrent key.
+            yield current_result
+          if not current_result or key != current_result[0]:
+            current_result = (key, [])
+          current_result[1].append(value)
+
+        # Read next key/value from reader, skipping keys before the key range.
+        try:
+          while True:
+            self._offsets[index] = reader.tell()
+            start_time = time.time()
+            binary_record = reader.read()
+            # update counters
+            if context.get():
+              operation.counters.Increment(
+                  input_readers.COUNTER_IO_READ_BYTES,
+                  len(binary_record))(context.get())
+              operation.counters.Increment(
+                  input_readers.COUNTER_IO_READ_MSEC,
+                  int((time.time() - start_time) * 1000))(context.get())
+            proto = file_service_pb.KeyValue()
+            proto.ParseFromString(binary_record)
+            if self._start_key is None or proto.key() >= self._start_key:
+              break
+          if self._end_key is not None and proto.key() >= self._end_key:
+            # Past the key range, the file is done.
+            raise EOFError()
+          # Put read data back into heap.
+          heapq.heapreplace(readers,
+                            (proto.key(), proto.value(), index, reader))
+        except EOFError:
+          heapq.heappop(readers)
+
+      # Yield leftovers.
+      if current_result:
+        yield current_result
+    finally:
+      for buffered_file in buffered_files:
+        buffered_file.close()
 
   @classmethod
   def from_json(cls, json):
     """Restore reader from json state."""
-    return cls(json["offsets"])
+    key_range = json.get("key_range")
+    if key_range:
+      key_range = [k if k is None else base64.b64decode(k)
+                   for k in key_range]
+    return cls(json["offsets"], json.get("files_index"), key_range,
+               json.get("next_indexes"))
 
   def to_json(self):
     """Serialize reader state to json."""
-    return {"offsets": self._offsets}
+    json = {"offsets": self._offsets}
+    if self._files_index is not None:
+      json["files_index"] = self._files_index
+    if self._next_indexes:
+      json["next_indexes"] = self._next_indexes
+    if self._start_key is not None or self._end_key is not None:
+      json["key_range"] = [k if k is None else base64.b64encode(k)
+                           for k in (self._start_key, self._end_key)]
+    return json
 
   @classmethod
   def split_input(cls, mapper_spec):
     """Split input into multiple shards.
 
-    Only one shard is generated at the moment.
+    One shard is generated per files list, unless the shard count differs.
+    With more shards, lists are split into key ranges, as evenly as the
+    shard count allows. Split keys are sampled from the files, see
+    _split_keys(). With fewer shards, every shard reads several lists.
     """
     filelists = mapper_spec.params[cls.FILES_PARAM]
-    return [cls([0] * len(files)) for files in filelists]
+    shard_count = mapper_spec.shard_count
+    if not cls._SPLIT_BY_KEY_RANGE or shard_count == len(filelists):
+      return [cls([0] * len(files)) for files in filelists]
+    if shard_count < len(filelists):
+      readers = []
+      for shard in xrange(shard_count):
+        indexes = range(shard, len(filelists), shard_count)
+        readers.append(cls([0] * len(filelists[indexes[0]]), indexes[0],
+                           None, indexes[1:]))
+      return readers
+
+    readers = []
+    for i, files in enumerate(filelists):
+      range_count = shard_count // len(filelists)
+      if i < shard_count % len(filelists):
+        range_count += 1
+      bounds = [None] + _split_keys(files, range_count) + [None]
+      for start_key, end_key in zip(bounds, bounds[1:]):
+        readers.append(cls(None, i, (start_key, end_key)))
+    return readers
 
   @classmethod
   def validate(cls, mapper_spec):
@@ -311,6 +664,63 @@ class _MergingReader(input_readers.InputReader):
       raise errors.BadReaderParamsError("Missing files parameter.")
 
 
+class _MergingRecordsReader(_MergingReader):
+  """Reader which merge-reads multiple sorted KeyValue files.
+
+  Unlike _MergingReader, yields every serialized KeyValue record as it is,
+  in key order.
+  """
+
+  expand_parameters = False
+
+  _SPLIT_BY_KEY_RANGE = False
+
+  def __iter__(self):
+    """Iterate over records in input files in key order.
+
+    self._offsets is updated when a record is yielded, so stopping iterations
+    doesn't skip records and doesn't read the same record twice.
+    """
+    ctx = context.get()
+    mapper_spec = ctx.mapreduce_spec.mapper
+    shard_number = ctx.shard_state.shard_number
+    filenames = mapper_spec.params[self.FILES_PARAM][shard_number]
+
+    if len(filenames) != len(self._offsets):
+      raise Exception("Files list and offsets do not match.")
+
+    buffered_files = []
+    try:
+      # Heap with (key, index, record, end offset, reader) tuples.
+      heap = []
+      for (i, filename) in enumerate(filenames):
+        buffered_file = files.BufferedFile(filename)
+        buffered_files.append(buffered_file)
+        reader = records.RecordsReader(buffered_file)
+        reader.seek(self._offsets[i])
+        self._push(heap, i, reader)
+
+      while heap:
+        (_, index, record, end, reader) = heap[0]
+        self._offsets[index] = end
+        yield record
+        heapq.heappop(heap)
+        self._push(heap, index, reader)
+    finally:
+      for buffered_file in buffered_files:
+        buffered_file.close()
+
+  @staticmethod
+  def _push(heap, index, reader):
+    """Read the next record of reader into the heap, if there is one."""
+    try:
+      record = reader.read()
+    except EOFError:
+      return
+    heapq.heappush(heap, (_record_key(record), index, record, reader.tell(),
+                          reader))
+
+
 class _HashingBlobstoreOutputWriter(output_writers.BlobstoreOutputWriterBase):
   """An OutputWriter which outputs data into blobstore in key-value format.
 
@@ -464,15 +874,18 @@ class _MergePipeline(base_handler.PipelineBase):
   This pipeline merges together individually sorted chunks of each shard.
 
   Args:
-    filenames: list of lists of filenames. Each list will correspond to a single
-      shard. Each file in the list should have keys sorted and should contain
-      records with KeyValue serialized entity.
+    filenames: list of lists of filenames. Each list will correspond to at
+      least one shard. Each file in the list should have keys sorted and
+      should contain records with KeyValue serialized entity.
+    shards: number of shards as int, defaults to one per list. Lists are
+      split into key ranges when there are more shards than lists, and
+      merged several per shard when there are fewer.
 
   Returns:
     The list of filenames, where each filename is fully merged and will contain
     records with KeyValues serialized entity.
   """
-  def run(self, job_name, filenames):
+  def run(self, job_name, filenames, shards=None):
     yield mapper_pipeline.MapperPipeline(
             job_name + "-shuffle-merge",
             __name__ + "._merge_map",
@@ -480,7 +893,7 @@ class _MergePipeline(base_handler.PipelineBase):
             output_writer_spec=
                 output_writers.__name__ + ".BlobstoreRecordsOutputWriter",
             params={'files': filenames},
-            shards=len(filenames))
+            shards=shards or len(filenames))
 
 
 def _hashing_map(binary_record):
@@ -523,16 +936,25 @@ class ShufflePipeline(base_handler.PipelineBase):
     filenames: list of file names to sort. Files have to be of records format
       defined by Files API and contain serialized file_service_pb.KeyValue
       protocol messages.
+    merge: if False, the sorted runs are returned without merging them.
+    shards: number of merge shards as int, defaults to one per file.
 
   Returns:
     The list of filenames as string. Resulting files contain serialized
     file_service_pb.KeyValues protocol messages with all values collated
-    to a single key.
+    to a single key. Without merge, the list of lists of sorted files,
+    each list holding all values of its keys, as serialized KeyValue
+    protocol messages.
   """
-  def run(self, job_name, filenames):
+  def run(self, job_name, filenames, merge=True, shards=None):
     hashed_files = yield _HashPipeline(job_name, filenames)
     sorted_files = yield _SortChunksPipeline(job_name, hashed_files)
-    merged_files = yield _MergePipeline(job_name, sorted_files)
+    if not merge:
+      with pipeline.After(sorted_files):
+        yield mapper_pipeline._CleanupPipeline(hashed_files)
+      yield pipeline_common.Return(sorted_files)
+      return
+    merged_files = yield _MergePipeline(job_name, sorted_files, shards)
     with pipeline.After(merged_files):
       all_temp_files = yield pipeline_common.Extend(
           hashed_files, sorted_files)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""Tests for the key range merge of mapreduce.shuffler."""
+
+from __future__ import with_statement
+
+import os
+import unittest
+
+from google.appengine.api import apiproxy_stub_map
+from mapreduce.lib import files
+from mapreduce.lib.files import file_service_pb
+from mapreduce.lib.files import records
+from mapreduce.lib.files import testutil
+from mapreduce import context
+from mapreduce import model
+from mapreduce import shuffler
+
+
+MAPREDUCE_ID = "mapreduce_id"
+
+
+def make_pairs(run, count):
+  """Deterministic key/value pairs of a sorted run, overlapping other runs."""
+  return [("key%06d" % (i * (run + 2)), "value-%d-%d-%s" % (run, i, "x" * 20))
+          for i in xrange(count)]
+
+
+def write_run(filename, pairs):
+  """Write pairs as a sorted run of serialized KeyValue protos."""
+  with files.open(filename, "a") as f:
+    with records.RecordsWriter(f) as w:
+      for key, value in sorted(pairs):
+        proto = file_service_pb.KeyValue()
+        proto.set_key(key)
+        proto.set_value(value)
+        w.write(proto.Encode())
+
+
+def set_context(reader_spec, params, shard_count=1, shard_number=0):
+  """Make a context of a shard of a mapreduce reading with reader_spec."""
+  mapper_spec = model.MapperSpec("mapreduce.shuffler._merge_map",
+                                 reader_spec, params, shard_count)
+  mapreduce_spec = model.MapreduceSpec("test", MAPREDUCE_ID,
+                                       mapper_spec.to_json())
+  shard_state = model.ShardState.create_new(MAPREDUCE_ID, shard_number)
+  context.Context._set(context.Context(mapreduce_spec, shard_state))
+  return mapper_spec
+
+
+class FilesTestBase(unittest.TestCase):
+  """Sets up an in-memory file service for sorted runs."""
+
+  def setUp(self):
+    os.environ["APPLICATION_ID"] = "testapp"
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    self.file_stub = testutil.TestFileServiceStub()
+    apiproxy_stub_map.apiproxy.RegisterStub("file", self.file_stub)
+    self.run_sizes = shuffler._run_sizes
+    # runs are not finalized into blobs, their sizes are read from the stub
+    shuffler._run_sizes = lambda filenames: [
+        len(self.file_stub.get_content(f)) for f in filenames]
+
+  def tearDown(self):
+    shuffler._run_sizes = self.run_sizes
+    context.Context._set(None)
+
+
+class KeyRangeMergeTest(FilesTestBase):
+  """Tests _MergingReader reading key ranges of sorted runs."""
+
+  def setUp(self):
+    FilesTestBase.setUp(self)
+    self.filelists = []
+    self.pairs = []
+    for i in xrange(2):
+      filenames = []
+      pairs = []
+      for run in xrange(3):
+        filename = "/run-%d-%d" % (i, run)
+        run_pairs = make_pairs(run + i, 4000)
+        write_run(filename, run_pairs)
+        filenames.append(filename)
+        pairs.extend(run_pairs)
+      self.filelists.append(filenames)
+      self.pairs.append(pairs)
+    # the runs have to span blocks to be split
+    self.assertTrue(len(self.file_stub.get_content("/run-0-0")) >
+                    3 * records.BLOCK_SIZE)
+
+  def set_context(self, shard_count):
+    return set_context("mapreduce.shuffler._MergingReader",
+                       {"files": self.filelists}, shard_count)
+
+  def expected(self, files_index):
+    result = {}
+    for key, value in self.pairs[files_index]:
+      result.setdefault(key, []).append(value)
+    return sorted((key, sorted(values)) for key, values in result.iteritems())
+
+  def read(self, reader):
+    return [(key, sorted(values)) for key, values in reader]
+
+  def testSplitInputByList(self):
+    mapper_spec = self.set_context(2)
+    readers = shuffler._MergingReader.split_input(mapper_spec)
+    self.assertEquals(2, len(readers))
+    for shard_number, reader in enumerate(readers):
+      set_context("mapreduce.shuffler._MergingReader",
+                  {"files": self.filelists}, 2, shard_number)
+      self.assertEquals(self.expected(shard_number), self.read(reader))
+
+  def testSplitInputByKeyRange(self):
+    mapper_spec = self.set_context(5)
+    readers = shuffler._MergingReader.split_input(mapper_spec)
+    self.assertEquals(5, len(readers))
+    by_list = {}
+    for reader in readers:
+      json = reader.to_json()
+      self.assertEquals(None, json["offsets"])
+      by_list.setdefault(json["files_index"], []).append(reader)
+    # the first list gets the shard left over
+    self.assertEquals(3, len(by_list[0]))
+    self.assertEquals(2, len(by_list[1]))
+
+    for files_index, readers in by_list.iteritems():
+      results = [self.read(reader) for reader in readers]
+      for result in results:
+        self.assertTrue(result)
+      # ranges are disjoint and ascending
+      for before, after in zip(results, results[1:]):
+        self.assertTrue(before[-1][0] < after[0][0])
+      self.assertEquals(self.expected(files_index), sum(results, []))
+
+  def testSplitInputGroupsLists(self):
+    mapper_spec = self.set_context(1)
+    readers = shuffler._MergingReader.split_input(mapper_spec)
+    self.assertEquals(1, len(readers))
+    expected = self.expected(0) + self.expected(1)
+    self.assertEquals(expected, self.read(readers[0]))
+    # a slice ending in the first list continues with the second one
+    reader = shuffler._MergingReader.split_input(mapper_spec)[0]
+    result = []
+    for key, values in reader:
+      result.append((key, sorted(values)))
+      if len(result) == len(self.expected(0)):
+        break
+    reader = shuffler._MergingReader.from_json(reader.to_json())
+    result.extend(self.read(reader))
+    self.assertEquals(expected, result)
+
+  def testKeyRange(self):
+    self.set_context(1)
+    reader = shuffler._MergingReader(None, 1, ("key001000", "key002000"))
+    self.assertEquals(
+        [(key, values) for key, values in self.expected(1)
+         if "key001000" <= key < "key002000"],
+        self.read(reader))
+
+  def testCheckpoint(self):
+    self.set_context(1)
+    key_range = ("key000500", "key009000")
+    expected = [(key, values) for key, values in self.expected(0)
+                if key_range[0] <= key < key_range[1]]
+    for stop in (0, 1, 10, 500, len(expected) - 1):
+      reader = shuffler._MergingReader(None, 0, key_range)
+      result = []
+      for key, values in reader:
+        result.append((key, sorted(values)))
+        if len(result) > stop:
+          break
+      reader = shuffler._MergingReader.from_json(reader.to_json())
+      result.extend(self.read(reader))
+      self.assertEquals(expected, result, stop)
+
+  def testStartOffset(self):
+    self.set_context(1)
+    for filename in self.filelists[0]:
+      size = len(self.file_stub.get_content(filename))
+      for start_key in ("", "key000000", "key003001", "key010000", "key~"):
+        offset = shuffler._start_offset(filename, size, start_key)
+        self.assertEquals(0, offset % records.BLOCK_SIZE)
+        with files.BufferedFile(filename) as buffered_file:
+          reader = records.RecordsReader(buffered_file)
+          all_keys = [shuffler._record_key(r) for r in reader]
+          reader.seek(offset)
+          keys = [shuffler._record_key(r) for r in reader]
+        self.assertEquals([k for k in all_keys if k >= start_key],
+                          [k for k in keys if k >= start_key])
+      self.assertEquals(0, shuffler._start_offset(filename, size, "key000000"))
+      self.assertTrue(shuffler._start_offset(filename, size, "key~") > 0)
+
+  def testSplitKeys(self):
+    self.set_context(1)
+    filenames = self.filelists[0]
+    self.assertEquals([], shuffler._split_keys(filenames, 1))
+    split_keys = shuffler._split_keys(filenames, 4)
+    self.assertTrue(1 <= len(split_keys) <= 3)
+    self.assertEquals(sorted(set(split_keys)), split_keys)
+
+  def testSplitKeysEmpty(self):
+    self.assertEquals([], shuffler._split_keys(["/empty"], 4))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""Typed encoding of intermediate MapReduce values.
+
+Mapper values are normally converted with str() and reducers have to parse
+them again. Values of the types defined here are instead written in a packed
+binary form which is decoded with a single struct call.
+
+An encoded typed value starts with a NUL byte followed by a type code. Plain
+string values starting with a NUL byte are escaped by doubling it, so every
+string value round-trips unchanged.
+"""
+
+
+
+__all__ = ["IntVector", "encode", "decode", "sum_vectors"]
+
+
+import itertools
+import struct
+
+
+_TAG = "\x00"
+
+# Fixed-width integer formats by increasing width. The narrowest format
+# holding all elements of a vector is used.
+_INT_FORMATS = (
+    ("b", -(1 << 7), (1 << 7) - 1),
+    ("h", -(1 << 15), (1 << 15) - 1),
+    ("i", -(1 << 31), (1 << 31) - 1),
+    ("q", -(1 << 63), (1 << 63) - 1),
+    )
+
+_INT_CODES = frozenset(code for code, _, _ in _INT_FORMATS)
+
+
+class IntVector(tuple):
+  """Tuple of integers which is encoded as a packed fixed-width vector.
+
+  Mappers yield IntVector values instead of strings like '[1, 0]'. Reducers
+  receive IntVector values again and can sum them with sum_vectors().
+  """
+
+  __slots__ = ()
+
+  def __repr__(self):
+    return "IntVector(%s)" % list(self)
+
+
+def _int_format(values):
+  """Narrowest struct format code holding all values."""
+  low = min(values) if values else 0
+  high = max(values) if values else 0
+  for code, min_value, max_value in _INT_FORMATS:
+    if min_value <= low and high <= max_value:
+      return code
+  raise ValueError("IntVector element out of 64-bit range: %s" % (values,))
+
+
+def encode(value):
+  """Encode a value for an intermediate KeyValue record.
+
+  Args:
+    value: IntVector or any value which is converted with str().
+
+  Returns:
+    encoded value as str.
+  """
+  if isinstance(value, IntVector):
+    code = _int_format(value)
+    return _TAG + code + struct.pack("<%d%s" % (len(value), code), *value)
+  value = str(value)
+  if value.startswith(_TAG):
+    return _TAG + value
+  return value
+
+
+def decode(data):
+  """Decode a value produced by encode().
+
+  Args:
+    data: encoded value as str.
+
+  Returns:
+    IntVector for encoded vectors, str otherwise.
+
+  Raises:
+    ValueError: if data has an unknown type code.
+  """
+  if not data.startswith(_TAG):
+    return data
+  code = data[1:2]
+  if code == _TAG:
+    return data[1:]
+  if code not in _INT_CODES:
+    raise ValueError("Unknown value type code %r" % code)
+  count = (len(data) - 2) // struct.calcsize(code)
+  return IntVector(struct.unpack_from("<%d%s" % (count, code), data, 2))
+
+
+def sum_vectors(vectors):
+  """Element-wise sum of integer vectors.
+
+  All elements are flattened into a single list and every column is summed
+  with a strided slice, which avoids per-vector Python work.
+
+  Args:
+    vectors: iterable of equally long integer sequences.
+
+  Returns:
+    IntVector of the sums, empty if there were no vectors.
+  """
+  vectors = iter(vectors)
+  try:
+    first = next(vectors)
+  except StopIteration:
+    return IntVector()
+  width = len(first)
+  flat = list(first)
+  flat.extend(itertools.chain.from_iterable(vectors))
+  if len(flat) % width:
+    raise ValueError("Vectors of different length can not be summed")
+  return IntVector(sum(flat[i::width]) for i in xrange(width))
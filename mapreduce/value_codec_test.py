@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""Tests for mapreduce.value_codec."""
+
+import unittest
+
+from mapreduce import value_codec
+
+
+class ValueCodecTest(unittest.TestCase):
+  """Tests encode() and decode()."""
+
+  def assertRoundTrip(self, value):
+    decoded = value_codec.decode(value_codec.encode(value))
+    self.assertEquals(type(value), type(decoded))
+    self.assertEquals(value, decoded)
+
+  def testStrings(self):
+    for value in ("", "abc", "[1, 0]", "\x00", "\x00\x00b", "\x00q"):
+      self.assertRoundTrip(value)
+    self.assertEquals("[1, 0]", value_codec.encode("[1, 0]"))
+
+  def testNonStringsUseStr(self):
+    self.assertEquals("12", value_codec.encode(12))
+    self.assertEquals("[1, 2]", value_codec.encode([1, 2]))
+
+  def testVectors(self):
+    for value in ((), (0,), (1, -1), (127, -128), (128,), (-32769, 5),
+                  (1 << 40, 0), (-(1 << 63), (1 << 63) - 1)):
+      self.assertRoundTrip(value_codec.IntVector(value))
+
+  def testNarrowestFormat(self):
+    self.assertEquals("\x00b\x01\xff",
+                      value_codec.encode(value_codec.IntVector((1, -1))))
+    self.assertEquals(
+        2 + 2 * 4, len(value_codec.encode(value_codec.IntVector((1, 1 << 20)))))
+
+  def testOutOfRange(self):
+    self.assertRaises(ValueError, value_codec.encode,
+                      value_codec.IntVector((1 << 63,)))
+
+  def testUnknownCode(self):
+    self.assertRaises(ValueError, value_codec.decode, "\x00z\x01")
+
+
+class SumVectorsTest(unittest.TestCase):
+  """Tests sum_vectors()."""
+
+  def testSum(self):
+    self.assertEquals(value_codec.IntVector((4, 6, -1)),
+                      value_codec.sum_vectors([(1, 2, 0), (3, 4, -1)]))
+    self.assertEquals((5, 0), value_codec.sum_vectors(iter([(5, 0)])))
+
+  def testEmpty(self):
+    self.assertEquals(value_codec.IntVector(), value_codec.sum_vectors([]))
+
+  def testDifferentLengths(self):
+    self.assertRaises(ValueError, value_codec.sum_vectors, [(1, 2), (3,)])
+
+
+if __name__ == "__main__":
+  unittest.main()
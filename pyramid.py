@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""Multi-resolution aggregates of the graph MapReduce output.
+
+The graph job writes one CSV line per second.  A pyramid sums those lines
+into fixed size bins of every resolution in RESOLUTIONS, each coarser level
+being computed from the next finer one.  A graph of any window is then drawn
+from the coarsest level which still gives the requested smoothing, so the
+work and payload depend on the number of plotted points only.
+
+Latencies are kept as LatencySketch quantile sketches, which are merged
+when bins are coarsened, so percentiles are only computed for the bins
+actually served.
+
+Levels are stored as text, one "start,hits,busy" line per non-empty bin in
+ascending order, followed by ",<sketch>" for bins with latencies, see
+LatencySketch.to_string().
+
+The 'concurrency' MapReduce writes concurrency changes instead of one line
+per second a request was running; sweep_concurrency() turns them into the
+graph output format.
+"""
+
+import math
+
+import logstats
+
+
+# Bin sizes in seconds. Each resolution is a multiple of the previous one.
+RESOLUTIONS = (1, 10, 60, 300, 3600)
+
+# Names of the values of a point: requests started and request-seconds
+# spent, shown as qps and concurrent requests once divided by the bin size.
+COLUMNS = ('qps', 'conc reqs')
+
+# Names of the latency percentiles following COLUMNS in downsampled points.
+PERCENTILE_COLUMNS = tuple('p%d ms' % p for p in logstats.PERCENTILES)
+
+# Number of points returned when the caller does not ask for a limit.
+DEFAULT_MAX_POINTS = 1000
+
+
+def _parse_sketch(data):
+  data = data.strip()
+  if not data:
+    return None
+  return logstats.LatencySketch.from_string(data)
+
+
+def parse_line(line):
+  """Parse a graph MapReduce output line into (second, [hits, busy], sketch).
+
+  Lines are "second,[hits, busy]", optionally followed by ",<sketch>" with
+  the latencies of requests started in the second. sketch is a
+  LatencySketch, or None for lines without one.
+  """
+  key, values = line.split(',', 1)
+  values, _, sketch = values.partition(']')
+  values = values.strip().lstrip('[').split(',')
+  return (int(math.floor(float(key))), [int(v) for v in values[:len(COLUMNS)]],
+          _parse_sketch(sketch.strip().lstrip(',')))
+
+
+def sweep_concurrency(lines):
+  """Turn 'concurrency' MapReduce output into graph MapReduce output.
+
+  Lines keyed by a whole second carry the change in the number of running
+  requests at that second as their second value, optionally followed by a
+  latency sketch. Their running sum is written for every second with running
+  requests. Lines keyed by a fractional start time only count hits and are
+  passed on unchanged.
+
+  Args:
+    lines: iterable of 'concurrency' MapReduce output lines.
+
+  Yields:
+    graph MapReduce output lines, hits first, then seconds in ascending
+    order.
+  """
+  deltas = {}
+  sketches = {}
+  for line in lines:
+    if not line.strip():
+      continue
+    if '.' in line.split(',', 1)[0]:
+      yield line
+      continue
+    second, values, sketch = parse_line(line)
+    deltas[second] = deltas.get(second, 0) + values[1]
+    if sketch is not None:
+      sketches[second] = sketch.to_string()
+
+  concurrent = 0
+  seconds = sorted(deltas)
+  for i, second in enumerate(seconds):
+    concurrent += deltas[second]
+    if concurrent <= 0:
+      continue
+    end = seconds[i + 1] if i + 1 < len(seconds) else second + 1
+    for t in xrange(second, end):
+      if t in sketches:
+        yield '%d,%s,%s\n' % (t, [0, concurrent], sketches[t])
+      else:
+        yield '%d,%s\n' % (t, [0, concurrent])
+
+
+def _add(level, start, values, sketch):
+  """Add values and sketch to the bin of level starting at start."""
+  total = level.get(start)
+  if total is None:
+    total = level[start] = [[0] * len(COLUMNS), None]
+  for i, v in enumerate(values):
+    total[0][i] += v
+  if sketch is not None:
+    if total[1] is None:
+      total[1] = logstats.LatencySketch()
+    total[1].merge(sketch)
+
+
+def _rebin(level, resolution):
+  result = {}
+  for start, (values, sketch) in level.iteritems():
+    _add(result, start // resolution * resolution, values, sketch)
+  return result
+
+
+def build(lines, resolutions=RESOLUTIONS):
+  """Compute all levels of the pyramid.
+
+  Args:
+    lines: iterable of graph MapReduce output lines.
+    resolutions: bin sizes, each a multiple of the previous one.
+
+  Returns:
+    dict of resolution -> sorted list of (start, [hits, busy], sketch)
+    points, sketch being a LatencySketch or None.
+  """
+  level = {}
+  for line in lines:
+    if not line.strip():
+      continue
+    _add(level, *parse_line(line))
+
+  levels = {}
+  for resolution in resolutions:
+    level = _rebin(level, resolution)
+    levels[resolution] = [(start, values, sketch) for start, (values, sketch)
+                          in sorted(level.iteritems())]
+  return levels
+
+
+def format_level(points):
+  """Encode a level as text, see the module docstring."""
+  lines = []
+  for start, values, sketch in points:
+    line = '%d,%s' % (start, ','.join(str(v) for v in values))
+    if sketch is not None:
+      line += ',' + sketch.to_string()
+    lines.append(line + '\n')
+  return ''.join(lines)
+
+
+def parse_level(lines, start_time=None, end_time=None):
+  """Yield the (start, [hits, busy], sketch) points of level lines in a window.
+
+  Reading stops at the first point at or after end_time.
+  """
+  for line in lines:
+    if not line.strip():
+      continue
+    values = line.split(',', len(COLUMNS) + 1)
+    start = int(values[0])
+    if start_time is not None and start < start_time:
+      continue
+    if end_time is not None and start >= end_time:
+      return
+    sketch = None
+    if len(values) > len(COLUMNS) + 1:
+      sketch = _parse_sketch(values[-1])
+    yield start, [int(v) for v in values[1:len(COLUMNS) + 1]], sketch
+
+
+def plan(smooth_seconds, span, max_points=DEFAULT_MAX_POINTS,
+         resolutions=RESOLUTIONS):
+  """Choose the level and the bin size to draw a window with.
+
+  Args:
+    smooth_seconds: requested bin size.
+    span: length of the window in seconds.
+    max_points: upper bound of the number of bins.
+    resolutions: available levels.
+
+  Returns:
+    (resolution, bin_seconds). bin_seconds is smooth_seconds unless that
+    gives more than max_points bins, in which case bins are widened.
+  """
+  bin_seconds = max(1, int(smooth_seconds))
+  if span > bin_seconds * max_points:
+    bin_seconds = int(math.ceil(float(span) / max_points))
+    resolution = max(r for r in resolutions if r <= bin_seconds)
+    bin_seconds = -(-bin_seconds // resolution) * resolution
+  else:
+    resolution = max(r for r in resolutions if bin_seconds % r == 0)
+  return resolution, bin_seconds
+
+
+def downsample(points, bin_seconds):
+  """Sum points into bins, divide by the bin size and add percentiles.
+
+  Args:
+    points: iterable of (start, [hits, busy], sketch) in ascending order, at
+      a resolution bin_seconds is a multiple of.
+    bin_seconds: bin size.
+
+  Returns:
+    list of [start, qps, concurrent requests] followed by the latency
+    percentiles of PERCENTILE_COLUMNS, which are None for bins without
+    latencies.
+  """
+  level = {}
+  for start, values, sketch in points:
+    _add(level, start // bin_seconds * bin_seconds, values, sketch)
+
+  result = []
+  for start, (values, sketch) in sorted(level.iteritems()):
+    total = [start] + [float(v) / bin_seconds for v in values]
+    if sketch is None:
+      total += [None] * len(PERCENTILE_COLUMNS)
+    else:
+      total += [ms for p, ms in sketch.percentiles()]
+    result.append(total)
+  return result
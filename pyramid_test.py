@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""Tests for pyramid."""
+
+import unittest
+
+import logstats
+import pyramid
+
+
+def make_sketch(*latencies):
+  sketch = logstats.LatencySketch()
+  for ms in latencies:
+    sketch.add(ms)
+  return sketch
+
+
+def strip_sketches(points):
+  return [(start, values) for start, values, _ in points]
+
+
+class PyramidTest(unittest.TestCase):
+  """Tests building and reading pyramid levels."""
+
+  def testParseLine(self):
+    self.assertEquals((12, [3, 7], None), pyramid.parse_line("12.5,[3, 7]\n"))
+    self.assertEquals((12, [3, 7], None), pyramid.parse_line("12,3,7"))
+    sketch = make_sketch(5, 250)
+    second, values, parsed = pyramid.parse_line(
+        "12,[0, 1],%s\n" % sketch.to_string())
+    self.assertEquals((12, [0, 1]), (second, values))
+    self.assertEquals(sketch.buckets, parsed.buckets)
+
+  def testBuild(self):
+    lines = ["5,[1, 2]\n", "\n", "5,[1, 1]\n", "12,[4, 0]\n", "61,[1, 3]\n"]
+    levels = pyramid.build(lines, resolutions=(1, 10, 60))
+    self.assertEquals([(5, [2, 3]), (12, [4, 0]), (61, [1, 3])],
+                      strip_sketches(levels[1]))
+    self.assertEquals([(0, [2, 3]), (10, [4, 0]), (60, [1, 3])],
+                      strip_sketches(levels[10]))
+    self.assertEquals([(0, [6, 3]), (60, [1, 3])], strip_sketches(levels[60]))
+
+  def testBuildMergesSketches(self):
+    lines = ["5,[0, 1],%s\n" % make_sketch(10, 20).to_string(),
+             "5.5,[1, 0]\n",
+             "12,[0, 1],%s\n" % make_sketch(30).to_string(),
+             "13,[0, 1]\n"]
+    levels = pyramid.build(lines, resolutions=(1, 10))
+    self.assertEquals(2, levels[1][0][2].count)
+    self.assertEquals(None, levels[1][2][2])
+    coarse = levels[10]
+    self.assertEquals([(0, [1, 1]), (10, [0, 2])], strip_sketches(coarse))
+    self.assertEquals(make_sketch(10, 20).buckets, coarse[0][2].buckets)
+    self.assertEquals(make_sketch(30).buckets, coarse[1][2].buckets)
+
+  def testBuildCoarserLevelsAgree(self):
+    lines = ["%d,[%d, %d]\n" % (t, t % 3, t % 5) for t in xrange(0, 7300, 7)]
+    levels = pyramid.build(lines)
+    total = [sum(values[i] for _, values, _ in levels[1]) for i in (0, 1)]
+    for resolution in pyramid.RESOLUTIONS:
+      self.assertEquals(
+          total, [sum(values[i] for _, values, _ in levels[resolution])
+                  for i in (0, 1)])
+      for start, _, _ in levels[resolution]:
+        self.assertEquals(0, start % resolution)
+
+  def testLevelRoundTrip(self):
+    points = [(0, [2, 3], None), (10, [4, 0], None), (60, [1, 3], None)]
+    text = pyramid.format_level(points)
+    self.assertEquals("0,2,3\n10,4,0\n60,1,3\n", text)
+    lines = text.splitlines(True)
+    self.assertEquals(points, list(pyramid.parse_level(lines)))
+    self.assertEquals([(10, [4, 0], None)],
+                      list(pyramid.parse_level(lines, 5, 60)))
+
+  def testLevelRoundTripWithSketch(self):
+    sketch = make_sketch(1, 70, 70, 3000)
+    text = pyramid.format_level([(10, [4, 2], sketch)])
+    self.assertEquals("10,4,2,%s\n" % sketch.to_string(), text)
+    [(start, values, parsed)] = pyramid.parse_level([text])
+    self.assertEquals((10, [4, 2]), (start, values))
+    self.assertEquals(sketch.buckets, parsed.buckets)
+
+  def testParseLevelStopsAtEnd(self):
+    def lines():
+      yield "0,1,1\n"
+      yield "10,1,1\n"
+      self.fail("read past the end of the window")
+    self.assertEquals([(0, [1, 1], None)],
+                      list(pyramid.parse_level(lines(), 0, 10)))
+
+  def testPlan(self):
+    self.assertEquals((60, 60), pyramid.plan(60, 3600))
+    self.assertEquals((10, 30), pyramid.plan(30, 3600))
+    self.assertEquals((1, 7), pyramid.plan(7, 3600))
+    # a day at one second would be 86400 points, more than max_points
+    self.assertEquals((60, 120), pyramid.plan(1, 86400, max_points=1000))
+    self.assertEquals((3600, 7200), pyramid.plan(1, 30 * 86400, max_points=500))
+
+  def testDownsample(self):
+    points = [(0, [10, 20], None), (10, [30, 0], None), (60, [6, 6], None)]
+    no_percentiles = [None] * len(pyramid.PERCENTILE_COLUMNS)
+    self.assertEquals([[0, 2.0 / 3, 1.0 / 3] + no_percentiles,
+                       [60, 0.1, 0.1] + no_percentiles],
+                      pyramid.downsample(points, 60))
+    self.assertEquals([], pyramid.downsample([], 60))
+
+  def testDownsamplePercentiles(self):
+    points = [(0, [1, 0], make_sketch(*range(1, 51))),
+              (10, [1, 0], make_sketch(*range(51, 101))),
+              (60, [1, 0], None)]
+    result = pyramid.downsample(points, 60)
+    whole = make_sketch(*range(1, 101))
+    self.assertEquals([ms for _, ms in whole.percentiles()], result[0][3:])
+    self.assertEquals(len(pyramid.PERCENTILE_COLUMNS), len(result[0]) - 3)
+
+
+class SweepConcurrencyTest(unittest.TestCase):
+  """Tests sweep_concurrency()."""
+
+  def testSweep(self):
+    sketch = make_sketch(50, 90).to_string()
+    lines = ["10.25,[1, 0]\n",
+             "10,[0, 1]\n",
+             "12,[0, 1],%s\n" % sketch,
+             "\n",
+             "13,[0, -1]\n",
+             "15,[0, -1]\n"]
+    self.assertEquals(["10.25,[1, 0]\n",
+                       "10,[0, 1]\n",
+                       "11,[0, 1]\n",
+                       "12,[0, 2],%s\n" % sketch,
+                       "13,[0, 1]\n",
+                       "14,[0, 1]\n"],
+                      list(pyramid.sweep_concurrency(lines)))
+
+  def testSweepIntoBuild(self):
+    lines = ["3.5,[1, 0]\n", "3,[0, 1]\n", "5,[0, -1]\n"]
+    levels = pyramid.build(pyramid.sweep_concurrency(lines), resolutions=(1,))
+    self.assertEquals([(3, [1, 1]), (4, [0, 1])], strip_sketches(levels[1]))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""Cache for computed log summaries.
+
+Results are pickled and kept in a small in-process LRU cache in front of
+memcache.  Entries expire after a TTL and the LRU cache is bounded by total
+size in bytes, so a long running instance does not grow without bound.
+
+Only windows which can no longer change should be cached, see
+is_closed_window().
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import pickle
+import time
+
+from google.appengine.api import memcache
+
+
+# Memcache namespace prefix for cached results. The deployed version is
+# appended, so pickles of an older deployment are never loaded.
+NAMESPACE = 'resultcache'
+
+# Seconds a cached result stays valid.
+DEFAULT_TTL_SEC = 60 * 60
+
+# Total size of the pickled results kept in the in-process cache.
+DEFAULT_LOCAL_MAX_BYTES = 16 * 1024 * 1024
+
+# Largest value memcache accepts.
+_MEMCACHE_MAX_BYTES = 1000 * 1000
+
+# Logs for a request show up some time after the request ends. A window is
+# considered closed once its end is at least this many seconds in the past.
+CLOSED_WINDOW_DELAY_SEC = 120
+
+
+def is_closed_window(end_time, now=None):
+  """Whether logs in a window ending at end_time are final."""
+  if now is None:
+    now = time.time()
+  return end_time <= now - CLOSED_WINDOW_DELAY_SEC
+
+
+def make_key(*args):
+  """Cache key for a query described by args."""
+  return hashlib.sha1(repr(args)).hexdigest()
+
+
+class LRUCache(object):
+  """In-process cache of byte strings, bounded by total size and with TTL."""
+
+  def __init__(self, max_bytes=DEFAULT_LOCAL_MAX_BYTES, ttl_sec=DEFAULT_TTL_SEC):
+    self._max_bytes = max_bytes
+    self._ttl_sec = ttl_sec
+    self._size = 0
+    self._entries = collections.OrderedDict()
+
+  def get(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return None
+    expires, value = entry
+    if expires < time.time():
+      self._size -= len(value)
+      return None
+    # re-insert as most recently used
+    self._entries[key] = entry
+    return value
+
+  def set(self, key, value):
+    if len(value) > self._max_bytes:
+      return
+    old = self._entries.pop(key, None)
+    if old is not None:
+      self._size -= len(old[1])
+    self._entries[key] = (time.time() + self._ttl_sec, value)
+    self._size += len(value)
+    while self._size > self._max_bytes:
+      _, (_, evicted) = self._entries.popitem(last=False)
+      self._size -= len(evicted)
+
+
+class ResultCache(object):
+  """Two level cache: in-process LRU first, then memcache."""
+
+  def __init__(self, namespace=NAMESPACE, ttl_sec=DEFAULT_TTL_SEC,
+               local_max_bytes=DEFAULT_LOCAL_MAX_BYTES):
+    self._namespace = '%s-%s' % (namespace,
+                                 os.environ.get('CURRENT_VERSION_ID', ''))
+    self._ttl_sec = ttl_sec
+    self._local = LRUCache(local_max_bytes, ttl_sec)
+
+  def get(self, key):
+    """Returns the cached object for key or None."""
+    data = self._local.get(key)
+    if data is None:
+      data = memcache.get(key, namespace=self._namespace)
+      if data is None:
+        return None
+      self._local.set(key, data)
+    return pickle.loads(data)
+
+  def set(self, key, value):
+    """Cache value, which must be picklable."""
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    self._local.set(key, data)
+    if len(data) > _MEMCACHE_MAX_BYTES:
+      logging.debug("Result of %d bytes is too big for memcache", len(data))
+      return
+    memcache.set(key, data, time=self._ttl_sec, namespace=self._namespace)
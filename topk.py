@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""Approximate most frequent log messages in bounded memory.
+
+Messages are first reduced to a template: numbers, hex ids and quoted
+strings are replaced by placeholders, so messages which only differ in such
+values are counted together.  Templates are then counted with the
+Space-Saving algorithm, which tracks at most a fixed number of entries.  For
+every tracked entry the reported count is an upper bound of the true count
+and count - error a lower bound; every message occurring more often than
+total / capacity is guaranteed to be tracked.
+
+Trackers merge, so per-shard trackers can be combined in a MapReduce reduce
+or combine step.
+"""
+
+import heapq
+import json
+import re
+
+
+# Number of templates tracked by default.
+DEFAULT_CAPACITY = 200
+
+# Longest example message kept per template, in characters.
+MAX_EXAMPLE_LENGTH = 1000
+
+# Placeholders, applied in this order.
+_TEMPLATE_RULES = [
+  (re.compile(r'"(?:[^"\\\n]|\\.)*"'), '"<str>"'),
+  (re.compile(r"(?<!\w)'(?:[^'\\\n]|\\.)*'"), "'<str>'"),
+  (re.compile(r'\b[0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}\b'), '<uuid>'),
+  (re.compile(r'\b0[xX][0-9a-fA-F]+\b'), '<hex>'),
+  (re.compile(r'\b(?=[a-fA-F]*[0-9])[0-9a-fA-F]{8,}\b'), '<hex>'),
+  (re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?'), '<num>'),
+]
+
+
+def template(message):
+  """Message with variable parts replaced by placeholders."""
+  for pattern, placeholder in _TEMPLATE_RULES:
+    message = pattern.sub(placeholder, message)
+  return message
+
+
+class TopK(object):
+  """Space-Saving counter of the most frequent keys.
+
+  Attributes:
+    capacity: maximum number of tracked keys.
+    total: number of occurrences added, tracked or not.
+    entries: dict of key -> [count, error, example].
+  """
+
+  def __init__(self, capacity=DEFAULT_CAPACITY):
+    self.capacity = capacity
+    self.total = 0
+    self.entries = {}
+    # Min-heap of (count, key). Counts only grow, so an item may be stale and
+    # hold a lower count than its entry; _min_key() fixes stale items once
+    # they reach the top. Items of evicted keys are dropped the same way.
+    self._heap = []
+
+  def add(self, key, example=None, cnt=1):
+    """Count cnt occurrences of key.
+
+    Args:
+      key: the key to count, usually a template().
+      example: an original message for key, kept for display.
+      cnt: number of occurrences.
+    """
+    self.total += cnt
+    entry = self.entries.get(key)
+    if entry is not None:
+      entry[0] += cnt
+      return
+    error = 0
+    if len(self.entries) >= self.capacity:
+      # the new key takes over the smallest entry, inheriting its count as
+      # the possible overestimate
+      evicted = self._min_key()
+      heapq.heappop(self._heap)
+      error = self.entries.pop(evicted)[0]
+    if example is not None:
+      example = example[:MAX_EXAMPLE_LENGTH]
+    self.entries[key] = [error + cnt, error, example]
+    heapq.heappush(self._heap, (error + cnt, key))
+    if len(self._heap) > 2 * self.capacity:
+      self._rebuild_heap()
+
+  def _min_key(self):
+    """Key of the smallest entry, left with an up to date item on top of
+    the heap."""
+    heap = self._heap
+    while True:
+      count, key = heap[0]
+      entry = self.entries.get(key)
+      if entry is None:
+        heapq.heappop(heap)
+      elif entry[0] != count:
+        heapq.heapreplace(heap, (entry[0], key))
+      else:
+        return key
+
+  def _rebuild_heap(self):
+    self._heap = [(entry[0], key) for key, entry in self.entries.iteritems()]
+    heapq.heapify(self._heap)
+
+  def min_count(self):
+    """Count every untracked key may have reached."""
+    if not self.entries or len(self.entries) < self.capacity:
+      return 0
+    return self.entries[self._min_key()][0]
+
+  def merge(self, other):
+    """Add all occurrences counted in other.
+
+    Keys missing from one of the trackers may have occurred up to that
+    tracker's min_count() times, which is added to their count and error.
+    """
+    mine = self.min_count()
+    theirs = other.min_count()
+    merged = {}
+    for key in set(self.entries) | set(other.entries):
+      a = self.entries.get(key, (mine, mine, None))
+      b = other.entries.get(key, (theirs, theirs, None))
+      merged[key] = [a[0] + b[0], a[1] + b[1], a[2] or b[2]]
+    if len(merged) > self.capacity:
+      keep = sorted(merged, key=lambda k: merged[k][0], reverse=True)
+      merged = dict((k, merged[k]) for k in keep[:self.capacity])
+    self.entries = merged
+    self._rebuild_heap()
+    self.total += other.total
+
+  def top(self, n=None):
+    """List of (key, count, error, example), most frequent first."""
+    result = sorted(((key, count, error, example)
+                     for key, (count, error, example) in self.entries.iteritems()),
+                    key=lambda item: item[1], reverse=True)
+    return result[:n] if n is not None else result
+
+  def __len__(self):
+    return len(self.entries)
+
+  def to_string(self):
+    """Encode as a JSON string."""
+    return json.dumps({'capacity': self.capacity,
+                       'total': self.total,
+                       'entries': [[key] + entry
+                                   for key, entry in self.entries.iteritems()]})
+
+  @classmethod
+  def from_string(cls, data):
+    """Decode a string produced by to_string()."""
+    data = json.loads(data)
+    tracker = cls(data['capacity'])
+    tracker.total = data['total']
+    for key, count, error, example in data['entries']:
+      tracker.entries[key] = [count, error, example]
+    tracker._rebuild_heap()
+    return tracker
+
+
+def combine(values):
+  """Merge encoded trackers into one encoded tracker.
+
+  The result may be combined again, so this can run as a MapReduce combiner
+  as well as in the reducer.
+  """
+  tracker = None
+  for value in values:
+    other = TopK.from_string(value)
+    if tracker is None:
+      tracker = other
+    else:
+      tracker.merge(other)
+  return tracker.to_string() if tracker is not None else TopK().to_string()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""Tests for topk."""
+
+import random
+import unittest
+
+import topk
+
+
+class TemplateTest(unittest.TestCase):
+  """Tests template()."""
+
+  def testNumbersAndIds(self):
+    self.assertEquals("took <num> ms for <hex>",
+                      topk.template("took 125 ms for 0x1f3a"))
+    self.assertEquals("user <uuid> failed",
+                      topk.template(
+                          "user 123e4567-e89b-12d3-a456-426614174000 failed"))
+
+  def testQuotedStrings(self):
+    self.assertEquals('key "<str>" missing',
+                      topk.template('key "foo 12" missing'))
+    self.assertEquals("key '<str>' missing",
+                      topk.template("key 'foo' missing"))
+
+  def testWordsKept(self):
+    self.assertEquals("shard2 done", topk.template("shard2 done"))
+
+
+class TopKTest(unittest.TestCase):
+  """Tests TopK."""
+
+  def testExactBelowCapacity(self):
+    tracker = topk.TopK(4)
+    for key in "abacab":
+      tracker.add(key, key.upper())
+    self.assertEquals([("a", 3, 0, "A"), ("b", 2, 0, "B"), ("c", 1, 0, "C")],
+                      tracker.top())
+    self.assertEquals(0, tracker.min_count())
+    self.assertEquals(6, tracker.total)
+
+  def testEvictsSmallest(self):
+    tracker = topk.TopK(2)
+    tracker.add("a", cnt=5)
+    tracker.add("b", cnt=2)
+    tracker.add("c")
+    self.assertEquals([("a", 5, 0, None), ("c", 3, 2, None)], tracker.top())
+    self.assertEquals(3, tracker.min_count())
+
+  def testEvictsSmallestAfterIncrements(self):
+    tracker = topk.TopK(2)
+    tracker.add("a")
+    tracker.add("b")
+    # "a" was smallest when added, but is not any more
+    tracker.add("a", cnt=5)
+    tracker.add("c")
+    self.assertEquals(["a", "c"], [key for key, _, _, _ in tracker.top()])
+
+  def testSpaceSavingInvariants(self):
+    rand = random.Random(1)
+    for capacity in (1, 2, 5, 20):
+      tracker = topk.TopK(capacity)
+      counts = {}
+      for _ in xrange(2000):
+        key = "k%d" % int(rand.paretovariate(1.2))
+        cnt = rand.randint(1, 3)
+        counts[key] = counts.get(key, 0) + cnt
+        tracker.add(key, cnt=cnt)
+
+        self.assertTrue(len(tracker) <= capacity)
+        if len(tracker) == capacity:
+          self.assertEquals(
+              min(count for _, count, _, _ in tracker.top()),
+              tracker.min_count())
+      self.assertEquals(tracker.total,
+                        sum(count for _, count, _, _ in tracker.top()))
+      for key, count, error, _ in tracker.top():
+        self.assertTrue(count - error <= counts[key] <= count)
+      for key, count in counts.iteritems():
+        if count > tracker.total / capacity:
+          self.assertTrue(key in tracker.entries)
+
+  def testExampleTruncated(self):
+    tracker = topk.TopK()
+    tracker.add("a", "x" * (topk.MAX_EXAMPLE_LENGTH + 10))
+    self.assertEquals(topk.MAX_EXAMPLE_LENGTH, len(tracker.top()[0][3]))
+
+  def testMerge(self):
+    first = topk.TopK(2)
+    first.add("a", cnt=5)
+    first.add("b", cnt=1)
+    second = topk.TopK(2)
+    second.add("a", cnt=2)
+    second.add("c", cnt=3)
+    first.merge(second)
+    # "c" may have occurred min_count() == 1 times in the first tracker
+    self.assertEquals([("a", 7, 0, None), ("c", 4, 1, None)], first.top())
+    self.assertEquals(11, first.total)
+    first.add("d")
+    self.assertEquals(["a", "d"], [key for key, _, _, _ in first.top()])
+
+  def testStringRoundTrip(self):
+    tracker = topk.TopK(2)
+    tracker.add("a", "example", 4)
+    tracker.add("b", cnt=2)
+    tracker.add("c")
+    decoded = topk.TopK.from_string(tracker.to_string())
+    self.assertEquals(tracker.capacity, decoded.capacity)
+    self.assertEquals(tracker.total, decoded.total)
+    self.assertEquals(tracker.top(), decoded.top())
+    self.assertEquals(3, decoded.min_count())
+
+  def testCombine(self):
+    values = []
+    for key in "aab":
+      tracker = topk.TopK()
+      tracker.add(key)
+      values.append(tracker.to_string())
+    combined = topk.TopK.from_string(topk.combine(values))
+    self.assertEquals([("a", 2, 0, None), ("b", 1, 0, None)], combined.top())
+    self.assertEquals(0, topk.TopK.from_string(topk.combine([])).total)
+
+
+if __name__ == "__main__":
+  unittest.main()